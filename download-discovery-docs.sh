@@ -0,0 +1,10 @@
+#!/bin/bash
+# downloads the Google API discovery documents used to build the GA service objects.
+# the bundled documents are trimmed to the methods we use, downloaded documents describe the whole API.
+
+set -e # everything must pass
+
+dir="src/article_metrics/ga_metrics/discovery"
+mkdir -p "$dir"
+curl --fail --silent --show-error "https://analyticsdata.googleapis.com/\$discovery/rest?version=v1beta" > "$dir/analyticsdata-v1beta.json"
+curl --fail --silent --show-error "https://www.googleapis.com/discovery/v1/apis/analytics/v3/rest" > "$dir/analytics-v3.json"
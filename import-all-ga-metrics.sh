@@ -4,4 +4,5 @@ source install.sh
 # this script can take a little while to complete
 # --days    number of days back in time to import from
 # --months  number of months back in time to import from
-./manage.sh import_metrics --days=9999 --months=9999 --only-cached --cached
+# --bulk-load load article metrics using a staging table and COPY
+./manage.sh import_metrics --days=9999 --months=9999 --bulk-load --only-cached --cached
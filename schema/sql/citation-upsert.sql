@@ -0,0 +1,30 @@
+-- inserts many citations in a single statement, updating any that already exist.
+-- each column is passed in as an array, one element per citation, and unnested into rows.
+-- existing citations whose values are unchanged are not touched and keep their `datetime_record_updated`,
+-- so only new and changed citations are picked up by `recently_updated_citations` and notified.
+-- returns the article id of each citation inserted or updated and whether it was inserted (`xmax` is 0 for new rows).
+insert into metrics_citation as mc
+    (article_id, source, num, source_id, datetime_record_created, datetime_record_updated)
+
+select
+    article_id, source, num, source_id, %(now)s, %(now)s
+
+from
+    unnest(%(article_id)s::integer[],
+           %(source)s::varchar[],
+           %(num)s::integer[],
+           %(source_id)s::varchar[])
+    as citation (article_id, source, num, source_id)
+
+on conflict (article_id, source) do update set
+    num = excluded.num,
+    source_id = excluded.source_id,
+    datetime_record_updated = excluded.datetime_record_updated
+
+where
+    (mc.num, mc.source_id)
+    is distinct from
+    (excluded.num, excluded.source_id)
+
+returning
+    mc.article_id, (mc.xmax = 0) as created
@@ -0,0 +1,50 @@
+-- merges the metrics in `metrics_metric_staging` into `metrics_metric`, creating any missing articles first.
+-- like `metrics-upsert.sql`, existing metrics whose values are unchanged are not touched.
+-- returns the number of metrics staged, inserted and updated.
+with
+
+new_article as (
+    insert into metrics_article (doi)
+    select distinct doi from metrics_metric_staging
+    on conflict (doi) do nothing
+    returning id, doi
+),
+
+staged as (
+    select distinct on (ms.doi, ms.date, ms.period, ms.source)
+        coalesce(ma.id, na.id) as article_id, ms.date, ms.period, ms.source, ms."full", ms.abstract, ms.digest, ms.pdf
+    from
+        metrics_metric_staging ms
+        left join metrics_article ma on ma.doi = ms.doi
+        left join new_article na on na.doi = ms.doi
+    order by
+        ms.doi, ms.date, ms.period, ms.source, ms.seq desc
+),
+
+merged as (
+    insert into metrics_metric as mm
+        (article_id, date, period, source, "full", abstract, digest, pdf, datetime_record_created, datetime_record_updated)
+    select
+        article_id, date, period, source, "full", abstract, digest, pdf, %(now)s, %(now)s
+    from
+        staged
+    on conflict (article_id, date, period, source) do update set
+        "full" = excluded."full",
+        abstract = excluded.abstract,
+        digest = excluded.digest,
+        pdf = excluded.pdf,
+        datetime_record_updated = excluded.datetime_record_updated
+    where
+        (mm."full", mm.abstract, mm.digest, mm.pdf)
+        is distinct from
+        (excluded."full", excluded.abstract, excluded.digest, excluded.pdf)
+    returning
+        (mm.xmax = 0) as created
+)
+
+select
+    (select count(*) from staged) as staged,
+    count(*) filter (where created) as created,
+    count(*) filter (where not created) as updated
+from
+    merged
@@ -0,0 +1,13 @@
+-- a temporary table metrics are `COPY`d into before being merged into `metrics_metric` with `metrics-merge.sql`.
+-- `seq` is the position of the metric in the stream, the last of any duplicate metrics is merged.
+create temporary table if not exists metrics_metric_staging (
+    seq integer not null,
+    doi varchar(255) not null,
+    date varchar(10) not null,
+    period varchar(10) not null,
+    source varchar(2) not null,
+    "full" integer not null check ("full" >= 0),
+    abstract integer not null check (abstract >= 0),
+    digest integer not null check (digest >= 0),
+    pdf integer not null check (pdf >= 0)
+) on commit drop
@@ -0,0 +1,36 @@
+-- inserts many metrics in a single statement, updating any that already exist.
+-- each column is passed in as an array, one element per metric, and unnested into rows.
+-- existing metrics whose values are unchanged are not touched and keep their `datetime_record_updated`,
+-- so only new and changed metrics are picked up by `recently_updated_metrics` and notified.
+-- returns the id of each metric inserted or updated and whether it was inserted (`xmax` is 0 for new rows).
+insert into metrics_metric as mm
+    (article_id, date, period, source, "full", abstract, digest, pdf, datetime_record_created, datetime_record_updated)
+
+select
+    article_id, date, period, source, "full", abstract, digest, pdf, %(now)s, %(now)s
+
+from
+    unnest(%(article_id)s::integer[],
+           %(date)s::varchar[],
+           %(period)s::varchar[],
+           %(source)s::varchar[],
+           %(full)s::integer[],
+           %(abstract)s::integer[],
+           %(digest)s::integer[],
+           %(pdf)s::integer[])
+    as metric (article_id, date, period, source, "full", abstract, digest, pdf)
+
+on conflict (article_id, date, period, source) do update set
+    "full" = excluded."full",
+    abstract = excluded.abstract,
+    digest = excluded.digest,
+    pdf = excluded.pdf,
+    datetime_record_updated = excluded.datetime_record_updated
+
+where
+    (mm."full", mm.abstract, mm.digest, mm.pdf)
+    is distinct from
+    (excluded."full", excluded.abstract, excluded.digest, excluded.pdf)
+
+returning
+    mm.id, (mm.xmax = 0) as created
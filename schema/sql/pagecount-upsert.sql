@@ -0,0 +1,24 @@
+-- inserts many page counts in a single statement, updating any that already exist.
+-- each column is passed in as an array, one element per page count, and unnested into rows.
+-- existing page counts whose views are unchanged are not touched.
+-- returns whether each page count inserted or updated was inserted (`xmax` is 0 for new rows).
+insert into metrics_pagecount as mp
+    (page_id, date, views)
+
+select
+    page_id, date, views
+
+from
+    unnest(%(page_id)s::integer[],
+           %(date)s::date[],
+           %(views)s::integer[])
+    as pagecount (page_id, date, views)
+
+on conflict (page_id, date) do update set
+    views = excluded.views
+
+where
+    mp.views is distinct from excluded.views
+
+returning
+    (mp.xmax = 0) as created
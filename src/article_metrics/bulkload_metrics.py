@@ -0,0 +1,74 @@
+"""loads many metrics at once, for full re-imports of GA metrics.
+
+metrics are streamed into a temporary staging table using PostgreSQL's `COPY` and then merged into
+`metrics_metric` with a single statement per-batch. see `schema/sql/metrics-staging.sql` and `metrics-merge.sql`.
+
+`logic.insert_many_rows` is still used for regular imports."""
+
+import csv, io, os
+from django.conf import settings
+from django.db import transaction, connection
+from django.utils import timezone
+from . import models, utils
+from .utils import ensure
+import logging
+
+LOG = logging.getLogger(__name__)
+
+# the number of metrics `COPY`d and merged at once.
+BATCH_SIZE = 50000
+
+STAGING_SQL = open(os.path.join(settings.SQL_PATH, 'metrics-staging.sql'), 'r').read()
+MERGE_SQL = open(os.path.join(settings.SQL_PATH, 'metrics-merge.sql'), 'r').read()
+
+STAGING_COLUMNS = ['seq', 'doi', 'date', 'period', 'source', 'full', 'abstract', 'digest', 'pdf']
+
+def staging_row(seq, data):
+    """returns a row for the staging table from the metric `data` as given to `logic.insert_row`.
+    returns `None` if the metric's doi is bad. metrics are validated in batches by `load`."""
+    try:
+        # temporary, until doi field is replaced with msid field
+        doi = utils.msid2doi(utils.doi2msid(data['doi'], allow_subresource=False))
+    except AssertionError as err:
+        LOG.warning("refusing to insert bad metric: %s" % err, extra={'row-data': data})
+        return None
+    ensure(data['date'], "metric has no date")
+    return [seq, doi, data['date'], data['period'], data['source'], data['full'], data['abstract'], data['digest'], data['pdf']]
+
+def _copy(cursor, row_list):
+    "`COPY`s the rows in `row_list` into the staging table."
+    buf = io.StringIO()
+    csv.writer(buf).writerows(row_list)
+    buf.seek(0)
+    columns = ", ".join('"%s"' % column for column in STAGING_COLUMNS)
+    cursor.copy_expert("COPY metrics_metric_staging (%s) FROM STDIN WITH (FORMAT csv)" % columns, buf)
+
+@transaction.atomic
+def load_batch(row_list):
+    """stages and merges the staging rows in `row_list` using a single transaction.
+    returns a map of the number of metrics `created`, `updated` and `unchanged`."""
+    with connection.cursor() as cursor:
+        cursor.execute(STAGING_SQL)
+        _copy(cursor, row_list)
+        cursor.execute(MERGE_SQL, {'now': timezone.now()})
+        staged, created, updated = cursor.fetchone()
+        # the staging table is dropped on commit, but it may be inside of a larger transaction
+        cursor.execute("TRUNCATE metrics_metric_staging")
+    return {'created': created, 'updated': updated, 'unchanged': staged - created - updated}
+
+def load(data_iter, batch_size=BATCH_SIZE):
+    """creates or updates a `models.Metric` for each metric in `data_iter`, `batch_size` metrics at a time.
+    metrics are dicts like those given to `logic.insert_row` and may be any iterable, they are consumed one at a time.
+    returns a map of the total number of metrics `created`, `updated` and `unchanged`."""
+    ensure(isinstance(batch_size, int) and batch_size > 0, "`batch_size` must be a positive integer")
+    totals = {'created': 0, 'updated': 0, 'unchanged': 0}
+    seq = 0
+    for data_list in utils.partition(data_iter, batch_size):
+        models.validate_metric_rows(data_list)
+        row_list = list(filter(None, (staging_row(seq + i, data) for i, data in enumerate(data_list))))
+        seq += len(data_list)
+        summary = load_batch(row_list)
+        LOG.info("%(created)s metrics created, %(updated)s updated and %(unchanged)s unchanged" % summary)
+        totals = {key: val + summary[key] for key, val in totals.items()}
+    LOG.info("bulk load complete: %(created)s metrics created, %(updated)s updated and %(unchanged)s unchanged" % totals)
+    return totals
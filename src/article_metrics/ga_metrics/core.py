@@ -5,26 +5,29 @@
 # https://developers.google.com/analytics/devguides/reporting/core/v3/reference
 
 from os.path import join
-import os, json, time, random
+import os, re, json, time, random, threading, copy, gzip, hashlib, inspect, types
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
 from datetime import datetime, timedelta
-from googleapiclient import errors
-from googleapiclient.discovery import build
-from oauth2client.client import AccessTokenRefreshError
-from oauth2client.service_account import ServiceAccountCredentials
-from httplib2 import Http
 from .utils import ymd, month_min_max, ensure
 from kids.cache import cache
 import logging
 from django.conf import settings
 from . import elife_v1, elife_v2, elife_v3, elife_v4, elife_v5, elife_v6, elife_vX, elife_v7, elife_v8
-from . import utils, ga4
-from article_metrics.utils import todt_notz, datetime_now
+from . import utils, ga4, ga4_async, store, service
+from article_metrics.utils import todt_notz, datetime_now, splitfilter, exsubdict, paginate
 
 LOG = logging.getLogger(__name__)
 
 MAX_GA_RESULTS = 10000
 GA3, GA4 = 'ga3', 'ga4'
 
+# upper limit on the number of date ranges fetched concurrently by `metrics_for_range`.
+# GA4 allows 10 concurrent requests per-property.
+MAX_WORKERS = 10
+
 # lsh@2021-12: test logic doesn't belong here. replace with a mock during testing
 def output_dir():
     root = os.path.dirname(os.path.dirname(__file__))
@@ -154,19 +157,150 @@ def sanitize_ga_response(ga_response):
         del ga_response['query']['ids']
     return ga_response
 
-@cache
+# cache files
+
+# new cache files are written gzip compressed.
+# existing uncompressed cache files continue to be read, see `find_cache`.
+COMPRESS_CACHE = True
+COMPRESSED_EXT = '.gz'
+
+# level 6 is ~zlib's default, level 9 (gzip's default) is much slower to write for little gain.
+COMPRESSION_LEVEL = 6
+
+def cache_path_variants(path):
+    "returns a pair of the given cache `path` and the path to it's compressed or uncompressed equivalent."
+    if path.endswith(COMPRESSED_EXT):
+        return path, path[:-len(COMPRESSED_EXT)]
+    return path, path + COMPRESSED_EXT
+
+def find_cache(path):
+    "returns the path to an existing cache file for the given `path` in either format or `None` if neither exist."
+    for candidate in cache_path_variants(path):
+        if os.path.exists(candidate):
+            return candidate
+
+def _open_cache_file(path):
+    if path.endswith(COMPRESSED_EXT):
+        return gzip.open(path, 'rt')
+    return open(path, 'r')
+
+def read_results(path):
+    "reads the json at the given `path`, decompressing it if necessary."
+    with _open_cache_file(path) as fh:
+        return json.load(fh)
+
+# number of characters read at a time when streaming rows from a cache file, see `iter_rows`.
+READ_CHUNK_SIZE = 2 ** 16
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+def iter_rows(path):
+    """yields each row of the GA response cached at the given `path`, decompressing it if necessary.
+    the response is read and decoded incrementally so only the current row is held in memory.
+    any other values in the response are decoded and discarded."""
+    decoder = json.JSONDecoder()
+    with _open_cache_file(path) as fh:
+        buf, pos, eof = '', 0, False
+
+        def fill():
+            nonlocal buf, pos, eof
+            # read at least as much again as is buffered so decoding large values stays linear.
+            chunk = fh.read(max(READ_CHUNK_SIZE, len(buf) - pos))
+            eof = not chunk
+            buf, pos = buf[pos:] + chunk, 0
+
+        def peek():
+            "returns the next non-whitespace character without consuming it, or an empty string at the end of the file."
+            nonlocal pos
+            while True:
+                pos = WHITESPACE.match(buf, pos).end()
+                if pos < len(buf) or eof:
+                    return buf[pos:pos + 1]
+                fill()
+
+        def consume(char):
+            nonlocal pos
+            ensure(peek() == char, "malformed cache file, expected %r at %s: %s" % (char, pos, path))
+            pos += 1
+
+        def decode():
+            "decodes and returns the next complete value."
+            nonlocal pos
+            while True:
+                peek()
+                try:
+                    val, end = decoder.raw_decode(buf, pos)
+                    # a value ending at the end of the buffer (like a number) may be incomplete.
+                    if end < len(buf) or eof:
+                        pos = end
+                        return val
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                fill()
+
+        consume('{')
+        if peek() == '}':
+            return
+        while True:
+            key = decode()
+            consume(':')
+            if key == 'rows' and peek() == '[':
+                consume('[')
+                while peek() != ']':
+                    yield decode()
+                    if peek() == ',':
+                        consume(',')
+                consume(']')
+            else:
+                decode()
+            if peek() != ',':
+                break
+            consume(',')
+        consume('}')
+
+def _write_json(results, path):
+    "writes `results` as json to the given `path`, compressed and compactly if `path` ends with `COMPRESSED_EXT`."
+    if path.endswith(COMPRESSED_EXT):
+        with gzip.open(path, 'wt', compresslevel=COMPRESSION_LEVEL) as fh:
+            json.dump(results, fh, separators=(',', ':'), sort_keys=True)
+        return
+    with open(path, 'w') as fh:
+        json.dump(results, fh, indent=4, sort_keys=True)
+
+def compress_cache_file(path):
+    """converts the uncompressed cache file at `path` to a compressed cache file.
+    the uncompressed file is removed only once the compressed file can be read back and matches.
+    returns the path to the compressed file."""
+    ensure(not path.endswith(COMPRESSED_EXT), "file is already compressed: %s" % path)
+    results = read_results(path)
+    new_path = path + COMPRESSED_EXT
+    _write_json(results, new_path)
+    ensure(read_results(new_path) == results, "compressed cache file differs from original, refusing to remove original: %s" % path)
+    os.unlink(path)
+    return new_path
+
+def compress_cache(root):
+    """converts all uncompressed cache files beneath `root` to compressed cache files.
+    returns a list of the new paths."""
+    path_list = []
+    for dirpath, _, fname_list in os.walk(root):
+        for fname in sorted(fname_list):
+            if fname.endswith('.json'):
+                path_list.append(compress_cache_file(join(dirpath, fname)))
+    return path_list
+
+#
+
+# per-thread state, released when the thread finishes.
+_local = threading.local()
+
 def ga_service():
-    service_name = 'analytics'
-    settings_file = settings.GA_SECRETS_LOCATION
-    scope = 'https://www.googleapis.com/auth/analytics.readonly'
-    credentials = ServiceAccountCredentials.from_json_keyfile_name(settings_file, scopes=[scope])
-    http = Http()
-    credentials.authorize(http) # does this 'put' back into the credentials file??
-    # `cache_discovery=False`:
-    # - https://github.com/googleapis/google-api-python-client/issues/299
-    # - https://github.com/googleapis/google-api-python-client/issues/345
-    service = build(service_name, 'v3', http=http, cache_discovery=False)
-    return service
+    """returns a GA3 service object for the current thread.
+    the `httplib2.Http` object used by the service is not safe to share between threads."""
+    if getattr(_local, 'service', None) is None:
+        _local.service = service.build('analytics', 'v3')
+    return _local.service
 
 def guess_era_from_query(query_map):
     # ga4 queries use `dateRanges.0.startDate`.
@@ -197,6 +331,9 @@ def _query_ga(query_map, num_attempts=5):
         # a regular query object can be passed in
         query = query_map
 
+    from googleapiclient import errors
+    from oauth2client.client import AccessTokenRefreshError
+
     # execute it
     for n in range(0, num_attempts):
         try:
@@ -204,7 +341,7 @@ def _query_ga(query_map, num_attempts=5):
                 LOG.info("query attempt %r" % (n + 1))
             else:
                 LOG.info("querying ...")
-            return query.execute()
+            return ga4.execute(query)
 
         except TypeError as error:
             # Handle errors in constructing a query.
@@ -280,8 +417,11 @@ def output_path(results_type, from_date, to_date):
     else:
         dt_str = "%s_%s" % (from_date, to_date)
 
-    # "output/downloads/2014-04-01.json", "output/downloads/2014-04-01_2014-04-30.json"
-    return join(output_dir(), results_type, dt_str + ".json")
+    # "output/downloads/2014-04-01.json.gz", "output/downloads/2014-04-01_2014-04-30.json.gz"
+    path = join(output_dir(), results_type, dt_str + ".json")
+    if COMPRESS_CACHE:
+        path += COMPRESSED_EXT
+    return path
 
 def output_path_from_results(response, results_type=None):
     """determines a path where the given response can live, using the
@@ -308,8 +448,7 @@ def write_results(results, path):
     if not os.path.exists(dirname):
         assert os.system("mkdir -p %s" % dirname) == 0, "failed to make output dir %r" % dirname
     LOG.info("writing %r", path)
-    with open(path, 'w') as fh:
-        json.dump(sanitize_ga_response(results), fh, indent=4, sort_keys=True)
+    _write_json(sanitize_ga_response(results), path)
 
 def query_ga_write_results(query, num_attempts=5):
     "convenience. queries GA then writes the results, returning both the original response and the path to results"
@@ -329,13 +468,14 @@ def cacheable(to_date_dt):
     cache_threshold = datetime_now() - timedelta(days=3)
     return to_date_dt < cache_threshold
 
+KNOWN_RESULTS_TYPES = ['views', 'downloads',
+                       'blog-article', 'collection', 'digest', 'event', 'interview', 'labs-post', 'press-package']
+
 def output_path_v2(results_type, from_date_dt, to_date_dt):
     """generates a path for results of the given type.
     same logic as `output_path`, but more strict.
     """
-    known_results_types = ['views', 'downloads',
-                           'blog-article', 'collection', 'digest', 'event', 'interview', 'labs-post', 'press-package']
-    ensure(results_type in known_results_types, "unknown results type %r: %s" % (results_type, ", ".join(known_results_types)))
+    ensure(results_type in KNOWN_RESULTS_TYPES, "unknown results type %r: %s" % (results_type, ", ".join(KNOWN_RESULTS_TYPES)))
     ensure(type(from_date_dt) == datetime, "from_date_dt must be a datetime object")
     ensure(type(to_date_dt) == datetime, "to_date_dt must be a datetime object")
 
@@ -348,9 +488,11 @@ def output_path_v2(results_type, from_date_dt, to_date_dt):
     else:
         dt_str = "%s_%s" % (from_date, to_date)
 
-    # ll: output/downloads/2014-04-01.json
-    # ll: output/views/2014-01-01_2014-01-31.json
+    # ll: output/downloads/2014-04-01.json.gz
+    # ll: output/views/2014-01-01_2014-01-31.json.gz
     path = join(settings.GA_OUTPUT_SUBDIR, results_type, dt_str + ".json")
+    if COMPRESS_CACHE:
+        path += COMPRESSED_EXT
 
     # do not cache partial results
     if not cacheable(to_date_dt):
@@ -359,41 +501,302 @@ def output_path_v2(results_type, from_date_dt, to_date_dt):
 
     return path
 
+def sqlite_cache():
+    "returns `True` if GA responses are cached in the sqlite `store` rather than as individual files."
+    return settings.GA_CACHE_BACKEND == 'sqlite'
+
+def has_cache(results_type, from_date, to_date):
+    "returns `True` if cached results exist for the given `results_type` and date range."
+    path = output_path_v2(results_type, from_date, to_date)
+    if path and sqlite_cache():
+        return store.exists(results_type, from_date, to_date)
+    return bool(path and find_cache(path))
+
+def provisional_cache():
+    "returns `True` if results for date ranges that can't be cached yet are kept for `settings.GA_PROVISIONAL_TTL` seconds."
+    return settings.GA_PROVISIONAL_TTL > 0
+
+def load_provisional(results_type, from_date, to_date):
+    """returns the provisional results for the given `results_type` on the given date range.
+    returns `None` when the provisional cache is disabled, the date range is cachable or
+    no results were fetched within the last `settings.GA_PROVISIONAL_TTL` seconds."""
+    if provisional_cache() and not cacheable(to_date):
+        fetched_since = datetime_now() - timedelta(seconds=settings.GA_PROVISIONAL_TTL)
+        return store.get_provisional(results_type, from_date, to_date, fetched_since)
+    return None
+
+def has_provisional(results_type, from_date, to_date):
+    "returns `True` if recent provisional results exist for the given `results_type` and date range."
+    return load_provisional(results_type, from_date, to_date) is not None
+
+def write_provisional(results_type, from_date, to_date, results):
+    "keeps `results` of the given `results_type` for a date range that can't be cached yet, removing any expired provisional results."
+    fetched = datetime_now()
+    store.purge_provisional(fetched - timedelta(seconds=settings.GA_PROVISIONAL_TTL))
+    store.put_provisional(results_type, from_date, to_date, results, fetched)
+
 def load_cache(results_type, from_date, to_date, cached, only_cached):
     """returns the contents of the cached data for the given `results_type` on the given date range.
     returns an empty dict when `cached` is `True`, `only_cached` is `True` but no cached file exists.
     returns `None` when `cached` is `False`.
-    returns `None` when given date range is not cachable."""
+    returns provisional results, if any, when given date range is not cachable, see `load_provisional`."""
+    if cached and not cacheable(to_date):
+        return load_provisional(results_type, from_date, to_date)
     if cached and cacheable(to_date):
         path = output_path_v2(results_type, from_date, to_date)
-        has_cache = path and os.path.exists(path)
-        if has_cache:
-            with open(path, 'r') as fh:
-                return json.load(fh)
-        elif only_cached:
+        if path and sqlite_cache():
+            results = store.get(results_type, from_date, to_date)
+            if results is not None:
+                return results
+        else:
+            path = path and find_cache(path)
+            if path:
+                return read_results(path)
+        if only_cached:
             # no cache exists and we've been told to only use cache.
             return {}
 
+def load_cache_rows(results_type, from_date, to_date, cached, only_cached):
+    """like `load_cache` but returns an iterable of the rows of the cached response rather than the response.
+    rows are streamed from cache files, see `iter_rows`.
+    returns an empty list when `cached` is `True`, `only_cached` is `True` but no cached file exists.
+    returns `None` when `cached` is `False`.
+    returns the rows of provisional results, if any, when given date range is not cachable."""
+    if cached and not cacheable(to_date):
+        results = load_provisional(results_type, from_date, to_date)
+        return None if results is None else results.get('rows', [])
+    if cached and cacheable(to_date):
+        path = output_path_v2(results_type, from_date, to_date)
+        if path and sqlite_cache():
+            results = store.get(results_type, from_date, to_date)
+            if results is not None:
+                return results.get('rows', [])
+        else:
+            path = path and find_cache(path)
+            if path:
+                return iter_rows(path)
+        if only_cached:
+            # no cache exists and we've been told to only use cache.
+            return []
+
 def write_results_v2(results, path):
     """writes `results` as json to the given `path`.
     like v1, but expects output directory to exist and will not create it if it doesn't."""
     dirname = os.path.dirname(path)
     ensure(os.path.exists(dirname), "output directory does not exist: %s" % path)
     LOG.debug("writing %r", path)
-    json.dump(results, open(path, 'w'), indent=4, sort_keys=True)
+    _write_json(results, path)
+
+# module level values of these types used by a parser are part of it's version, see `parser_version`.
+PARSER_VALUE_TYPES = (str, bytes, int, float, bool, tuple, list, dict, frozenset, re.Pattern)
+
+def _own(val):
+    "returns `True` if `val` is defined in an `article_metrics` module."
+    return (getattr(val, '__module__', None) or getattr(val, '__name__', '')).startswith('article_metrics.')
+
+def _code_names(code):
+    "returns the global and attribute names used by `code`, including by any functions and comprehensions nested within it."
+    name_set = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            name_set.update(_code_names(const))
+    return name_set
+
+def _parser_parts(fn, seen, name=None):
+    """adds the source of the function `fn` to `seen`, along with the source of every `article_metrics` function
+    and the value of every module level value it uses, directly or via another function.
+    functions are keyed by the `name` they are used by, lambdas have no name of their own."""
+    key = "%s.%s" % (fn.__module__, name or fn.__qualname__)
+    if key in seen:
+        return
+    seen[key] = inspect.getsource(fn)
+    name_set = _code_names(fn.__code__)
+    for name in sorted(name_set):
+        val = fn.__globals__.get(name)
+        if isinstance(val, types.ModuleType):
+            # `utils.enplumpen`, the attribute name is also in `name_set`
+            if _own(val):
+                for attr in sorted(name_set):
+                    attr_val = getattr(val, attr, None)
+                    if isinstance(attr_val, types.FunctionType) and _own(attr_val):
+                        _parser_parts(attr_val, seen, attr)
+        elif isinstance(val, types.FunctionType):
+            if _own(val):
+                _parser_parts(val, seen, name)
+        elif isinstance(val, PARSER_VALUE_TYPES):
+            value = sorted(val) if isinstance(val, frozenset) else val
+            seen["%s.%s" % (fn.__module__, name)] = repr(value)
+
+@cache
+def parser_version(elife_module):
+    """returns a version string for the response parsing logic of the given era module, like 'elife_v7:8f2e...'.
+    the version changes whenever the source of the module's `path_counts` or `event_counts`, of any function they use
+    or any module level value they use changes. changes elsewhere in the era module or in shared modules don't change it."""
+    seen = {}
+    for name in ['path_counts', 'event_counts']:
+        fn = getattr(elife_module, name, None)
+        if fn:
+            _parser_parts(fn, seen)
+    digest = hashlib.sha1()
+    for key, part in sorted(seen.items()):
+        digest.update(key.encode('utf-8'))
+        digest.update(part.encode('utf-8'))
+    return "%s:%s" % (elife_module.__name__.rsplit('.', 1)[-1], digest.hexdigest())
+
+def load_parsed_cache(results_type, elife_module, from_date, to_date, cached):
+    """returns the cached results of parsing the response for the given `results_type` on the given date range.
+    returns `None` when the parsed cache is disabled, there are no parsed results or
+    the results were parsed by a different version of the era module's parser."""
+    if cached and settings.GA_PARSED_CACHE and cacheable(to_date):
+        results = store.get_parsed(results_type, from_date, to_date, parser_version(elife_module))
+        if results is not None and results_type == 'views':
+            # {"10.7554/eLife.09560": {"full": 1, "abstract": 0, "digest": 0}, ...}
+            return {doi: Counter(counts) for doi, counts in results.items()}
+        return results
+
+def write_parsed_cache(results_type, elife_module, from_date, to_date, results):
+    "caches the parsed `results` for the given `results_type` on the given date range, if enabled and cacheable."
+    if settings.GA_PARSED_CACHE and cacheable(to_date):
+        store.put_parsed(results_type, from_date, to_date, parser_version(elife_module), results)
+
+def parse_results(results_type, elife_module, from_date, to_date, rows):
+    """parses an iterable of `rows` from a GA response for the given `results_type` using the given era module.
+    the parsed results are cached unless there were no rows to parse."""
+    parser = elife_module.path_counts if results_type == 'views' else elife_module.event_counts
+    results = parser(rows)
+    # an empty list is also returned for missing cache files when only the cache is used.
+    if rows != []:
+        write_parsed_cache(results_type, elife_module, from_date, to_date, results)
+    return results
+
+def write_cache(results_type, from_date, to_date, results):
+    """caches `results` of the given `results_type` for the given date range.
+    results that can't be cached yet are kept provisionally, if enabled.
+    returns the path written to or `None` if results can't be cached."""
+    path = output_path_v2(results_type, from_date, to_date)
+    if not path:
+        if provisional_cache():
+            write_provisional(results_type, from_date, to_date, results)
+        return None
+    if provisional_cache():
+        store.finalise(results_type, from_date, to_date)
+    if sqlite_cache():
+        store.put(results_type, from_date, to_date, results)
+        return store.db_path()
+    write_results_v2(results, path)
+    if settings.GA_CACHE_MANIFEST:
+        store.record(results_type, from_date, to_date)
+    return path
+
+def _write_ga4_results(query_map, results_type, results):
+    "writes GA4 `results` for the given `query_map`, returning the path written to or `None` if results can't be cached."
+    query_start = todt_notz(query_map['dateRanges'][0]['startDate'])
+    query_end = todt_notz(query_map['dateRanges'][0]['endDate'])
+    return write_cache(results_type, query_start, query_end, results)
+
+OTHER_ROW = "(other)"
+
+def is_aggregated(results):
+    """returns `True` if GA4 has aggregated or sampled some of the rows in the given `results`.
+    this happens when a query returns too much data and some counts are lost or estimated."""
+    # `metadata.dataLossFromOtherRow` is not used, it has been observed on small responses without an "(other)" row.
+    metadata = results.get('metadata') or {}
+    if metadata.get('samplingMetadatas'):
+        return True
+    return any(dimension.get('value') == OTHER_ROW
+               for row in results.get('rows') or []
+               for dimension in row.get('dimensionValues') or [])
+
+def _query_date_range(query_map, from_date, to_date):
+    "returns a copy of the given GA4 `query_map` for the given date range."
+    query_map = copy.deepcopy(query_map)
+    query_map['dateRanges'] = [{'startDate': ymd(from_date), 'endDate': ymd(to_date)}]
+    return query_map
+
+def _sum_metric_values(a, b):
+    "GA4 metric values are strings."
+    try:
+        return str(int(a) + int(b))
+    except ValueError:
+        return str(float(a) + float(b))
+
+def merge_results(results_list):
+    """merges a list of GA4 `results` to the same query over adjacent date ranges.
+    rows with the same dimension values are merged by summing their metric values.
+    the first results are used for everything except the rows."""
+    rows_idx = {}
+    for results in results_list:
+        for row in results.get('rows') or []:
+            key = tuple(dimension['value'] for dimension in row['dimensionValues'])
+            if key in rows_idx:
+                metric_list = zip(rows_idx[key]['metricValues'], row['metricValues'])
+                row = dict(row, metricValues=[{'value': _sum_metric_values(a['value'], b['value'])} for a, b in metric_list])
+            rows_idx[key] = row
+    rows = list(rows_idx.values())
+    return dict(results_list[0], rows=rows, rowCount=len(rows))
+
+def bisect_aggregated(query_map, results, query_fn):
+    """returns the given `results` to the GA4 `query_map` if they are complete, otherwise
+    the date range is split in half and each half is queried with `query_fn`, recursively,
+    until the results are complete or can't be split any further.
+    the results of each half are merged."""
+    if not is_aggregated(results):
+        return results
+    from_date = todt_notz(query_map['dateRanges'][0]['startDate'])
+    to_date = todt_notz(query_map['dateRanges'][0]['endDate'])
+    if from_date >= to_date:
+        LOG.warning("GA aggregated rows for a query on a single day, some counts will be lost: %s", ymd(from_date))
+        return results
+    middle = from_date + timedelta(days=(to_date - from_date).days // 2)
+    LOG.info("GA aggregated rows for query between %s and %s, splitting at %s", ymd(from_date), ymd(to_date), ymd(middle))
+    results_list = []
+    for half_from, half_to in [(from_date, middle), (middle + timedelta(days=1), to_date)]:
+        half_query_map = _query_date_range(query_map, half_from, half_to)
+        results_list.append(bisect_aggregated(half_query_map, query_fn(half_query_map), query_fn))
+    return merge_results(results_list)
+
+def query_ga_v2(query_map, **kwargs):
+    """queries GA4 with the given `query_map`.
+    queries whose results are aggregated are split into smaller date ranges and merged, see `bisect_aggregated`."""
+    query_fn = partial(ga4.query_ga, **kwargs)
+    return bisect_aggregated(query_map, query_fn(query_map), query_fn)
 
 def query_ga_write_results_v2(query_map, from_date_dt, to_date_dt, results_type, **kwargs):
+    "queries GA and writes the results to the cache."
     if guess_era_from_query(query_map) == GA3:
+        if sqlite_cache():
+            # `load_cache` only reads from the store when it's used, GA3 results are stored like GA4 results.
+            response = sanitize_ga_response(query_ga(query_map, **kwargs))
+            return response, write_cache(results_type, from_date_dt, to_date_dt, response)
         return query_ga_write_results(query_map, **kwargs)
 
-    results = ga4.query_ga(query_map, **kwargs)
-    query_start = todt_notz(query_map['dateRanges'][0]['startDate'])
-    query_end = todt_notz(query_map['dateRanges'][0]['endDate'])
-    path = output_path_v2(results_type, query_start, query_end)
-    if path:
-        write_results_v2(results, path)
+    results = query_ga_v2(query_map, **kwargs)
+    path = _write_ga4_results(query_map, results_type, results)
     return results, path
 
+def batch_query_ga_write_results_v2(query_list, **kwargs):
+    """like `query_ga_write_results_v2` but for a list of `(query_map, results_type)` pairs of GA4 queries.
+    queries are sent to GA in batches and each response is written to it's own cache file.
+    returns a list of `(results, path)` pairs in the same order as `query_list`."""
+    ensure(all(guess_era_from_query(query_map) == GA4 for query_map, _ in query_list), "only GA4 queries can be batched")
+    results_list = ga4.batch_query_ga([query_map for query_map, _ in query_list], **kwargs)
+    return _bisect_write_ga4_results(query_list, results_list, **kwargs)
+
+def _bisect_write_ga4_results(query_list, results_list, **kwargs):
+    """writes each of the GA4 `results_list` to it's own cache file, fetching any aggregated results again as smaller queries.
+    returns a list of `(results, path)` pairs in the same order as `query_list`."""
+    query_fn = partial(ga4.query_ga, **kwargs)
+    results_list = [bisect_aggregated(query_map, results, query_fn) for (query_map, _), results in zip(query_list, results_list)]
+    return [(results, _write_ga4_results(query_map, results_type, results))
+            for (query_map, results_type), results in zip(query_list, results_list)]
+
+def async_query_ga_write_results_v2(query_list, **kwargs):
+    """like `batch_query_ga_write_results_v2` but the queries are performed concurrently using the asyncio GA4 client.
+    returns a list of `(results, path)` pairs in the same order as `query_list`."""
+    ensure(all(guess_era_from_query(query_map) == GA4 for query_map, _ in query_list), "only GA4 queries can be run asynchronously")
+    results_list = ga4_async.run_queries([query_map for query_map, _ in query_list], **kwargs)
+    return _bisect_write_ga4_results(query_list, results_list)
+
 #
 #
 #
@@ -406,13 +809,18 @@ def article_views(table_id, from_date, to_date, cached=False, only_cached=False)
 
     elife_module = module_picker(from_date, to_date)
 
-    raw_data = load_cache('views', from_date, to_date, cached, only_cached)
-    if raw_data is None:
+    results = load_parsed_cache('views', elife_module, from_date, to_date, cached)
+    if results is not None:
+        return results
+
+    rows = load_cache_rows('views', from_date, to_date, cached, only_cached)
+    if rows is None:
         # talk to google
         query_map = elife_module.path_counts_query(table_id, from_date, to_date)
         raw_data, _ = query_ga_write_results_v2(query_map, from_date, to_date, 'views')
+        rows = raw_data.get('rows', [])
 
-    return elife_module.path_counts(raw_data.get('rows', []))
+    return parse_results('views', elife_module, from_date, to_date, rows)
 
 def article_downloads(table_id, from_date, to_date, cached=False, only_cached=False):
     "returns article download data either from the cache or from talking to google"
@@ -422,35 +830,326 @@ def article_downloads(table_id, from_date, to_date, cached=False, only_cached=Fa
 
     elife_module = module_picker(from_date, to_date)
 
-    raw_data = load_cache('downloads', from_date, to_date, cached, only_cached)
-    if raw_data is None:
+    results = load_parsed_cache('downloads', elife_module, from_date, to_date, cached)
+    if results is not None:
+        return results
+
+    rows = load_cache_rows('downloads', from_date, to_date, cached, only_cached)
+    if rows is None:
         # talk to google
         query_map = elife_module.event_counts_query(table_id, from_date, to_date)
         raw_data, _ = query_ga_write_results_v2(query_map, from_date, to_date, 'downloads')
+        rows = raw_data.get('rows', [])
+
+    return parse_results('downloads', elife_module, from_date, to_date, rows)
+
+def batchable(from_date, to_date, cached, only_cached):
+    """returns `True` if both article views and downloads for the given date range
+    must be fetched from GA and can be fetched together in a single GA4 request."""
+    if from_date < GA4_SWITCH:
+        return False
+    if cached and not cacheable(to_date):
+        if has_provisional('views', from_date, to_date) or has_provisional('downloads', from_date, to_date):
+            return False
+    if cached and cacheable(to_date):
+        if only_cached:
+            return False
+        if has_cache('views', from_date, to_date) or has_cache('downloads', from_date, to_date):
+            return False
+    return True
 
-    return elife_module.event_counts(raw_data.get('rows', []))
+def article_metrics_batched(table_id, from_date, to_date):
+    """like `article_metrics` but article views and downloads are fetched from GA in a single request.
+    the cache is not consulted."""
+    query_list = article_metrics_query_list(table_id, from_date, to_date)
+    (views, _), (downloads, _) = batch_query_ga_write_results_v2(query_list)
+    return parse_article_metrics(from_date, to_date, views, downloads)
+
+def article_metrics_query_list(table_id, from_date, to_date):
+    "returns a list of `(query_map, results_type)` pairs for the article views and downloads for the given date range."
+    elife_module = module_picker(from_date, to_date)
+    return [
+        (elife_module.path_counts_query(table_id, from_date, to_date), 'views'),
+        (elife_module.event_counts_query(table_id, from_date, to_date), 'downloads'),
+    ]
+
+def parse_article_metrics(from_date, to_date, views, downloads):
+    "parses the raw GA `views` and `downloads` results for the given date range."
+    elife_module = module_picker(from_date, to_date)
+    return {
+        'views': parse_results('views', elife_module, from_date, to_date, views.get('rows', [])),
+        'downloads': parse_results('downloads', elife_module, from_date, to_date, downloads.get('rows', [])),
+    }
+
+def article_metrics_async(table_id, dt_range_list):
+    """like `article_metrics_batched` but the article views and downloads for every date range in `dt_range_list`
+    are fetched concurrently from a single thread using the asyncio GA4 client. the cache is not consulted.
+    returns a map of `{(from-date, to-date): {'views': {...}, 'downloads': {...}}`"""
+    query_list = []
+    for from_date, to_date in dt_range_list:
+        query_list.extend(article_metrics_query_list(table_id, from_date, to_date))
+    response_list = async_query_ga_write_results_v2(query_list)
+    results = {}
+    for (from_date, to_date), ((views, _), (downloads, _)) in zip(dt_range_list, paginate(response_list, 2)):
+        results[(ymd(from_date), ymd(to_date))] = parse_article_metrics(from_date, to_date, views, downloads)
+    return results
 
 def article_metrics(table_id, from_date, to_date, cached=False, only_cached=False):
     "returns a dictionary of article metrics, combining both article views and pdf downloads"
+    if batchable(from_date, to_date, cached, only_cached):
+        return article_metrics_batched(table_id, from_date, to_date)
     return {
         'views': article_views(table_id, from_date, to_date, cached, only_cached),
         'downloads': article_downloads(table_id, from_date, to_date, cached, only_cached),
     }
 
-def metrics_for_range(table_id, dt_range_list, cached=False, only_cached=False):
+def manifest_enabled():
+    "returns `True` if the manifest of cached results is maintained and can be used to find uncached date ranges."
+    return sqlite_cache() or settings.GA_CACHE_MANIFEST
+
+def cache_coverage(dt_range_list, results_type_list=('views', 'downloads')):
+    """returns the set of `(results_type, from-date, to-date)` keys in the manifest of cached results
+    for the date ranges in `dt_range_list`, using a single query."""
+    if not dt_range_list:
+        return set()
+    from_date = min(from_date for from_date, _ in dt_range_list)
+    to_date = max(to_date for _, to_date in dt_range_list)
+    return store.coverage(list(results_type_list), from_date, to_date)
+
+def cache_gaps(dt_range_list, results_type_list=('views', 'downloads')):
+    """returns a list of `(results_type, from-date, to-date)` triples for each date range in `dt_range_list`
+    whose results are missing from the manifest of cached results, in order.
+    date ranges that can't be cached are always missing. date ranges before a results type's inception are never missing."""
+    valid = {'views': valid_view_dt_pair, 'downloads': valid_downloads_dt_pair}
+    covered = cache_coverage(dt_range_list, results_type_list)
+    gap_list = []
+    for from_date, to_date in dt_range_list:
+        for results_type in results_type_list:
+            key = (results_type, ymd(from_date), ymd(to_date))
+            if valid[results_type]((from_date, to_date)) and (key not in covered or not cacheable(to_date)):
+                gap_list.append(key)
+    return gap_list
+
+def cache_hit(from_date, to_date, cached, only_cached, covered=None):
+    """returns `True` if the article metrics for the given date range can be served without talking to google.
+    does not read the cache files.
+    when a set of `covered` keys from the manifest of cached results is given, the cache is not checked either.
+    date ranges that can't be cached yet are a hit when there are recent provisional results."""
+    if not cached:
+        return False
+    if not cacheable(to_date):
+        return provisional_cache() and all(has_provisional(results_type, from_date, to_date) for results_type in ['views', 'downloads'])
+    if only_cached:
+        # missing cache files are empty results, google is never queried.
+        return True
+    if covered is not None:
+        return all((results_type, ymd(from_date), ymd(to_date)) in covered for results_type in ['views', 'downloads'])
+    return all(has_cache(results_type, from_date, to_date) for results_type in ['views', 'downloads'])
+
+def planning_coverage(dt_range_list, cached):
+    "returns the set of keys in the manifest of cached results for `dt_range_list` or `None` if the manifest can't be used."
+    if cached and manifest_enabled():
+        return cache_coverage(dt_range_list)
+    return None
+
+# number of date ranges whose cached results are read from the sqlite store at once.
+PRELOAD_CHUNK_SIZE = 31
+
+@contextmanager
+def preloaded_cache(dt_range_list, cached):
+    """reads the cached views and downloads for exactly the date ranges in `dt_range_list` in a single pass.
+    does nothing unless the sqlite store or the parsed cache is used."""
+    if not (cached and dt_range_list and (sqlite_cache() or settings.GA_PARSED_CACHE)):
+        yield
+        return
+    key_list = [(results_type, from_date, to_date) for from_date, to_date in dt_range_list for results_type in ['views', 'downloads']]
+    with store.preloaded(key_list):
+        yield
+
+def metrics_for_range(table_id, dt_range_list, cached=False, only_cached=False, workers=1):
     """query each `(from-date, to-date)` pair in `dt_range_list`.
+    when `workers` is greater than 1, pairs that can't be served from the cache are fetched concurrently.
+    when the `ga4-async` setting is enabled, pairs that can be batched are fetched concurrently using the asyncio GA4 client.
     returns a map of `{(from-date, to-date): {'views': {...}, 'downloads': {...}}`"""
+    ensure(isinstance(workers, int) and 1 <= workers <= MAX_WORKERS, "`workers` must be an integer between 1 and %s" % MAX_WORKERS)
+
+    def key(dt_pair):
+        from_date, to_date = dt_pair
+        return (ymd(from_date), ymd(to_date))
+
+    if workers == 1 and not settings.GA4_ASYNC:
+        hit_list, miss_list = dt_range_list, []
+    else:
+        covered = planning_coverage(dt_range_list, cached)
+        hit_list, miss_list = splitfilter(lambda dt_pair: cache_hit(*dt_pair, cached, only_cached, covered), dt_range_list)
+
     results = {}
-    for from_date, to_date in dt_range_list:
-        res = article_metrics(table_id, from_date, to_date, cached, only_cached)
-        results[(ymd(from_date), ymd(to_date))] = res
+    for chunk in paginate(hit_list, PRELOAD_CHUNK_SIZE):
+        with preloaded_cache(chunk, cached):
+            for from_date, to_date in chunk:
+                results[key((from_date, to_date))] = article_metrics(table_id, from_date, to_date, cached, only_cached)
+
+    if miss_list and settings.GA4_ASYNC:
+        async_list, miss_list = splitfilter(lambda dt_pair: batchable(*dt_pair, cached, only_cached), miss_list)
+        if async_list:
+            LOG.info("fetching %s date ranges using the asyncio GA4 client", len(async_list))
+            results.update(article_metrics_async(table_id, async_list))
+
+    if miss_list:
+        LOG.info("fetching %s date ranges using %s workers", len(miss_list), workers)
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                future_list = [(dt_pair, executor.submit(article_metrics, table_id, *dt_pair, cached, only_cached)) for dt_pair in miss_list]
+                for dt_pair, future in future_list:
+                    results[key(dt_pair)] = future.result()
+        finally:
+            # the workers have finished, any connections they opened to the store are closed.
+            store.close_connections()
+
+    # results are returned in the same order as `dt_range_list`
+    return {key(dt_pair): results[key(dt_pair)] for dt_pair in dt_range_list}
+
+#
+# multi-day queries
+#
+
+def add_date_dimension(query_map):
+    "returns a copy of the given GA4 `query_map` with a trailing 'date' dimension."
+    query_map = copy.deepcopy(query_map)
+    query_map['dimensions'].append({'name': 'date'})
+    return query_map
+
+def split_response_by_date(response, dt_list):
+    """splits a GA4 `response` to a query with a trailing 'date' dimension into a response per-day in `dt_list`.
+    each per-day response looks like a response to the same query for that single day, without the 'date' dimension.
+    returns a map of `{datetime: response}`."""
+    header_list = response.get('dimensionHeaders') or []
+    ensure(header_list and header_list[-1] == {'name': 'date'}, "response has no trailing 'date' dimension")
+    rows_idx = {ymd(dt): [] for dt in dt_list}
+    for row in response.get('rows') or []:
+        datestr = row['dimensionValues'][-1]['value'] # "20230801"
+        datestr = "%s-%s-%s" % (datestr[:4], datestr[4:6], datestr[6:])
+        ensure(datestr in rows_idx, "row found for unexpected date %r" % datestr)
+        rows_idx[datestr].append(dict(row, dimensionValues=row['dimensionValues'][:-1]))
+
+    template = exsubdict(response, ['rows', 'rowCount', 'dimensionHeaders'])
+    template['dimensionHeaders'] = header_list[:-1]
+    return {dt: dict(template, rows=rows_idx[ymd(dt)], rowCount=len(rows_idx[ymd(dt)])) for dt in dt_list}
+
+def contiguous_era_runs(dt_list):
+    """groups a sorted list of daily datetimes into runs of consecutive days that use the same era module.
+    returns a list of `(module, [datetime, ...])` pairs."""
+    run_list = []
+    for dt in dt_list:
+        elife_module = module_picker(dt, dt)
+        if run_list and run_list[-1][0] == elife_module and run_list[-1][1][-1] + timedelta(days=1) == dt:
+            run_list[-1][1].append(dt)
+        else:
+            run_list.append((elife_module, [dt]))
+    return run_list
+
+def multiday_metrics(table_id, dt_list):
+    """fetches the daily article metrics for each day in `dt_list` from GA4 using a single
+    query for views and a single query for downloads for each run of consecutive days.
+    per-day results are written to the same cache files as a daily query would.
+    the cache is not consulted.
+    returns a map of `{(from-date, to-date): {'views': {...}, 'downloads': {...}}`"""
+    ensure(all(dt >= GA4_SWITCH for dt in dt_list), "multi-day queries are only supported for GA4")
+    results = {}
+    for elife_module, run in contiguous_era_runs(sorted(dt_list)):
+        from_date, to_date = run[0], run[-1]
+        LOG.info("fetching %s days of metrics between %s and %s", len(run), ymd(from_date), ymd(to_date))
+        query_list = [
+            add_date_dimension(elife_module.path_counts_query(table_id, from_date, to_date)),
+            add_date_dimension(elife_module.event_counts_query(table_id, from_date, to_date)),
+        ]
+        views, downloads = ga4.batch_query_ga(query_list, results_pp=ga4.MAX_RESULTS_MULTIDAY)
+        query_fn = partial(ga4.query_ga, results_pp=ga4.MAX_RESULTS_MULTIDAY)
+        views, downloads = [bisect_aggregated(query_map, results, query_fn) for query_map, results in zip(query_list, [views, downloads])]
+        daily_views = split_response_by_date(views, run)
+        daily_downloads = split_response_by_date(downloads, run)
+        for dt in run:
+            for results_type, daily_results in [('views', daily_views), ('downloads', daily_downloads)]:
+                write_cache(results_type, dt, dt, daily_results[dt])
+            results[(ymd(dt), ymd(dt))] = {
+                'views': parse_results('views', elife_module, dt, dt, daily_views[dt]['rows']),
+                'downloads': parse_results('downloads', elife_module, dt, dt, daily_downloads[dt]['rows']),
+            }
     return results
 
-def daily_metrics_between(table_id, from_date, to_date, cached=True, only_cached=False):
-    "does a DAILY query between two dates, NOT a single query within a date range."
+def daily_metrics_between(table_id, from_date, to_date, cached=True, only_cached=False, workers=1, multiday=False):
+    """does a DAILY query between two dates, NOT a single query within a date range.
+    when `multiday` is `True`, GA4 days not in the cache are fetched using a single query spanning many days."""
     date_range = utils.dt_range(from_date, to_date)
-    return metrics_for_range(table_id, date_range, cached, only_cached)
+    if not multiday or only_cached:
+        return metrics_for_range(table_id, date_range, cached, only_cached, workers)
+
+    covered = planning_coverage(date_range, cached)
+    multiday_list = [dt1 for dt1, dt2 in date_range if dt1 >= GA4_SWITCH and not cache_hit(dt1, dt2, cached, only_cached, covered)]
+    results = multiday_metrics(table_id, multiday_list) if multiday_list else {}
+    remaining = [dt_pair for dt_pair in date_range if (ymd(dt_pair[0]), ymd(dt_pair[1])) not in results]
+    results.update(metrics_for_range(table_id, remaining, cached, only_cached, workers))
 
-def monthly_metrics_between(table_id, from_date, to_date, cached=True, only_cached=False):
+    # results are returned in the same order as `date_range`
+    return {(ymd(dt1), ymd(dt2)): results[(ymd(dt1), ymd(dt2))] for dt1, dt2 in date_range}
+
+#
+# monthly metrics derived from daily metrics
+#
+
+def downloads_cached(from_date, to_date, covered=None):
+    """returns `True` if the article downloads for the given date range are cached.
+    when a set of `covered` keys from the manifest of cached results is given, the cache is not checked."""
+    if not cacheable(to_date):
+        return False
+    if covered is not None:
+        return ('downloads', ymd(from_date), ymd(to_date)) in covered
+    return has_cache('downloads', from_date, to_date)
+
+def monthly_downloads_from_daily(table_id, from_date, to_date, covered=None):
+    """returns the article downloads for the month between `from_date` and `to_date` by summing the cached daily article downloads.
+    returns `None` if the month is cached, any day of the month isn't cached, or if the month would be parsed by a different era module than any of it's days.
+    downloads are counts of events and can be summed across days. views can't be: GA4 counts a session that spans
+    midnight once for each day, so monthly views are always queried."""
+    if not valid_downloads_dt_pair((from_date, to_date)):
+        return None
+    if downloads_cached(from_date, to_date, covered):
+        # prefer the results of a monthly query
+        return None
+    dt_range_list = utils.dt_range(from_date, to_date)
+    elife_module = module_picker(from_date, to_date)
+    if any(module_picker(dt, dt) != elife_module for dt, _ in dt_range_list):
+        return None
+    if not all(downloads_cached(dt1, dt2, covered) for dt1, dt2 in dt_range_list):
+        return None
+
+    LOG.info("deriving monthly downloads between %s and %s from daily downloads", ymd(from_date), ymd(to_date))
+    downloads = {}
+    with preloaded_cache(dt_range_list, True):
+        for dt1, dt2 in dt_range_list:
+            for doi, count in article_downloads(table_id, dt1, dt2, cached=True, only_cached=True).items():
+                downloads[doi] = downloads.get(doi, 0) + count
+    return downloads
+
+def monthly_metrics_between(table_id, from_date, to_date, cached=True, only_cached=False, workers=1, from_daily=False):
+    """does a MONTHLY query between two dates.
+    when `from_daily` is `True`, the downloads of months whose days are all cached are derived from the cached daily downloads.
+    the views of those months are still queried, see `monthly_downloads_from_daily`."""
     date_range = utils.dt_month_range(from_date, to_date)
-    return metrics_for_range(table_id, date_range, cached, only_cached)
+    if not from_daily or not cached:
+        return metrics_for_range(table_id, date_range, cached, only_cached, workers)
+
+    covered = None
+    if manifest_enabled():
+        covered = cache_coverage(utils.dt_range(date_range[0][0], date_range[-1][1]) + date_range)
+    results = {}
+    for dt1, dt2 in date_range:
+        downloads = monthly_downloads_from_daily(table_id, dt1, dt2, covered)
+        if downloads is not None:
+            views = article_views(table_id, dt1, dt2, cached, only_cached)
+            results[(ymd(dt1), ymd(dt2))] = {'views': views, 'downloads': downloads}
+    remaining = [dt_pair for dt_pair in date_range if (ymd(dt_pair[0]), ymd(dt_pair[1])) not in results]
+    results.update(metrics_for_range(table_id, remaining, cached, only_cached, workers))
+
+    # results are returned in the same order as `date_range`
+    return {(ymd(dt1), ymd(dt2)): results[(ymd(dt1), ymd(dt2))] for dt1, dt2 in date_range}
@@ -139,20 +139,23 @@ def count_counter_list(counter_lst):
         return c
     return reduce(update, counter_lst)
 
+# the position of each count type in an article's counts, see `group_results`.
+COUNT_TYPE_SLOTS = {'full': 0, 'abstract': 1, 'digest': 2}
+
 def group_results(triplet_list):
-    # for each path, build a list of path_type: value
+    """groups an iterable of (art-id, count-type, count) triples by article,
+    returning a map of `{doi: Counter(full, abstract, digest)}`.
+    every article always has a count for each count type, even if zero."""
+    # counts are summed in place in a list per-article of [full, abstract, digest]
     article_groups = {}
     for art, art_type, count in triplet_list:
-        zeroed_row = Counter({
-            'full': 0,
-            'abstract': 0,
-            'digest': 0,
-        })
-        group = article_groups.get(art, [zeroed_row]) # every article always has a zeroed result
-        group.append(Counter({art_type: count}))
-        article_groups[art] = group
-
-    return {utils.enplumpen(art): count_counter_list(group) for art, group in article_groups.items()}
+        counts = article_groups.get(art)
+        if counts is None:
+            counts = article_groups[art] = [0, 0, 0]
+        counts[COUNT_TYPE_SLOTS[art_type]] += count
+
+    return {utils.enplumpen(art): Counter(full=full, abstract=abstract, digest=digest)
+            for art, (full, abstract, digest) in article_groups.items()}
 
 
 def path_counts(path_count_pairs):
@@ -1,6 +1,7 @@
 from functools import reduce
+from collections import Counter
 from datetime import datetime
-from . import elife_v1, utils
+from . import utils
 from article_metrics.utils import ensure
 import re
 import logging
@@ -103,10 +104,38 @@ def path_count(row):
         LOG.warning("unhandled exception parsing views row, ignoring row: %s" % exc, extra={'row': row})
 
 
+# the most common paths are exactly '/articles/<msid>' or '/reviewed-preprints/<msid>'.
+# these can be classified without a regex, see `classify_paths`.
+FAST_PATH_PREFIXES = ('/articles', '/reviewed-preprints')
+
+def classify_paths(row_list):
+    """takes an iterable of rows from GA4 and returns a map of `{art-id: count}`, summing the counts of rows for the same art-id.
+    rows with the most common path shapes are classified directly and every other row is classified with `path_count`.
+    results and warnings for bad rows are the same as for `path_count`."""
+    counts = {}
+    for row in row_list or []:
+        try:
+            dimension_values, metric_values = row['dimensionValues'], row['metricValues']
+            if len(dimension_values) == 1 and len(metric_values) == 1:
+                prefix, _, artid = dimension_values[0]['value'].rpartition('/')
+                if prefix in FAST_PATH_PREFIXES and len(artid) <= 6 and artid.isdigit() and artid.isascii():
+                    counts[artid] = counts.get(artid, 0) + int(metric_values[0]['value'])
+                    continue
+        except Exception:
+            pass # unusual rows are classified (and reported) below
+
+        triple = path_count(row)
+        if triple:
+            artid, _, count = triple
+            counts[artid] = counts.get(artid, 0) + count
+    return counts
+
 def path_counts(path_count_pairs):
-    "takes a list of rows from GA4 and groups by msid, returning a list of (msid, count-type, count)"
-    path_count_triples = filter(None, map(path_count, path_count_pairs or []))
-    return elife_v1.group_results(path_count_triples)
+    """takes an iterable of rows from GA4 and groups by msid, returning a map of `{doi: Counter(full, abstract, digest)}`.
+    rows are consumed one at a time and may be streamed from a cache file.
+    results are identical to `elife_v1.group_results` over `path_count` for each row."""
+    return {utils.enplumpen(artid): Counter(full=count, abstract=0, digest=0)
+            for artid, count in classify_paths(path_count_pairs).items()}
 
 def event_counts_query(table_id, from_date, to_date):
     "returns the raw GA results for PDF downloads between the two given dates"
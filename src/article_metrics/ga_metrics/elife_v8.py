@@ -109,7 +109,8 @@ def event_count(row):
         LOG.warning("unhandled exception parsing download event, ignoring row: %s" % exc, extra={'row': row})
 
 def event_counts(row_list):
-    "parses the list of rows returned by google to extract the doi and it's count"
+    """parses the iterable of rows returned by google to extract the doi and it's count.
+    rows are consumed one at a time and may be streamed from a cache file."""
     # note: figures downloads (/articles/80082/figures) and mixed case paths (/Articles/800082) are excluded via the GA query.
     # for example, a case where two rows for 80072, one downloads, one figure downloads resulting in:
     #   [(80082, 717), (80082, 2)]
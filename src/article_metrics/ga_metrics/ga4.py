@@ -1,53 +1,79 @@
-from kids.cache import cache
-import time, random
-import googleapiclient, oauth2client
-import googleapiclient.discovery
-import oauth2client.service_account
-import httplib2
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import math, time, random, threading
 import logging
 from django.conf import settings
-from ..utils import ensure
+from ..utils import ensure, concurrent_rate_limiter, paginate
+from . import service
 
 LOG = logging.getLogger(__name__)
 
 # Analytics API:
 # https://developers.google.com/analytics/devguides/reporting/data/v1/rest
 
-@cache
-def ga_service():
-    service_name = 'analyticsdata'
-    service_version = 'v1beta'
-    scope = 'https://www.googleapis.com/auth/analytics.readonly'
-    credentials = oauth2client.service_account.ServiceAccountCredentials.from_json_keyfile_name(settings.GA_SECRETS_LOCATION, scopes=[scope])
-    http = httplib2.Http()
-    credentials.authorize(http) # does this 'put' back into the credentials file??
-    # `cache_discovery=False`:
-    # - https://github.com/googleapis/google-api-python-client/issues/299
-    # - https://github.com/googleapis/google-api-python-client/issues/345
-    service = googleapiclient.discovery.build(service_name, service_version, http=http, cache_discovery=False)
-    return service
+# the number of GA4 queries that may be *started* per-second, shared by all threads.
+# GA4 allows 10 concurrent requests per-property.
+MAX_QUERIES_PER_SECOND = 10
 
-# pylint: disable=E1101
-def _query_ga(query_map, num_attempts=5):
-    """talks to GA, executing the given `query_map`.
-    applies exponential back-off if rate limited or when service is unavailable."""
+# the maximum number of rows GA4 will return per-page is 250k, we use 10k.
+MAX_RESULTS = 10000
 
-    from_date, to_date = query_map['dateRanges'][0]['startDate'], query_map['dateRanges'][0]['endDate']
+# larger pages for queries spanning many days.
+MAX_RESULTS_MULTIDAY = 100000
 
-    ensure(isinstance(from_date, str), 'startDate must be a string: %s' % query_map)
-    ensure(isinstance(to_date, str), 'endDate must be a string')
+# the maximum number of reports GA4 will accept in a single `batchRunReports` request.
+MAX_BATCH_SIZE = 5
 
-    property_id = 'properties/' + settings.GA4_TABLE_ID
-    query = ga_service().properties().runReport(property=property_id, body=query_map)
+# upper limit on the number of further pages of a single query fetched concurrently.
+MAX_PAGE_WORKERS = MAX_QUERIES_PER_SECOND
 
-    # execute it
+# per-thread state, released when the thread finishes.
+_local = threading.local()
+
+def ga_service():
+    """returns a GA4 service object for the current thread.
+    the `httplib2.Http` object used by the service is not safe to share between threads."""
+    if getattr(_local, 'service', None) is None:
+        _local.service = service.build('analyticsdata', 'v1beta')
+    return _local.service
+
+# queries are executed from the workers of `core.metrics_for_range` and from the page workers of each of those,
+# this limits the number of queries in flight across all threads to what GA4 allows.
+_in_flight = threading.BoundedSemaphore(MAX_QUERIES_PER_SECOND)
+
+@concurrent_rate_limiter(MAX_QUERIES_PER_SECOND)
+def execute(query):
+    """executes the given `query` object once a slot is available.
+    GA3 and GA4 queries share the same budget of queries started per-second and queries in flight."""
+    with _in_flight:
+        return query.execute()
+
+def backoff_seconds(n, status_code):
+    """returns the number of seconds to wait before attempt `n+1` of a query that failed with `status_code`.
+    returns `None` if the error can't be recovered from by retrying.
+    shared with the `ga4_async` client."""
+    if status_code not in [403, 429, 503]:
+        return None
+    # apply exponential backoff.
+    ms_dither = random.randint(0, 1000) / 1000
+    seconds = (2 ** n) # 2**0 => 1, 2**1 => 2, 2**2 => 4, 2**3 => 8
+    if status_code == 503:
+        # service unavailable, wait even longer
+        seconds = seconds * 2
+    return seconds + ms_dither # 8.607
+
+def _execute_with_backoff(query, num_attempts=5):
+    """executes the given `query` object.
+    applies exponential back-off if rate limited or when service is unavailable."""
+    import googleapiclient.errors
+    import oauth2client.client
     for n in range(0, num_attempts):
         try:
             if n > 1:
                 LOG.info("query attempt %r" % (n + 1))
             else:
                 LOG.info("querying ...")
-            return query.execute()
+            return execute(query)
 
         except TypeError as error:
             # Handle errors in constructing a query.
@@ -58,29 +84,17 @@ def _query_ga(query_map, num_attempts=5):
             LOG.debug("HttpError ... can we recover?")
 
             status_code = e.resp.status
-
-            if status_code == 403:
-                # apply exponential backoff.
-                ms_dither = random.randint(0, 1000) / 1000
-                seconds = (2 ** n) # 2**0 => 1, 2**1 => 2, 2**2 => 4, 2**3 => 8
-                backoff = seconds + ms_dither # 8.607
-                LOG.info("403 rate limited. backoff is %ss", backoff)
-                time.sleep(backoff)
+            backoff = backoff_seconds(n, status_code)
+            if backoff is None:
+                # some other sort of HttpError, re-raise
+                LOG.exception("unhandled exception querying GA")
+                raise
 
             if status_code == 503:
-                # apply exponential backoff.
-                ms_dither = random.randint(0, 1000) / 1000
-                seconds = (2 ** n)
-                # wait even longer
-                seconds = seconds * 2
-                backoff = seconds + ms_dither
                 LOG.warning("503 service unavailable. backoff is %ss", backoff)
-                time.sleep(backoff)
-
             else:
-                # some other sort of HttpError, re-raise
-                LOG.exception("unhandled exception querying GA")
-                raise
+                LOG.info("%s rate limited. backoff is %ss", status_code, backoff)
+            time.sleep(backoff)
 
         except oauth2client.client.AccessTokenRefreshError:
             # Handle Auth errors.
@@ -89,26 +103,99 @@ def _query_ga(query_map, num_attempts=5):
 
     raise AssertionError("Failed to execute query after %s attempts" % num_attempts)
 
-def query_ga(query, **kwargs):
-    """performs given `query` and fetches any further pages.
-    results are concatenated and returned as part of the last response dict as `rows`."""
+def _validate_query_map(query_map):
+    from_date, to_date = query_map['dateRanges'][0]['startDate'], query_map['dateRanges'][0]['endDate']
+    ensure(isinstance(from_date, str), 'startDate must be a string: %s' % query_map)
+    ensure(isinstance(to_date, str), 'endDate must be a string')
 
-    results_pp = query['limit'] = 10000 # 100k max
-    query['offset'] = 0
+# pylint: disable=E1101
+def _query_ga(query_map, num_attempts=5):
+    """talks to GA, executing the given `query_map`.
+    applies exponential back-off if rate limited or when service is unavailable."""
+    _validate_query_map(query_map)
+    property_id = 'properties/' + settings.GA4_TABLE_ID
+    query = ga_service().properties().runReport(property=property_id, body=query_map)
+    return _execute_with_backoff(query, num_attempts)
 
-    page, results = 1, []
-    while True:
-        LOG.info("requesting page %s for query %s" % (page, query))  # ['filters']))
-        response = _query_ga(query, **kwargs)
+def _batch_query_ga(query_map_list, num_attempts=5):
+    """talks to GA, executing all of the queries in `query_map_list` in a single request.
+    applies exponential back-off if rate limited or when service is unavailable."""
+    ensure(0 < len(query_map_list) <= MAX_BATCH_SIZE, "a batch must contain between 1 and %s queries" % MAX_BATCH_SIZE)
+    for query_map in query_map_list:
+        _validate_query_map(query_map)
+    property_id = 'properties/' + settings.GA4_TABLE_ID
+    query = ga_service().properties().batchRunReports(property=property_id, body={'requests': query_map_list})
+    return _execute_with_backoff(query, num_attempts)
+
+def _query_ga_page(query, offset, **kwargs):
+    "fetches the page of results for `query` starting at `offset`. `query` is not modified."
+    page_query = dict(query, offset=offset)
+    LOG.info("requesting page %s for query %s" % (offset // int(query['limit']) + 1, page_query))
+    return _query_ga(page_query, **kwargs)
+
+def remaining_offsets(query, response):
+    "returns the offsets of any further pages of results for `query`, given the first page of results in `response`."
+    if not response.get('rows'):
+        return []
+    results_pp = int(query['limit'])
+    num_pages = math.ceil(response['rowCount'] / results_pp)
+    return [results_pp * page for page in range(1, num_pages)] # 10000, 20000, 30000, etc
+
+def concat_pages(response, response_list):
+    """concatenates the rows of the first page of results in `response` with the rows of each further page in `response_list`.
+    stops at the first empty page. returns the last response given but with all of the results as `rows`."""
+    page, results = 1, list(response.get('rows') or [])
+    for page_response in response_list:
+        page += 1
+        response = page_response
         if not response.get('rows'):
             break # empty response
         results.extend(response['rows'])
-        if (results_pp * page) >= response['rowCount']:
-            break # no more pages to fetch
-        query['offset'] += results_pp # 0, 1000, 2000, 3000, etc
-        page += 1
 
-    # use the last response given but with all of the results
     response['rows'] = results
     response['-total-pages'] = page
     return response
+
+def _query_ga_remaining_pages(query, response, page_workers=None, **kwargs):
+    """given the first page of results for `query` in `response`, fetches any further pages.
+    the number of pages is known from the `rowCount` of the first page, so further pages are fetched
+    concurrently by up to `page_workers` threads (default `settings.GA_PAGE_WORKERS`).
+    results are concatenated in offset order and returned as part of the last response dict as `rows`."""
+    page_workers = settings.GA_PAGE_WORKERS if page_workers is None else page_workers
+    ensure(isinstance(page_workers, int) and 1 <= page_workers <= MAX_PAGE_WORKERS,
+           "`page_workers` must be an integer between 1 and %s" % MAX_PAGE_WORKERS)
+    offset_list = remaining_offsets(query, response)
+    fetch = partial(_query_ga_page, query, **kwargs)
+    if page_workers == 1 or len(offset_list) < 2:
+        # lazily, one page at a time
+        response_list = map(fetch, offset_list)
+    else:
+        with ThreadPoolExecutor(max_workers=min(page_workers, len(offset_list))) as executor:
+            response_list = list(executor.map(fetch, offset_list))
+    return concat_pages(response, response_list)
+
+def query_ga(query, results_pp=MAX_RESULTS, page_workers=None, **kwargs):
+    """performs given `query` and fetches any further pages of `results_pp` rows, up to `page_workers` at a time.
+    results are concatenated and returned as part of the last response dict as `rows`."""
+    query['limit'] = results_pp
+    query['offset'] = 0
+    LOG.info("requesting page 1 for query %s" % (query,))
+    response = _query_ga(query, **kwargs)
+    return _query_ga_remaining_pages(query, response, page_workers, **kwargs)
+
+def batch_query_ga(query_list, results_pp=MAX_RESULTS, page_workers=None, **kwargs):
+    """like `query_ga` but performs each query in `query_list` using as few requests as possible.
+    the first page of up to `MAX_BATCH_SIZE` queries are fetched in a single request, any further pages are fetched individually.
+    returns a list of responses in the same order as `query_list`."""
+    response_list = []
+    for batch in paginate(query_list, MAX_BATCH_SIZE):
+        for query in batch:
+            query['limit'] = results_pp
+            query['offset'] = 0
+        LOG.info("requesting page 1 for a batch of %s queries" % len(batch))
+        batch_response = _batch_query_ga(batch, **kwargs)
+        report_list = batch_response.get('reports') or []
+        ensure(len(report_list) == len(batch), "expected %s reports in batch response, got %s" % (len(batch), len(report_list)))
+        for query, response in zip(batch, report_list):
+            response_list.append(_query_ga_remaining_pages(query, response, page_workers, **kwargs))
+    return response_list
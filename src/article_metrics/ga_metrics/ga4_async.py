@@ -0,0 +1,177 @@
+"""an asyncio client for the GA4 Data API.
+
+talks to the `runReport` endpoint directly over HTTP using `asyncio` streams rather than through the
+blocking `googleapiclient` service in `ga4.py`, whose `httplib2.Http` object can't be shared between threads.
+many independent queries, and the pages of each query, can be in-flight at once in a single thread.
+
+    response_list = ga4_async.run_queries([query_map, query_map, ...])
+
+responses look like those returned by `ga4.query_ga`.
+enabled for article metrics with the `ga4-async` setting, see `core.metrics_for_range`."""
+
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit
+import asyncio, json, threading, time
+from django.conf import settings
+from article_metrics.utils import ensure
+from . import ga4, service
+import logging
+
+LOG = logging.getLogger(__name__)
+
+# https://developers.google.com/analytics/devguides/reporting/data/v1/rest/v1beta/properties/runReport
+API_URL = "https://analyticsdata.googleapis.com/v1beta"
+
+# upper limit on the number of requests in-flight at once.
+# GA4 allows 10 concurrent requests per-property.
+MAX_CONCURRENT = ga4.MAX_QUERIES_PER_SECOND
+
+# upper limit on the number of requests started a second, same as the blocking client.
+MAX_PER_SECOND = ga4.MAX_QUERIES_PER_SECOND
+
+# seconds to wait for a connection or a response.
+TIMEOUT = 120
+
+class GAHTTPError(Exception):
+    "GA responded with an unexpected HTTP status code."
+
+    def __init__(self, status, body):
+        self.status = status
+        self.body = body
+        super().__init__("GA responded with HTTP %s: %s" % (status, body[:1000]))
+
+# --- http
+
+async def _read_chunked(reader):
+    "reads a body sent using 'chunked' transfer encoding."
+    chunk_list = []
+    while True:
+        size = int((await reader.readline()).split(b';', 1)[0].strip(), 16)
+        if size == 0:
+            # discard any trailers
+            while (await reader.readline()).strip():
+                pass
+            return b"".join(chunk_list)
+        chunk_list.append(await reader.readexactly(size))
+        await reader.readexactly(2) # \r\n
+
+async def _read_response(reader):
+    "reads a HTTP/1.1 response, returning a triple of `(status, headers, body)`."
+    status_line = await reader.readline() # b"HTTP/1.1 200 OK\r\n"
+    ensure(status_line.startswith(b"HTTP/"), "unexpected HTTP status line: %r" % status_line)
+    status = int(status_line.split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if not line.strip():
+            break
+        key, _, val = line.decode('latin-1').partition(':')
+        headers[key.strip().lower()] = val.strip()
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        body = await _read_chunked(reader)
+    elif 'content-length' in headers:
+        body = await reader.readexactly(int(headers['content-length']))
+    else:
+        body = await reader.read()
+    return status, headers, body
+
+async def http_post(url, body, headers=None, timeout=TIMEOUT):
+    """POSTs the `body` bytes to the given `url`, returning a triple of `(status, headers, body)`.
+    a connection is opened for each request."""
+    parts = urlsplit(url)
+    https = parts.scheme == 'https'
+    port = parts.port or (443 if https else 80)
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(parts.hostname, port, ssl=https or None), timeout)
+    try:
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        header_list = [
+            "POST %s HTTP/1.1" % path,
+            "Host: %s" % parts.netloc,
+            "User-Agent: %s" % settings.USER_AGENT,
+            "Content-Type: application/json",
+            "Content-Length: %s" % len(body),
+            "Connection: close",
+        ] + ["%s: %s" % pair for pair in (headers or {}).items()]
+        writer.write(("\r\n".join(header_list) + "\r\n\r\n").encode('latin-1') + body)
+        await writer.drain()
+        return await asyncio.wait_for(_read_response(reader), timeout)
+    finally:
+        writer.close()
+
+# --- auth
+
+_token_lock = threading.Lock()
+
+def _access_token():
+    "returns an access token, refreshing it if it has expired. blocks while refreshing."
+    with _token_lock:
+        return service.credentials().get_access_token().access_token
+
+async def access_token():
+    return await asyncio.get_running_loop().run_in_executor(None, _access_token)
+
+# --- GA
+
+def throttle(max_concurrent=MAX_CONCURRENT, max_per_second=MAX_PER_SECOND):
+    """returns an async context manager that waits until there are fewer than `max_concurrent` requests in-flight
+    and no more than `max_per_second` requests have been started in the last second.
+    like `ga4.execute`, but for coroutines in a single thread."""
+    ensure(isinstance(max_concurrent, int) and max_concurrent > 0, "`max_concurrent` must be a positive integer")
+    ensure(max_per_second > 0, "`max_per_second` must be a positive number")
+    semaphore = asyncio.Semaphore(max_concurrent)
+    min_interval = 1.0 / max_per_second
+    next_slot = time.perf_counter()
+
+    @asynccontextmanager
+    async def request_slot():
+        nonlocal next_slot
+        async with semaphore:
+            now = time.perf_counter()
+            slot = max(now, next_slot)
+            next_slot = slot + min_interval
+            if slot > now:
+                await asyncio.sleep(slot - now)
+            yield
+
+    return request_slot
+
+async def run_report(query_map, request_slot, api_url=API_URL, num_attempts=5):
+    """talks to GA, executing the given `query_map`, once a `request_slot` is available.
+    applies the same exponential back-off as `ga4` if rate limited or when service is unavailable."""
+    ga4._validate_query_map(query_map)
+    url = "%s/properties/%s:runReport" % (api_url, settings.GA4_TABLE_ID)
+    body = json.dumps(query_map).encode('utf-8')
+    for n in range(0, num_attempts):
+        async with request_slot():
+            token = await access_token()
+            status, _, response = await http_post(url, body, {'Authorization': 'Bearer %s' % token})
+        if status == 200:
+            return json.loads(response)
+        backoff = ga4.backoff_seconds(n, status)
+        if backoff is None:
+            raise GAHTTPError(status, response.decode('utf-8', 'replace'))
+        LOG.warning("%s from GA, backoff is %ss", status, backoff)
+        await asyncio.sleep(backoff)
+    raise AssertionError("Failed to execute query after %s attempts" % num_attempts)
+
+async def query_ga(query_map, request_slot, results_pp=ga4.MAX_RESULTS, **kwargs):
+    """like `ga4.query_ga`. performs given `query_map` and fetches any further pages of `results_pp` rows concurrently.
+    results are concatenated and returned as part of the last response dict as `rows`."""
+    query_map['limit'] = results_pp
+    query_map['offset'] = 0
+    response = await run_report(query_map, request_slot, **kwargs)
+    offset_list = ga4.remaining_offsets(query_map, response)
+    response_list = await asyncio.gather(*[run_report(dict(query_map, offset=offset), request_slot, **kwargs) for offset in offset_list])
+    return ga4.concat_pages(response, response_list)
+
+async def query_ga_many(query_list, max_concurrent=MAX_CONCURRENT, max_per_second=MAX_PER_SECOND, **kwargs):
+    """performs each query in `query_list` with no more than `max_concurrent` requests in-flight at once,
+    starting no more than `max_per_second` requests a second.
+    returns a list of responses in the same order as `query_list`."""
+    request_slot = throttle(max_concurrent, max_per_second)
+    return await asyncio.gather(*[query_ga(query_map, request_slot, **kwargs) for query_map in query_list])
+
+def run_queries(query_list, **kwargs):
+    "like `query_ga_many`, but blocks until all of the queries in `query_list` have been performed."
+    LOG.info("performing %s queries", len(query_list))
+    return asyncio.run(query_ga_many(query_list, **kwargs))
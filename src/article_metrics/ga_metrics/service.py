@@ -0,0 +1,55 @@
+"""builds Google API service objects for GA from the discovery documents bundled in `./discovery/`.
+
+building from a bundled document avoids a request for the discovery document on the first query of every process.
+`googleapiclient`, `oauth2client` and `httplib2` are slow to import and only needed when GA is queried,
+so they are imported here, when a service is first built, and not when a module is loaded.
+
+the bundled documents only describe the methods we use. refresh them with `./download-discovery-docs.sh`."""
+
+from os.path import join, dirname, exists
+import json
+from kids.cache import cache
+from django.conf import settings
+import logging
+
+LOG = logging.getLogger(__name__)
+
+DISCOVERY_DIR = join(dirname(__file__), 'discovery')
+
+SCOPE = 'https://www.googleapis.com/auth/analytics.readonly'
+
+@cache
+def credentials():
+    "returns the GA service account credentials, loaded once per-process. safe to share between threads."
+    from oauth2client.service_account import ServiceAccountCredentials
+    return ServiceAccountCredentials.from_json_keyfile_name(settings.GA_SECRETS_LOCATION, scopes=[SCOPE])
+
+def discovery_document_path(service_name, version):
+    return join(DISCOVERY_DIR, '%s-%s.json' % (service_name, version))
+
+@cache
+def discovery_document(service_name, version):
+    "returns the bundled discovery document for the given service as a string or `None` if there isn't one."
+    path = discovery_document_path(service_name, version)
+    if not exists(path):
+        return None
+    with open(path, 'r') as fh:
+        # parsed to fail early on a bad document
+        return json.dumps(json.load(fh))
+
+def build(service_name, version, http=None):
+    """returns a service object for the given GA service and version.
+    each service gets it's own authorised `httplib2.Http` object unless one is given.
+    `httplib2.Http` objects are not safe to share between threads."""
+    import httplib2
+    import googleapiclient.discovery
+    if http is None:
+        http = credentials().authorize(httplib2.Http())
+    document = discovery_document(service_name, version)
+    if document is None:
+        LOG.warning("no bundled discovery document for %s %s, fetching it", service_name, version)
+        # `cache_discovery=False`:
+        # - https://github.com/googleapis/google-api-python-client/issues/299
+        # - https://github.com/googleapis/google-api-python-client/issues/345
+        return googleapiclient.discovery.build(service_name, version, http=http, cache_discovery=False)
+    return googleapiclient.discovery.build_from_document(document, http=http)
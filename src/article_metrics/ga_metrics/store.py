@@ -0,0 +1,301 @@
+"""a single-file, indexed store for GA responses.
+
+an alternative to writing one cache file per-results type, per-date range.
+responses are keyed by `(results_type, from_date, to_date)` and stored compressed.
+see `settings.GA_CACHE_BACKEND` and `core.load_cache`.
+
+the results of parsing a response may also be stored, keyed by the version of the parser used.
+see `settings.GA_PARSED_CACHE` and `core.load_parsed_cache`.
+
+the store also keeps a manifest of the results that have been cached, in the store or as files,
+so the date ranges missing from the cache can be found without checking each one.
+see `settings.GA_CACHE_MANIFEST` and `core.cache_gaps`.
+
+results for date ranges that can't be cached yet may be kept provisionally, along with when they were fetched.
+provisional results are flagged as finalised once the permanent cache has results for the same key.
+see `settings.GA_PROVISIONAL_TTL` and `core.load_provisional`."""
+
+from os.path import join
+import os, json, sqlite3, threading, zlib
+from contextlib import contextmanager
+from django.conf import settings
+from .utils import ymd
+from article_metrics.utils import ensure, paginate, todt_notz, ymdhms
+import logging
+
+LOG = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    results_type TEXT NOT NULL,
+    from_date TEXT NOT NULL,
+    to_date TEXT NOT NULL,
+    response BLOB NOT NULL,
+    PRIMARY KEY (results_type, from_date, to_date)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS parsed (
+    results_type TEXT NOT NULL,
+    from_date TEXT NOT NULL,
+    to_date TEXT NOT NULL,
+    parser TEXT NOT NULL,
+    response BLOB NOT NULL,
+    PRIMARY KEY (results_type, from_date, to_date)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS manifest (
+    results_type TEXT NOT NULL,
+    from_date TEXT NOT NULL,
+    to_date TEXT NOT NULL,
+    PRIMARY KEY (results_type, from_date, to_date)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS provisional (
+    results_type TEXT NOT NULL,
+    from_date TEXT NOT NULL,
+    to_date TEXT NOT NULL,
+    fetched TEXT NOT NULL,
+    finalised INTEGER NOT NULL DEFAULT 0,
+    response BLOB NOT NULL,
+    PRIMARY KEY (results_type, from_date, to_date)
+) WITHOUT ROWID;
+"""
+
+_local = threading.local()
+
+def db_path():
+    "returns the path to the store."
+    return join(settings.GA_OUTPUT_SUBDIR, 'cache.sqlite3')
+
+# seconds a connection waits for another to release a lock on the store before failing.
+BUSY_TIMEOUT = 30
+
+# every open connection and the thread that opened it, see `close_connections`.
+_connection_list = []
+_connection_lock = threading.Lock()
+
+def _conn(path):
+    # `timeout` is sqlite's `busy_timeout`.
+    # connections are only used by the thread that opened them, but may be closed by another once that thread has finished.
+    connection = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+    # readers don't block the writer and the writer doesn't block readers.
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.executescript(SCHEMA)
+    return connection
+
+def conn():
+    """returns a connection to the store for the current thread.
+    sqlite connections can't be shared between threads."""
+    path = db_path()
+    connection_map = getattr(_local, 'connections', None)
+    if connection_map is None:
+        connection_map = _local.connections = {}
+    if path not in connection_map:
+        connection_map[path] = _conn(path)
+        with _connection_lock:
+            _connection_list.append((threading.current_thread(), connection_map[path]))
+    return connection_map[path]
+
+def close_connections():
+    """closes the connections opened by threads that have since finished, like the workers of a thread pool that has shut down.
+    returns the number of connections closed."""
+    with _connection_lock:
+        finished = [connection for thread, connection in _connection_list if not thread.is_alive()]
+        _connection_list[:] = [(thread, connection) for thread, connection in _connection_list if thread.is_alive()]
+    for connection in finished:
+        connection.close()
+    return len(finished)
+
+def encode(results):
+    return zlib.compress(json.dumps(results, separators=(',', ':'), sort_keys=True).encode('utf-8'))
+
+def decode(blob):
+    return json.loads(zlib.decompress(blob).decode('utf-8'))
+
+def _key(results_type, from_date, to_date):
+    return (results_type, ymd(from_date), ymd(to_date))
+
+#
+
+def put(results_type, from_date, to_date, results):
+    "stores the given `results`, replacing any existing results for the same key."
+    LOG.debug("storing %s %s", results_type, _key(results_type, from_date, to_date))
+    with conn() as c:
+        c.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                  _key(results_type, from_date, to_date) + (encode(results),))
+        c.execute("INSERT OR IGNORE INTO manifest VALUES (?, ?, ?)", _key(results_type, from_date, to_date))
+
+def _get_blob(key):
+    blob_map = getattr(_local, 'preloaded', None)
+    if blob_map is not None and ('results',) + key in blob_map:
+        return blob_map[('results',) + key]
+    row = conn().execute("SELECT response FROM results WHERE results_type = ? AND from_date = ? AND to_date = ?", key).fetchone()
+    return row and row[0]
+
+def get(results_type, from_date, to_date):
+    "returns the stored results for the given key or `None` if not found."
+    blob = _get_blob(_key(results_type, from_date, to_date))
+    return decode(blob) if blob else None
+
+def exists(results_type, from_date, to_date):
+    "returns `True` if results are stored for the given key."
+    return bool(_get_blob(_key(results_type, from_date, to_date)))
+
+def _range_blobs(results_type_list, from_date, to_date, table='results'):
+    ensure(results_type_list, "at least one results type is required")
+    ensure(table in ['results', 'parsed'], "unknown table %r" % table)
+    response = "response" if table == 'results' else "parser, response"
+    sql = "SELECT results_type, from_date, to_date, %s FROM %s " \
+        "WHERE results_type IN (%s) AND from_date >= ? AND to_date <= ? " \
+        "ORDER BY results_type, from_date, to_date" % (response, table, ", ".join("?" * len(results_type_list)))
+    params = list(results_type_list) + [ymd(from_date), ymd(to_date)]
+    for row in conn().execute(sql, params):
+        key, val = tuple(row[:3]), tuple(row[3:])
+        if table == 'results':
+            val = val[0]
+        yield key, val
+
+def get_range(results_type, from_date, to_date):
+    """returns all stored results of the given `results_type` that fall within the given date range, in a single pass.
+    returns a map of `{(from-date, to-date): results}`."""
+    return {(key[1], key[2]): decode(blob) for key, blob in _range_blobs([results_type], from_date, to_date)}
+
+# older versions of sqlite allow at most 999 parameters per-statement, three per key.
+MAX_KEYS_PER_QUERY = 333
+
+def _key_blobs(key_list, table='results'):
+    ensure(table in ['results', 'parsed'], "unknown table %r" % table)
+    response = "t.response" if table == 'results' else "t.parser, t.response"
+    for chunk in paginate(key_list, MAX_KEYS_PER_QUERY):
+        # joining on the wanted keys looks each one up by primary key rather than scanning the table
+        sql = "SELECT t.results_type, t.from_date, t.to_date, %s FROM (VALUES %s) AS wanted JOIN %s AS t " \
+            "ON t.results_type = wanted.column1 AND t.from_date = wanted.column2 AND t.to_date = wanted.column3" \
+            % (response, ", ".join(["(?, ?, ?)"] * len(chunk)), table)
+        params = [val for key in chunk for val in key]
+        for row in conn().execute(sql, params):
+            key, val = tuple(row[:3]), tuple(row[3:])
+            if table == 'results':
+                val = val[0]
+            yield key, val
+
+@contextmanager
+def preloaded(key_list):
+    """reads all stored results, raw and parsed, for each `(results_type, from_date, to_date)` in `key_list` in a single pass.
+    within the context, `get`, `exists` and `get_parsed` are served from memory for the current thread.
+    results are held compressed and only decoded when fetched."""
+    key_list = [_key(*key) for key in key_list]
+    blob_map = {}
+    for table in ['results', 'parsed']:
+        for key, val in _key_blobs(key_list, table):
+            blob_map[(table,) + key] = val
+    _local.preloaded = blob_map
+    try:
+        yield
+    finally:
+        _local.preloaded = None
+
+#
+
+def put_parsed(results_type, from_date, to_date, parser, results):
+    """stores the parsed `results` of a response, along with the `parser` that produced them.
+    replaces any existing parsed results for the same key, regardless of parser."""
+    with conn() as c:
+        c.execute("INSERT OR REPLACE INTO parsed VALUES (?, ?, ?, ?, ?)",
+                  _key(results_type, from_date, to_date) + (parser, encode(results)))
+
+def get_parsed(results_type, from_date, to_date, parser):
+    """returns the stored parsed results for the given key or `None` if not found.
+    parsed results produced by a different `parser` are treated as not found."""
+    key = _key(results_type, from_date, to_date)
+    blob_map = getattr(_local, 'preloaded', None)
+    if blob_map is not None and ('parsed',) + key in blob_map:
+        row = blob_map[('parsed',) + key]
+    else:
+        row = conn().execute("SELECT parser, response FROM parsed WHERE results_type = ? AND from_date = ? AND to_date = ?", key).fetchone()
+    if row and row[0] == parser:
+        return decode(row[1])
+    return None
+
+#
+
+def record(results_type, from_date, to_date):
+    "adds the given key to the manifest of cached results."
+    with conn() as c:
+        c.execute("INSERT OR IGNORE INTO manifest VALUES (?, ?, ?)", _key(results_type, from_date, to_date))
+
+def coverage(results_type_list, from_date, to_date):
+    """returns the set of `(results_type, from-date, to-date)` keys in the manifest of cached results
+    for the given types that fall within the given date range, in a single pass."""
+    ensure(results_type_list, "at least one results type is required")
+    sql = "SELECT results_type, from_date, to_date FROM manifest " \
+        "WHERE results_type IN (%s) AND from_date >= ? AND to_date <= ?" % ", ".join("?" * len(results_type_list))
+    params = list(results_type_list) + [ymd(from_date), ymd(to_date)]
+    return set(tuple(row) for row in conn().execute(sql, params))
+
+#
+
+def put_provisional(results_type, from_date, to_date, results, fetched):
+    """stores the given `results` provisionally, replacing any existing provisional results for the same key.
+    `fetched` is the datetime the results were fetched."""
+    with conn() as c:
+        c.execute("INSERT OR REPLACE INTO provisional VALUES (?, ?, ?, ?, 0, ?)",
+                  _key(results_type, from_date, to_date) + (ymdhms(fetched), encode(results)))
+
+def purge_provisional(fetched_before):
+    "removes provisional results that have been finalised or were fetched before the datetime `fetched_before`."
+    with conn() as c:
+        c.execute("DELETE FROM provisional WHERE finalised = 1 OR fetched < ?", (ymdhms(fetched_before),))
+
+def get_provisional(results_type, from_date, to_date, fetched_since):
+    """returns the provisional results for the given key or `None` if not found.
+    provisional results fetched before the datetime `fetched_since` or that have been finalised are treated as not found."""
+    row = conn().execute("SELECT response FROM provisional WHERE results_type = ? AND from_date = ? AND to_date = ? "
+                         "AND finalised = 0 AND fetched >= ?", _key(results_type, from_date, to_date) + (ymdhms(fetched_since),)).fetchone()
+    return decode(row[0]) if row else None
+
+def finalise(results_type, from_date, to_date):
+    "flags any provisional results for the given key as finalised, they are no longer returned and will be removed."
+    with conn() as c:
+        c.execute("UPDATE provisional SET finalised = 1 WHERE results_type = ? AND from_date = ? AND to_date = ?",
+                  _key(results_type, from_date, to_date))
+
+#
+
+def _parse_cache_fname(fname):
+    "returns a pair of `(from-date, to-date)` datetimes from a cache file name like '2001-01-01.json' or '2001-01-01_2001-01-31.json.gz'."
+    dt_str = fname.split('.', 1)[0]
+    bits = dt_str.split('_')
+    return todt_notz(bits[0]), todt_notz(bits[-1])
+
+def _cache_files(root, results_type_list):
+    "yields a tuple of `(results_type, from-date, to-date, path)` for each cache file beneath `root`."
+    from . import core # circular dependency
+    for results_type in results_type_list:
+        path = join(root, results_type)
+        if not os.path.isdir(path):
+            continue
+        for fname in sorted(os.listdir(path)):
+            if fname.endswith('.json') or fname.endswith('.json' + core.COMPRESSED_EXT):
+                from_date, to_date = _parse_cache_fname(fname)
+                yield results_type, from_date, to_date, join(path, fname)
+
+def import_files(root, results_type_list):
+    """imports the cache files beneath `root` for each of the given `results_type_list` into the store.
+    returns the number of files imported."""
+    from . import core # circular dependency
+    num = 0
+    for results_type, from_date, to_date, path in _cache_files(root, results_type_list):
+        put(results_type, from_date, to_date, core.read_results(path))
+        num += 1
+    return num
+
+def rebuild_manifest(root, results_type_list):
+    """replaces the manifest with the results in the store and the cache files beneath `root`
+    for each of the given `results_type_list`. cache files are not read.
+    returns the number of entries in the manifest."""
+    with conn() as c:
+        c.execute("DELETE FROM manifest")
+        c.execute("INSERT INTO manifest SELECT results_type, from_date, to_date FROM results")
+        for results_type, from_date, to_date, _ in _cache_files(root, results_type_list):
+            c.execute("INSERT OR IGNORE INTO manifest VALUES (?, ?, ?)", _key(results_type, from_date, to_date))
+        return c.execute("SELECT COUNT(*) FROM manifest").fetchone()[0]
@@ -1,9 +1,10 @@
-from functools import partial
-from datetime import timedelta
-from . import ga_metrics, models, utils, events
+from datetime import datetime, timedelta
+import os, itertools
+from . import ga_metrics, models, utils, events, bulkload_metrics, resolver
 from django.conf import settings
-from django.db import transaction
-from .utils import first, create_or_update, ensure, splitfilter, comp, run, lfilter, datetime_now
+from django.db import transaction, connection
+from django.utils import timezone
+from .utils import first, create_or_update, ensure, splitfilter, run, lfilter, datetime_now
 import logging
 
 LOG = logging.getLogger(__name__)
@@ -58,7 +59,14 @@ def recently_updated_article_notifications(**kwargs):
 #
 
 def get_create_article(data):
-    "single point for accessing/creating Articles. returns None on bad data"
+    """single point for accessing/creating Articles. returns None on bad data.
+    during a `resolver.ingestion` articles fetched by doi alone are resolved without a query,
+    the returned article has just it's `id` and `doi`."""
+    if resolver.ingesting() and list(data.keys()) == ['doi']:
+        article_id = resolver.article_id(data['doi'])
+        if article_id:
+            return models.Article(id=article_id, doi=resolver.norm_doi(data['doi']))
+        return None
     try:
         if 'doi' in data:
             msid = utils.doi2msid(data['doi'], allow_subresource=False)
@@ -85,10 +93,55 @@ def insert_row(data):
     DO NOT USE when inserting many objects. Use `insert_many_rows` or your performance will suffer greatly."""
     return _insert_row(data)
 
+METRIC_KEY = ['article_id', 'date', 'period', 'source']
+METRIC_VALUES = ['full', 'abstract', 'digest', 'pdf']
+UPSERT_METRICS_SQL = open(os.path.join(settings.SQL_PATH, 'metrics-upsert.sql'), 'r').read()
+
+def upsert_metrics(row_list):
+    """creates or updates a `models.Metric` for each row in `row_list` using a single query.
+    rows are dicts of `METRIC_KEY` and `METRIC_VALUES` and are not validated.
+    metrics that exist and are unchanged are not updated.
+    returns a list of `(metric_id, created)` pairs for each metric created or updated."""
+    if not row_list:
+        return []
+    params = {key: [row[key] for row in row_list] for key in METRIC_KEY + METRIC_VALUES}
+    params['now'] = timezone.now()
+    with connection.cursor() as cursor:
+        cursor.execute(UPSERT_METRICS_SQL, params)
+        return cursor.fetchall()
+
 @transaction.atomic
 def insert_many_rows(data_list):
-    "inserts all items in given `data_list` using a single transaction."
-    run(_insert_row, data_list)
+    """inserts all items in given `data_list` using a single transaction.
+    metrics are validated together, articles are fetched and created in bulk and metrics are inserted or updated with a single query.
+    returns a map of the number of metrics `created`, `updated` and `unchanged`."""
+    data_list = list(data_list)
+    models.validate_metric_rows(data_list)
+    # metrics without a date can't be matched by the upsert, see `metrics-upsert.sql`
+    dateless_list, data_list = splitfilter(lambda data: data.get('date') is None, data_list)
+    with models.bulk_ingest(models.Metric):
+        run(_insert_row, dateless_list)
+
+    article_id_map = resolver.article_ids(set(data['doi'] for data in data_list))
+    row_map = {}
+    for data in data_list:
+        if data['doi'] not in article_id_map:
+            LOG.warning("refusing to insert bad metric", extra={'row-data': data})
+            continue
+        row = utils.exsubdict(data, ['doi'])
+        row['article_id'] = article_id_map[data['doi']]
+        # a metric may only be upserted once per-query. the last one wins, as if inserted one at a time.
+        row_map[tuple(row[key] for key in METRIC_KEY)] = row
+
+    result_list = upsert_metrics(list(row_map.values()))
+    num_created = len(lfilter(lambda result: result[1], result_list))
+    summary = {
+        'created': num_created,
+        'updated': len(result_list) - num_created,
+        'unchanged': len(row_map) - len(result_list),
+    }
+    LOG.info("%(created)s metrics created, %(updated)s updated and %(unchanged)s unchanged" % summary)
+    return summary
 
 def create_row(doi, period, views, downloads):
     "wrangles the data into a format suitable for `insert_row`"
@@ -104,8 +157,12 @@ def create_row(doi, period, views, downloads):
     row.update(views)
     return row
 
-def import_ga_metrics(metrics_type='daily', from_date=None, to_date=None, use_cached=True, use_only_cached=False):
-    "import metrics from GA between the two given dates or from the inception date in `settings.py`"
+def import_ga_metrics(metrics_type='daily', from_date=None, to_date=None, use_cached=True, use_only_cached=False, workers=1, multiday=False, monthly_from_daily=False, bulk_load=False):
+    """import metrics from GA between the two given dates or from the inception date in `settings.py`.
+    `workers` is the number of date ranges that may be fetched from GA concurrently.
+    `multiday` fetches uncached GA4 daily metrics using a single query spanning many days.
+    `monthly_from_daily` derives monthly downloads from cached daily downloads where possible, monthly views are always queried.
+    `bulk_load` loads the metrics of all periods using `bulkload_metrics`, for full re-imports."""
     ensure(metrics_type in ['daily', 'monthly'], 'metrics type must be either "daily" or "monthly"')
 
     table_id = 'ga:%s' % settings.GA3_TABLE_ID
@@ -119,20 +176,27 @@ def import_ga_metrics(metrics_type='daily', from_date=None, to_date=None, use_ca
         # don't import today's partial results. they're available but lets wait until tomorrow
         to_date = yesterday
 
-    f = {
-        'daily': ga_metrics.core.daily_metrics_between,
-        'monthly': ga_metrics.core.monthly_metrics_between,
-    }
-    results = f[metrics_type](table_id, from_date, to_date, use_cached, use_only_cached)
+    if metrics_type == 'daily':
+        results = ga_metrics.core.daily_metrics_between(table_id, from_date, to_date, use_cached, use_only_cached, workers, multiday)
+    else:
+        results = ga_metrics.core.monthly_metrics_between(table_id, from_date, to_date, use_cached, use_only_cached, workers, monthly_from_daily)
 
-    for period, metrics in results.items():
+    def period_rows(period, metrics):
         views, downloads = metrics['views'], metrics['downloads']
         # there is often a disjoint between articles that have been viewed and those downloaded within a period
         # what we do is create a record for *all* articles seen, even if their views or downloads may not exist
         doi_list = set(views.keys()).union(list(downloads.keys()))
-        row_list = [create_row(doi, period, views.get(doi), downloads.get(doi)) for doi in doi_list]
-        # insert rows in batches of 1000
-        run(insert_many_rows, utils.partition(row_list, 1000))
+        return [create_row(doi, period, views.get(doi), downloads.get(doi)) for doi in doi_list]
+
+    if bulk_load:
+        # rows are generated one period at a time
+        return bulkload_metrics.load(itertools.chain.from_iterable(itertools.starmap(period_rows, results.items())))
+
+    with resolver.ingestion():
+        for period, metrics in results.items():
+            row_list = period_rows(period, metrics)
+            # insert rows in batches of 1000
+            run(insert_many_rows, utils.partition(row_list, 1000))
 
 #
 # citations
@@ -148,26 +212,136 @@ def insert_citation(data, aid='doi'):
     key = utils.subdict(row, ['article', 'source'])
     return create_or_update(models.Citation, row, key, create=True, update=True, update_check=True)
 
-def countable(triple):
-    "if the citation has been created or modified, return the object"
-    if triple:
-        citation, created, updated = triple
-        if created or updated:
-            return citation
+# the number of citations inserted or updated per-query.
+CITATION_CHUNK_SIZE = 1000
+
+UPSERT_CITATIONS_SQL = open(os.path.join(settings.SQL_PATH, 'citation-upsert.sql'), 'r').read()
+
+def upsert_citations(row_list):
+    """creates or updates a `models.Citation` for each row in `row_list` using a single query.
+    rows are dicts of `article_id`, `source`, `num` and `source_id` and are not validated.
+    citations that exist and are unchanged are not updated.
+    returns a list of `(article_id, created)` pairs for each citation created or updated."""
+    if not row_list:
+        return []
+    params = {key: [row[key] for row in row_list] for key in ['article_id', 'source', 'num', 'source_id']}
+    params['now'] = timezone.now()
+    with connection.cursor() as cursor:
+        cursor.execute(UPSERT_CITATIONS_SQL, params)
+        return cursor.fetchall()
+
+def article_ids_by_pmcid(pmcid_list):
+    "returns a map of each known pmcid in `pmcid_list` to the id of it's `models.Article`. articles are not created."
+    return dict(models.Article.objects.filter(pmcid__in=set(pmcid_list)).values_list('pmcid', 'id'))
+
+@transaction.atomic
+def _insert_citation_chunk(data_list, aid):
+    models.validate_citation_rows(data_list)
+    if aid == 'doi':
+        article_id_map = resolver.article_ids(set(data['doi'] for data in data_list))
+    else:
+        ensure(aid == 'pmcid', "unsupported article identifier: %r" % aid)
+        article_id_map = article_ids_by_pmcid(data['pmcid'] for data in data_list)
+
+    row_map = {}
+    for data in data_list:
+        if data[aid] not in article_id_map:
+            LOG.warning("refusing to insert bad citation", extra={'citation-data': data})
+            continue
+        row = utils.subdict(data, ['source', 'num', 'source_id'])
+        row['article_id'] = article_id_map[data[aid]]
+        # a citation may only be upserted once per-query. the last one wins, as if inserted one at a time.
+        row_map[(row['article_id'], row['source'])] = row
+    return len(row_map), upsert_citations(list(row_map.values()))
+
+def insert_citations(data_iter, aid='doi', chunk_size=CITATION_CHUNK_SIZE):
+    """creates or updates a `models.Citation` for each citation in `data_iter`, `chunk_size` citations at a time.
+    citations are dicts like those given to `insert_citation` and may be any iterable, they are consumed one chunk at a time.
+    each chunk is validated, it's articles resolved in bulk and it's citations upserted using a single transaction.
+    citations for unknown pmcids are skipped, articles are only created for dois.
+    returns a map of the number of citations `created`, `updated` and `unchanged` and the ids of the
+    `changed-articles` whose citations were created or updated."""
+    summary = {'created': 0, 'updated': 0, 'unchanged': 0}
+    changed_articles = set()
+    with resolver.ingestion():
+        for data_list in utils.partition(data_iter, chunk_size):
+            num_rows, result_list = _insert_citation_chunk(data_list, aid)
+            num_created = len(lfilter(lambda result: result[1], result_list))
+            summary['created'] += num_created
+            summary['updated'] += len(result_list) - num_created
+            summary['unchanged'] += num_rows - len(result_list)
+            changed_articles.update(article_id for article_id, _ in result_list)
+    summary['changed-articles'] = sorted(changed_articles)
+    LOG.info("%s citations created, %s updated and %s unchanged across %s articles" % (
+        summary['created'], summary['updated'], summary['unchanged'], len(changed_articles)))
+    return summary
 
 def import_scopus_citations():
     from .scopus.citations import all_todays_entries
-    results = all_todays_entries()
-    good_eggs, bad_eggs = splitfilter(lambda e: 'bad' not in e, results)
+    bad_eggs = []
+
+    def good_egg(entry):
+        if 'bad' in entry:
+            bad_eggs.append(entry)
+            return False
+        return True
+
+    summary = insert_citations(filter(good_egg, all_todays_entries()))
     LOG.warning("refusing to insert %s bad entries", len(bad_eggs), extra={'bad-entries': bad_eggs})
-    run(comp(insert_citation, countable), good_eggs)
+    return summary
 
 def import_pmc_citations():
     from .pm.citations import citations_for_all_articles
     results = citations_for_all_articles()
-    run(comp(partial(insert_citation, aid='pmcid'), countable), results)
+    return insert_citations(filter(None, results), aid='pmcid')
 
 def import_crossref_citations():
     from .crossref.citations import citations_for_all_articles
     results = citations_for_all_articles()
-    run(comp(insert_citation, countable), lfilter(None, results))
+    return insert_citations(filter(None, results))
+
+#
+# watermarks
+#
+
+def _todate(dt):
+    return dt.date() if isinstance(dt, datetime) else dt
+
+def get_watermark(source):
+    "returns the last day of the most recent final period imported for `source` or `None` if not known."
+    obj = models.Watermark.objects.filter(source=source).first()
+    return obj.date if obj else None
+
+def set_watermark(source, dt, from_date=None):
+    """records `dt` as the last day of the most recent final period imported for `source`.
+    watermarks never move backwards.
+    if the import started at `from_date`, the watermark is only moved if nothing was skipped between the watermark and `from_date`."""
+    dt = _todate(dt)
+    current = get_watermark(source)
+    if current and current >= dt:
+        return
+    if current and from_date and _todate(from_date) > current + timedelta(days=1):
+        LOG.warning("not moving %r watermark from %s to %s, import started at %s", source, current, dt, _todate(from_date))
+        return
+    create_or_update(models.Watermark, {'source': source, 'date': dt}, ['source'])
+
+def final_date(to_date, monthly=False):
+    """returns the most recent day, on or before `to_date`, whose metrics are final and won't change.
+    when `monthly` is `True`, returns the last day of the most recent month whose metrics are final."""
+    dt = _todate(min(ga_metrics.utils.d2dt(to_date), datetime_now()))
+    while not ga_metrics.core.cacheable(ga_metrics.utils.d2dt(dt)):
+        dt -= timedelta(days=1)
+    if monthly and dt != ga_metrics.utils.month_min_max(dt)[1].date():
+        dt = ga_metrics.utils.month_min_max(dt)[0].date() - timedelta(days=1)
+    return dt
+
+def watermark_from_date(source, default_from_date, monthly=False):
+    """returns the day to import `source` from.
+    this is the day after it's watermark or the first day whose metrics aren't final, whichever is earlier.
+    when `monthly` is `True`, this is the first day of the month whose metrics aren't final.
+    returns `default_from_date` if `source` has no watermark."""
+    current = get_watermark(source)
+    if not current:
+        return _todate(default_from_date)
+    first_non_final = final_date(utils.date_today(), monthly) + timedelta(days=1)
+    return min(current + timedelta(days=1), first_non_final)
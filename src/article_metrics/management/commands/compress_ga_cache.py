@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from article_metrics.ga_metrics import core
+
+import logging
+LOG = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'converts uncompressed GA cache files to compressed GA cache files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', nargs='?', type=str, default=settings.GA_OUTPUT_SUBDIR)
+
+    def handle(self, *args, **options):
+        path_list = core.compress_cache(options['path'])
+        self.stdout.write("compressed %s cache files\n" % len(path_list))
+        self.stdout.flush()
@@ -0,0 +1,38 @@
+from datetime import datetime, timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from article_metrics.ga_metrics import core, store, utils
+from article_metrics.utils import todt_notz
+
+import logging
+LOG = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'reports the days or months of GA results missing from the cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from-date', nargs='?', type=todt_notz, default=core.VIEWS_INCEPTION)
+        parser.add_argument('--to-date', nargs='?', type=todt_notz, default=datetime.now() - timedelta(days=1))
+        parser.add_argument('--period', choices=['daily', 'monthly'], default='daily')
+        # replace the manifest with the cache files beneath `--path` and the results in the sqlite store
+        parser.add_argument('--rebuild', dest='rebuild', action="store_true", default=False)
+        parser.add_argument('--path', nargs='?', type=str, default=settings.GA_OUTPUT_SUBDIR)
+
+    def handle(self, *args, **options):
+        if not (options['rebuild'] or core.manifest_enabled()):
+            raise CommandError("the manifest of cached results is not enabled or maintained. see `GA_CACHE_MANIFEST` or use `--rebuild`.")
+
+        if options['rebuild']:
+            num = store.rebuild_manifest(options['path'], core.KNOWN_RESULTS_TYPES)
+            self.stdout.write("rebuilt manifest with %s entries\n" % num)
+
+        if options['period'] == 'daily':
+            dt_range_list = utils.dt_range(options['from_date'], options['to_date'])
+        else:
+            dt_range_list = utils.dt_month_range(options['from_date'], options['to_date'])
+
+        gap_list = core.cache_gaps(dt_range_list)
+        for results_type, from_date, to_date in gap_list:
+            self.stdout.write("%s %s %s\n" % (results_type, from_date, to_date))
+        self.stdout.write("%s missing\n" % len(gap_list))
+        self.stdout.flush()
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from article_metrics.ga_metrics import core, store
+
+import logging
+LOG = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'imports GA cache files into the sqlite GA cache store'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', nargs='?', type=str, default=settings.GA_OUTPUT_SUBDIR)
+
+    def handle(self, *args, **options):
+        num = store.import_files(options['path'], core.KNOWN_RESULTS_TYPES)
+        self.stdout.write("imported %s cache files into %s\n" % (num, store.db_path()))
+        self.stdout.flush()
@@ -4,6 +4,7 @@ from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
 from django.core.management.base import BaseCommand
 from article_metrics import logic, models
+from article_metrics.ga_metrics.utils import d2dt
 import metrics
 import logging
 
@@ -31,6 +32,10 @@ def timeit(label):
         return wrap2
     return wrap1
 
+# number of days/months imported when a source has no watermark
+DEFAULT_DAYS = 5
+DEFAULT_MONTHS = 2
+
 class Command(BaseCommand):
     help = 'imports all metrics from google analytics'
 
@@ -40,29 +45,59 @@ class Command(BaseCommand):
         # lsh@2023-08-14: changed default from 2 days to 5 days.
         # as results from the last 3 days are no longer cached because of partial results,
         # this will see 2 cache hits and 3 cache misses on days with partial results.
-        parser.add_argument('--days', nargs='?', type=int, default=5)
+        # when not given, days are imported from the day after the last final day imported (the 'watermark'),
+        # plus any days that aren't final yet. non-article metrics are imported the same way.
+        # `DEFAULT_DAYS` are imported if there is no watermark.
+        parser.add_argument('--days', nargs='?', type=int, default=None)
         # import the last two months by default
-        parser.add_argument('--months', nargs='?', type=int, default=2)
+        # when not given, months are imported from the watermark as with `--days`.
+        parser.add_argument('--months', nargs='?', type=int, default=None)
 
         # use cache files if they exist
         parser.add_argument('--cached', dest='cached', action="store_true", default=True)
         # import *only* from cached results, don't try to fetch from remote
         parser.add_argument('--only-cached', dest='only_cached', action="store_true", default=False)
+        # number of uncached days/months to fetch from GA at once
+        parser.add_argument('--workers', nargs='?', type=int, default=1)
+        # fetch uncached days from GA4 using a single query spanning many days
+        parser.add_argument('--multiday', dest='multiday', action="store_true", default=False)
+        # derive monthly downloads from cached daily downloads where every day of the month is cached.
+        # monthly views are always queried, daily sessions can't be summed into monthly sessions.
+        parser.add_argument('--monthly-from-daily', dest='monthly_from_daily', action="store_true", default=False)
+        # load article metrics using a staging table and `COPY` rather than in batches of 1000. for full re-imports.
+        parser.add_argument('--bulk-load', dest='bulk_load', action="store_true", default=False)
 
     @timeit("overall")
     def handle(self, *args, **options):
         today = datetime.now()
-        n_days_ago = today - timedelta(days=options['days'])
-        n_months_ago = today - relativedelta(months=options['months'])
+
+        GA_DAILY, GA_MONTHLY = 'ga-daily', 'ga-monthly'
+        NA_METRICS = 'non-article-metrics'
+
+        if options['days'] is None:
+            default_from_date = today - timedelta(days=DEFAULT_DAYS)
+            n_days_ago = d2dt(logic.watermark_from_date(GA_DAILY, default_from_date))
+            update_non_article_metrics = metrics.logic.update_all_ptypes_since_watermark
+        else:
+            n_days_ago = today - timedelta(days=options['days'])
+            update_non_article_metrics = metrics.logic.update_all_ptypes_latest_frame
+
+        if options['months'] is None:
+            default_from_date = today - relativedelta(months=DEFAULT_MONTHS)
+            n_months_ago = d2dt(logic.watermark_from_date(GA_MONTHLY, default_from_date, monthly=True))
+        else:
+            n_months_ago = today - relativedelta(months=options['months'])
+
         use_cached = options['cached']
         use_only_cached = options['only_cached']
+        workers = options['workers']
+        multiday = options['multiday']
+        monthly_from_daily = options['monthly_from_daily']
+        bulk_load = options['bulk_load']
 
         from_date = n_days_ago
         to_date = today
 
-        GA_DAILY, GA_MONTHLY = 'ga-daily', 'ga-monthly'
-        NA_METRICS = 'non-article-metrics'
-
         # the mapping of sources and how to call them.
         # date ranges and caching arguments don't matter to citations right now
         # caching is feasible, but only crossref supports querying citations by date range
@@ -71,20 +106,38 @@ class Command(BaseCommand):
             # Because the frame boundary extends to 'today' a cache file will not be generated.
             # This is what we want. For now it avoids accumulating files and partial results at the
             # expense of daily queries with larger results (<10MB).
-            (NA_METRICS, (timeit("non-article-metrics")(metrics.logic.update_all_ptypes_latest_frame),)),
-            (GA_DAILY, (timeit("article-metrics-daily")(logic.import_ga_metrics), 'daily', from_date, to_date, use_cached, use_only_cached)),
-            (GA_MONTHLY, (timeit("article-metrics-monthly")(logic.import_ga_metrics), 'monthly', n_months_ago, to_date, use_cached, use_only_cached)),
+            (NA_METRICS, (timeit("non-article-metrics")(update_non_article_metrics),)),
+            (GA_DAILY, (timeit("article-metrics-daily")(logic.import_ga_metrics), 'daily', from_date, to_date, use_cached, use_only_cached, workers, multiday, False, bulk_load)),
+            (GA_MONTHLY, (timeit("article-metrics-monthly")(logic.import_ga_metrics), 'monthly', n_months_ago, to_date, use_cached, use_only_cached, workers, False, monthly_from_daily, bulk_load)),
             (models.CROSSREF, (timeit("crossref-citations")(logic.import_crossref_citations),)),
             (models.SCOPUS, (timeit("scopus-citations")(logic.import_scopus_citations),)),
             (models.PUBMED, (timeit("pmc-citations")(logic.import_pmc_citations),)),
         ])
 
+        # the watermark for each source once it has been successfully imported, and the date it was imported from.
+        # watermarks for non-article metrics are set per-page type.
+        # citations are totals rather than periods, the watermark for a citation source is simply the last day it was imported.
+        watermarks = {
+            GA_DAILY: (logic.final_date(to_date), from_date),
+            GA_MONTHLY: (logic.final_date(to_date, monthly=True), n_months_ago),
+            models.CROSSREF: (today, None),
+            models.SCOPUS: (today, None),
+            models.PUBMED: (today, None),
+        }
+        if use_only_cached:
+            # a missing cache file is an empty result when only importing from the cache.
+            # the GA watermarks are left where they are so the missing periods are fetched from GA next time.
+            del watermarks[GA_DAILY]
+            del watermarks[GA_MONTHLY]
+
         try:
             start_time = time.time() # seconds since epoch
             for source, row in sources.items():
                 try:
                     fn, args = row[0], row[1:]
                     fn(*args)
+                    if source in watermarks:
+                        logic.set_watermark(source, *watermarks[source])
                 except KeyboardInterrupt:
                     print('ctrl-c caught, skipping rest of %s' % source)
                     print('use ctrl-c again to abort immediately')
@@ -0,0 +1,24 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('article_metrics', '0002_alter_article_pmcid'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Watermark',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(help_text="the source of metrics, like 'ga-daily', 'ptype-blog-article' or 'crossref'", max_length=255, unique=True)),
+                ('date', models.DateField(help_text='the last day of the most recent final period imported')),
+                ('datetime_record_created', models.DateTimeField(auto_now_add=True)),
+                ('datetime_record_updated', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'db_table': 'metrics_watermark',
+            },
+        ),
+    ]
@@ -1,15 +1,38 @@
+from contextlib import contextmanager
+import re, threading
 from django.db import models
-from django.db.models import DateTimeField, PositiveIntegerField, ForeignKey, CharField
+from django.db.models import DateTimeField, DateField, PositiveIntegerField, ForeignKey, CharField
 from django.conf import settings
 from django.core.exceptions import ValidationError
 
 from django.dispatch import receiver
 from django.db.models.signals import pre_save
 
+_local = threading.local()
+
+def bulk_ingest_models():
+    "returns the set of models being bulk ingested in the current thread."
+    return getattr(_local, 'models', frozenset())
+
+@contextmanager
+def bulk_ingest(*model_list):
+    """instances of the models in `model_list` are not validated when saved until the context is exited.
+    their rows must be validated in batches instead, see `validate_article_rows`, `validate_metric_rows` and `validate_citation_rows`.
+    bulk ingests are per-thread, saves elsewhere are still validated.
+    rows written with SQL rather than saved never reach `pre_save_handler` and are always validated in batches,
+    like the citations upserted by `logic.insert_citations`."""
+    previous = bulk_ingest_models()
+    _local.models = previous.union(model_list)
+    try:
+        yield
+    finally:
+        _local.models = previous
+
 @receiver(pre_save)
 def pre_save_handler(sender, instance, *args, **kwargs):
-    # validate everything before save.
-    instance.full_clean()
+    # validate everything before save, unless it's rows have been validated in bulk.
+    if sender not in bulk_ingest_models():
+        instance.full_clean()
 
 def validate_doi(val):
     "validates given value is not just any doi, but a known doi"
@@ -19,6 +42,21 @@ def validate_doi(val):
             return
     raise ValidationError('%r has an unknown doi prefix. known prefixes: %r' % (val, known_doi_prefix_list))
 
+def _bad_values(value_list, is_valid):
+    "returns the distinct values in `value_list` that are not valid. each distinct value is only checked once."
+    return [val for val in set(value_list) if not is_valid(val)]
+
+def _is_count(val):
+    try:
+        return int(val) >= 0
+    except (TypeError, ValueError):
+        return False
+
+def _raise_errors(error_map):
+    error_map = {key: ["bad values: %s" % ", ".join(sorted(map(repr, bad)))] for key, bad in error_map.items() if bad}
+    if error_map:
+        raise ValidationError(error_map)
+
 class Article(models.Model):
     doi = CharField(max_length=255, unique=True, help_text="article identifier", validators=[validate_doi])
     pmid = PositiveIntegerField(unique=True, blank=True, null=True)
@@ -34,6 +72,19 @@ class Article(models.Model):
     def __repr__(self):
         return '<Article %r>' % self.doi
 
+def _is_pmcid(pmcid):
+    return pmcid is None or len(str(pmcid)) <= 11
+
+def validate_article_rows(row_list):
+    """validates a batch of article rows all at once, dicts of `Article` field values.
+    raises a `ValidationError` listing the bad values of each field."""
+    error_map = {
+        'doi': _bad_values((row['doi'] for row in row_list), lambda doi: str(doi).startswith(settings.DOI_PREFIX)),
+        'pmid': _bad_values((row['pmid'] for row in row_list if row.get('pmid') is not None), _is_count),
+        'pmcid': _bad_values((row.get('pmcid') for row in row_list), _is_pmcid),
+    }
+    _raise_errors(error_map)
+
 DAY, MONTH, EVER = 'day', 'month', 'ever'
 
 def metric_period_list():
@@ -86,6 +137,35 @@ class Metric(models.Model):
     def __repr__(self):
         return '<Metric %s>' % self
 
+METRIC_COUNTS = ['full', 'abstract', 'digest', 'pdf']
+
+METRIC_DATE_PATTERNS = {
+    DAY: re.compile(r'^\d{4}-\d{2}-\d{2}$'),
+    MONTH: re.compile(r'^\d{4}-\d{2}$'),
+}
+
+def _is_metric_date(pair):
+    "metrics for all time have no date, daily and monthly metrics have a YYYY-MM-DD and YYYY-MM date."
+    period, datestr = pair
+    if period == EVER:
+        return datestr is None
+    pattern = METRIC_DATE_PATTERNS.get(period)
+    return bool(pattern and isinstance(datestr, str) and pattern.match(datestr))
+
+def validate_metric_rows(row_list):
+    """validates a batch of metric rows all at once, dicts of `Metric` field values.
+    raises a `ValidationError` listing the bad values of each field."""
+    period_list = [period for period, _ in metric_period_list()]
+    source_list = [source for source, _ in metric_source_list()]
+    error_map = {
+        'period': _bad_values((row['period'] for row in row_list), lambda period: period in period_list),
+        'source': _bad_values((row['source'] for row in row_list), lambda source: source in source_list),
+        'date': _bad_values(((row['period'], row['date']) for row in row_list), _is_metric_date),
+    }
+    for key in METRIC_COUNTS:
+        error_map[key] = _bad_values((row[key] for row in row_list), _is_count)
+    _raise_errors(error_map)
+
 #
 #
 #
@@ -128,3 +208,34 @@ class Citation(models.Model):
 
     def __repr__(self):
         return '<Citation %s>' % self
+
+def validate_citation_rows(row_list):
+    """validates a batch of citation rows all at once, dicts of `Citation` field values.
+    raises a `ValidationError` listing the bad values of each field."""
+    error_map = {
+        'num': _bad_values((row['num'] for row in row_list), _is_count),
+        'source': _bad_values((row['source'] for row in row_list), lambda source: source in SOURCES),
+        'source_id': _bad_values((row['source_id'] for row in row_list), lambda source_id: bool(source_id) and len(str(source_id)) <= 255),
+    }
+    _raise_errors(error_map)
+
+#
+#
+#
+
+class Watermark(models.Model):
+    "the most recent period of metrics from a source known to be final and fully imported."
+    source = CharField(max_length=255, unique=True, help_text="the source of metrics, like 'ga-daily', 'ptype-blog-article' or 'crossref'")
+    date = DateField(help_text="the last day of the most recent final period imported")
+
+    datetime_record_created = DateTimeField(auto_now_add=True)
+    datetime_record_updated = DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'metrics_watermark'
+
+    def __str__(self):
+        return '%s,%s' % (self.source, self.date)
+
+    def __repr__(self):
+        return '<Watermark %s>' % self
@@ -4,8 +4,8 @@ The number of fetches can be amortised by bulk loading this CSV file.
 See `download-pmcids.sh` to download *and* populate the database.
 """
 
-from article_metrics import models, utils
-from article_metrics.utils import create_or_update, lmap, ensure
+from article_metrics import models, utils, resolver
+from article_metrics.utils import create_or_update, ensure
 from django.conf import settings
 from django.db import transaction
 import csv
@@ -30,8 +30,40 @@ def update_article(row):
 
     return create_or_update(models.Article, data, ['doi'], create=True, update=True, update_check=True)
 
+def update_articles(row_list):
+    """like `update_article` for many rows at once.
+    articles are resolved and created in bulk and only articles whose pmid or pmcid have changed are updated.
+    returns a list of the updated articles."""
+    data_list = []
+    for row in row_list:
+        data = {'doi': row['DOI'], 'pmcid': row['PMCID'], 'pmid': row['PMID'] or None}
+        ensure(data['doi'].startswith(settings.DOI_PREFIX), "refusing to create/update non-journal article: %s" % row)
+        if not data['pmid']:
+            LOG.warning("no pmid for %s" % data['doi'])
+        data_list.append(data)
+
+    models.validate_article_rows(data_list)
+    article_id_map = resolver.article_ids([data['doi'] for data in data_list])
+    row_map = {}
+    for data in data_list:
+        if data['doi'] not in article_id_map:
+            continue # bad doi, already logged
+        # the last row for an article wins
+        article_id = article_id_map[data['doi']]
+        row_map[article_id] = {'id': article_id, 'doi': resolver.norm_doi(data['doi']), 'pmid': data['pmid'], 'pmcid': data['pmcid']}
+
+    key_list, value_list = ['id'], ['pmid', 'pmcid']
+    snapshot_map = utils.snapshot(models.Article.objects.filter(id__in=row_map.keys()), key_list, value_list)
+    _, updated, unchanged = utils.detect_changes(models.Article, snapshot_map, row_map.values(), key_list, value_list)
+
+    updated_list = [models.Article(**utils.exsubdict(row, ['pk'])) for row in updated]
+    models.Article.objects.bulk_update(updated_list, value_list)
+    LOG.info("%s articles updated, %s unchanged" % (len(updated_list), len(unchanged)))
+    return updated_list
+
 @transaction.atomic
 def load_csv(path):
     with open(path, 'r') as fh:
         reader = csv.DictReader(fh)
-        return lmap(update_article, reader)
+        with resolver.ingestion():
+            return update_articles(reader)
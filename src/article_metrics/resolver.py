@@ -0,0 +1,83 @@
+"""resolves article dois to article ids, creating any missing articles in bulk.
+
+during an import the map of every known doi to it's article id can be loaded once and shared:
+
+    with resolver.ingestion():
+        article_id_map = resolver.article_ids(doi_list)
+
+outside of an `ingestion` each call looks up just the dois it is given."""
+
+from contextlib import contextmanager
+import threading
+from django.db import transaction
+from . import models, utils
+import logging
+
+LOG = logging.getLogger(__name__)
+
+_local = threading.local()
+
+def norm_doi(doi):
+    """returns the doi articles are stored with for the given `doi`.
+    raises an `AssertionError` for bad dois and dois of sub-resources."""
+    # temporary, until doi field is replaced with msid field
+    return utils.msid2doi(utils.doi2msid(doi, allow_subresource=False))
+
+def _ingestion_map():
+    "returns the map of dois to article ids for the current ingestion or `None` if there isn't one."
+    return getattr(_local, 'id_map', None)
+
+def ingesting():
+    "returns `True` if there is an ingestion in the current thread."
+    return _ingestion_map() is not None
+
+@contextmanager
+def ingestion():
+    """loads the map of all article dois to article ids in a single query and uses it until the context is exited.
+    nested ingestions share the outermost map. ingestions are per-thread."""
+    if ingesting():
+        yield
+        return
+    _local.id_map = dict(models.Article.objects.values_list('doi', 'id'))
+    LOG.info("loaded %s article ids" % len(_local.id_map))
+    try:
+        yield
+    finally:
+        _local.id_map = None
+
+def _fetch(doi_list):
+    return dict(models.Article.objects.filter(doi__in=doi_list).values_list('doi', 'id'))
+
+def article_ids(doi_list):
+    """returns a map of each good doi in `doi_list` to the id of it's `models.Article`, creating any missing articles.
+    bad dois are logged and skipped. missing articles are created with a single query."""
+    norm_map = {}
+    for doi in doi_list:
+        try:
+            norm_map[doi] = norm_doi(doi)
+        except AssertionError as err:
+            LOG.warning("refusing to fetch/create bad article: %s" % err, extra={'article-data': {'doi': doi}})
+
+    norm_doi_set = set(norm_map.values())
+    ingestion_map = _ingestion_map()
+    if ingestion_map is None:
+        id_map = _fetch(norm_doi_set)
+    else:
+        id_map = {doi: ingestion_map[doi] for doi in norm_doi_set if doi in ingestion_map}
+
+    missing = norm_doi_set.difference(id_map)
+    if missing:
+        models.validate_article_rows([{'doi': doi} for doi in missing])
+        models.Article.objects.bulk_create([models.Article(doi=doi) for doi in sorted(missing)], ignore_conflicts=True)
+        created_map = _fetch(missing)
+        LOG.info("%s articles created" % len(created_map))
+        id_map.update(created_map)
+        if ingestion_map is not None:
+            # the articles are only known to exist once the transaction creating them succeeds
+            transaction.on_commit(lambda: ingestion_map.update(created_map))
+
+    return {doi: id_map[norm] for doi, norm in norm_map.items()}
+
+def article_id(doi):
+    "like `article_ids` for a single `doi`. returns `None` for a bad doi."
+    return article_ids([doi]).get(doi)
@@ -1,6 +1,9 @@
 import os
 import json
+import time
+from collections import Counter
 from article_metrics import utils, models, logic
+from article_metrics.ga_metrics import elife_v1, utils as ga_utils
 from datetime import timedelta, datetime
 import pytest
 
@@ -18,6 +21,33 @@ def fixture_json(fixture_name):
     with open(fixture_path(fixture_name), 'r') as fh:
         return json.load(fh)
 
+# timing comparisons are noisy on busy machines and are only run when asked for:
+#   BENCHMARK=1 ./.test.sh
+benchmark = pytest.mark.skipif(not os.environ.get('BENCHMARK'), reason="benchmarks are only run when BENCHMARK is set")
+
+def best_of(fn, *args, n=3):
+    "returns the result of calling `fn` with `args` and the least time taken over `n` calls"
+    elapsed_list = []
+    for _ in range(n):
+        start = time.time()
+        result = fn(*args)
+        elapsed_list.append(time.time() - start)
+    return result, min(elapsed_list)
+
+def group_results_reference(triplet_list):
+    "`elife_v1.group_results` prior to accumulating counts in place."
+    article_groups = {}
+    for art, art_type, count in triplet_list:
+        zeroed_row = Counter({
+            'full': 0,
+            'abstract': 0,
+            'digest': 0,
+        })
+        group = article_groups.get(art, [zeroed_row]) # every article always has a zeroed result
+        group.append(Counter({art_type: count}))
+        article_groups[art] = group
+    return {ga_utils.enplumpen(art): elife_v1.count_counter_list(group) for art, group in article_groups.items()}
+
 def insert_metrics(abbr_list):
     "function to bypass scraping logic and insert metrics and citations directly into db"
     def wrangle(msid, data, date):
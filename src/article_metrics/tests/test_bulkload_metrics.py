@@ -0,0 +1,65 @@
+from datetime import datetime
+from unittest import mock
+import pytest
+from django.core.exceptions import ValidationError
+from article_metrics import models, logic, bulkload_metrics
+from . import base
+
+def _metric(doi, datestr, pdf=0, **kwargs):
+    return dict({'pdf': pdf, 'full': 0, 'abstract': 0, 'digest': 0, 'period': models.DAY, 'date': datestr, 'doi': doi, 'source': models.GA}, **kwargs)
+
+@pytest.mark.django_db
+def test_load():
+    "metrics are created or updated in batches, unchanged metrics are not touched"
+    logic.insert_row(_metric('10.7554/eLife.00001', '2001-01-01'))
+    logic.insert_row(_metric('10.7554/eLife.00001', '2001-01-02'))
+    unchanged = models.Metric.objects.get(date='2001-01-02')
+
+    data_list = [
+        _metric('10.7554/eLife.00001', '2001-01-01', pdf=1), # updated
+        _metric('10.7554/eLife.00001', '2001-01-02'), # unchanged
+        _metric('10.7554/eLife.1', '2001-01', period=models.MONTH), # created, same article
+        _metric('10.7554/eLife.00002', '2001-01-01'), # created, new article
+        _metric('10.7554/eLife.00003.001', '2001-01-01'), # bad doi, sub-resource
+        _metric('10.7554/eLife.00002', '2001-01-01', pdf=2), # same metric again in the same batch, last one wins
+        _metric('10.7554/eLife.00002', '2001-01-01', pdf=3), # and again in a later batch
+    ]
+    actual = bulkload_metrics.load(data_list, batch_size=5)
+    assert actual == {'created': 2, 'updated': 2, 'unchanged': 1}
+
+    assert models.Article.objects.count() == 2
+    assert models.Metric.objects.count() == 4
+    assert models.Metric.objects.get(article__doi='10.7554/eLife.00001', date='2001-01-01').pdf == 1
+    assert models.Metric.objects.get(article__doi='10.7554/eLife.00002').pdf == 3
+    assert models.Metric.objects.get(date='2001-01-02').datetime_record_updated == unchanged.datetime_record_updated
+
+@pytest.mark.django_db
+def test_load__bad_metric():
+    "metrics are validated before they are loaded"
+    with pytest.raises(ValidationError):
+        bulkload_metrics.load([_metric('10.7554/eLife.00001', '2001-01-01', period='year')])
+
+@pytest.mark.django_db
+def test_import_ga_metrics__bulk_load():
+    "bulk loading GA metrics gives the same results as inserting them in batches"
+    day_to_import = datetime(year=2015, month=9, day=11)
+    fixture = base.fixture_path('test_import_ga_daily_stats/ga-output/views/2015-09-11.json')
+
+    def import_metrics(bulk_load):
+        with mock.patch('article_metrics.ga_metrics.core.output_path_v2', return_value=fixture):
+            return logic.import_ga_metrics('daily', from_date=day_to_import, to_date=day_to_import, use_only_cached=True, bulk_load=bulk_load)
+
+    def metric_values():
+        return sorted(models.Metric.objects.values_list('article__doi', 'date', 'period', 'source', 'full', 'abstract', 'digest', 'pdf'))
+
+    import_metrics(bulk_load=False)
+    expected = metric_values()
+    models.Article.objects.all().delete()
+
+    actual = import_metrics(bulk_load=True)
+    assert actual == {'created': len(expected), 'updated': 0, 'unchanged': 0}
+    assert models.Article.objects.count() == 1119
+    assert metric_values() == expected
+
+    # nothing has changed
+    assert import_metrics(bulk_load=True) == {'created': 0, 'updated': 0, 'unchanged': len(expected)}
@@ -1,7 +1,10 @@
+import os
+import gzip
 import shutil
 import json
 import tempfile
 import pytest
+from collections import Counter
 from os.path import join
 from unittest import mock
 from . import base
@@ -148,7 +151,7 @@ def test_valid_dt_pair():
 def test_output_path_for_view_results(test_output_dir):
     "the output path is correctly generated for views"
     response = base.fixture_json('views-2016-02-24.json')
-    expected = join(test_output_dir, settings.GA_OUTPUT_SUBDIR, "views/2016-02-24.json")
+    expected = join(test_output_dir, settings.GA_OUTPUT_SUBDIR, "views/2016-02-24.json.gz")
     path = core.output_path_from_results(response)
     assert expected == path
 
@@ -156,7 +159,7 @@ def test_output_path_for_download_results(test_output_dir):
     "the output path is correctly generated for downloads"
     response = base.fixture_json('views-2016-02-24.json')
     response['query']['filters'] = 'ga:eventLabel' # downloads are counted as events
-    expected = join(test_output_dir, settings.GA_OUTPUT_SUBDIR, "downloads/2016-02-24.json")
+    expected = join(test_output_dir, settings.GA_OUTPUT_SUBDIR, "downloads/2016-02-24.json.gz")
     path = core.output_path_from_results(response)
     assert expected == path
 
@@ -225,6 +228,23 @@ def test_exponential_backoff_applied_on_rate_limit():
     with pytest.raises(AssertionError):
         core._query_ga(query, num_attempts=1)
 
+def test_query_ga__shared_budget():
+    "GA3 queries are executed within the same budget of queries as GA4 queries"
+    query = mock.Mock()
+    with mock.patch('article_metrics.ga_metrics.ga4.execute', return_value={'rows': []}) as execute:
+        assert core._query_ga(query) == {'rows': []}
+    execute.assert_called_once_with(query)
+    assert not query.execute.called
+
+def test_write_results__compressed(test_output_dir):
+    "GA3 results are written compressed and can be found and read back"
+    response = base.fixture_json('views-2016-02-24.json')
+    path = core.output_path_from_results(response)
+    core.write_results(response, path)
+    assert path.endswith('.json.gz')
+    assert core.find_cache(path[:-len(core.COMPRESSED_EXT)]) == path
+    assert core.read_results(path) == response
+
 # ---
 
 def test_load_cache(temp_json_file):
@@ -266,3 +286,373 @@ def test_load_cache(temp_json_file):
         expected = {}
         actual = core.load_cache(results_type, cacheable_dt, cacheable_dt, True, True)
         assert actual == expected
+
+def test_metrics_for_range__workers():
+    "fetching date ranges concurrently returns the same results, in the same order, as fetching them sequentially"
+    dt_range_list = utils.dt_range(datetime(year=2023, month=1, day=1), datetime(year=2023, month=1, day=10))
+
+    def fake_article_metrics(table_id, from_date, to_date, cached, only_cached):
+        return {'views': {'10.7554/eLife.%05d' % from_date.day: 1}, 'downloads': {}}
+
+    with mock.patch('article_metrics.ga_metrics.core.article_metrics', side_effect=fake_article_metrics):
+        expected = core.metrics_for_range('', dt_range_list, cached=False)
+        actual = core.metrics_for_range('', dt_range_list, cached=False, workers=4)
+    assert list(expected.items()) == list(actual.items())
+
+def test_metrics_for_range__cache_hits_skip_pool():
+    "date ranges that can be served from the cache are not fetched using the worker pool"
+    dt_range_list = utils.dt_range(datetime(year=2023, month=1, day=1), datetime(year=2023, month=1, day=3))
+    with mock.patch('article_metrics.ga_metrics.core.article_metrics', return_value={}):
+        with mock.patch('article_metrics.ga_metrics.core.ThreadPoolExecutor') as executor:
+            core.metrics_for_range('', dt_range_list, cached=True, only_cached=True, workers=4)
+    assert not executor.called
+
+def test_metrics_for_range__bad_workers():
+    for bad_workers in [0, -1, core.MAX_WORKERS + 1, None, '2']:
+        with pytest.raises(AssertionError):
+            core.metrics_for_range('', [], workers=bad_workers)
+
+def test_cache_hit():
+    cacheable_dt = datetime_now() - timedelta(days=4)
+    uncacheable_dt = datetime_now()
+    cases = [
+        # not using the cache
+        ((cacheable_dt, cacheable_dt, False, False), False),
+        # range can't be cached
+        ((uncacheable_dt, uncacheable_dt, True, True), False),
+        # only using the cache, missing cache files are empty results
+        ((cacheable_dt, cacheable_dt, True, True), True),
+    ]
+    with mock.patch('article_metrics.ga_metrics.core.output_path_v2', return_value='/path/does/not/exist'):
+        for args, expected in cases:
+            assert core.cache_hit(*args) == expected
+        # cache files don't exist
+        assert not core.cache_hit(cacheable_dt, cacheable_dt, True, False)
+
+def test_article_metrics__batched(test_output_dir):
+    "GA4 views and downloads not in the cache are fetched together and written to their own cache files"
+    views_fixture = base.fixture_json('v7--views--2023-03-20.json')
+    downloads_fixture = base.fixture_json('v8--downloads--2023-08-13.json')
+    from_dt = to_dt = core.GA4_DOWNLOADS_SWITCH
+    with mock.patch('article_metrics.ga_metrics.core.settings.GA_OUTPUT_SUBDIR', test_output_dir):
+        for results_type in ['views', 'downloads']:
+            os.makedirs(join(test_output_dir, results_type))
+        with mock.patch('article_metrics.ga_metrics.ga4.batch_query_ga', return_value=[views_fixture, downloads_fixture]) as batch_query:
+            actual = core.article_metrics('', from_dt, to_dt, cached=True)
+        assert batch_query.call_count == 1
+        assert core.has_cache('views', from_dt, to_dt)
+        assert core.has_cache('downloads', from_dt, to_dt)
+
+    assert len(actual['views']) == 9840
+    assert len(actual['downloads']) == 496
+
+def test_metrics_for_range__async(test_output_dir):
+    "with the `ga4-async` setting, GA4 date ranges not in the cache are fetched together using the asyncio client"
+    views_fixture = base.fixture_json('v7--views--2023-03-20.json')
+    downloads_fixture = base.fixture_json('v8--downloads--2023-08-13.json')
+    ga3_dt = core.GA4_SWITCH - timedelta(days=1)
+    dt_range_list = [(ga3_dt, ga3_dt)] + utils.dt_range(core.GA4_DOWNLOADS_SWITCH, core.GA4_DOWNLOADS_SWITCH + timedelta(days=1))
+    with mock.patch('article_metrics.ga_metrics.core.settings.GA_OUTPUT_SUBDIR', test_output_dir):
+        for results_type in ['views', 'downloads']:
+            os.makedirs(join(test_output_dir, results_type))
+        with mock.patch('article_metrics.ga_metrics.core.settings.GA4_ASYNC', True):
+            with mock.patch('article_metrics.ga_metrics.ga4_async.run_queries', return_value=[views_fixture, downloads_fixture] * 2) as run_queries:
+                with mock.patch('article_metrics.ga_metrics.core.article_metrics', return_value={}) as article_metrics:
+                    actual = core.metrics_for_range('', dt_range_list, cached=True)
+        # both GA4 date ranges are fetched in a single call, the GA3 date range is fetched as usual
+        assert run_queries.call_count == 1
+        assert len(run_queries.call_args[0][0]) == 4
+        article_metrics.assert_called_once_with('', ga3_dt, ga3_dt, True, False)
+        for from_dt, to_dt in dt_range_list[1:]:
+            assert core.has_cache('views', from_dt, to_dt)
+            assert core.has_cache('downloads', from_dt, to_dt)
+
+    assert list(actual.keys()) == [(utils.ymd(from_dt), utils.ymd(to_dt)) for from_dt, to_dt in dt_range_list]
+    for from_dt, to_dt in dt_range_list[1:]:
+        metrics = actual[(utils.ymd(from_dt), utils.ymd(to_dt))]
+        assert len(metrics['views']) == 9840
+        assert len(metrics['downloads']) == 496
+
+def test_batchable():
+    cacheable_dt = datetime(year=2023, month=8, day=1)
+    cases = [
+        # GA3, can't be batched
+        ((core.GA4_SWITCH - timedelta(days=1), core.GA4_SWITCH - timedelta(days=1), False, False), False),
+        # not using the cache
+        ((cacheable_dt, cacheable_dt, False, False), True),
+        # only using the cache
+        ((cacheable_dt, cacheable_dt, True, True), False),
+    ]
+    with mock.patch('article_metrics.ga_metrics.core.output_path_v2', return_value='/path/does/not/exist'):
+        for args, expected in cases:
+            assert core.batchable(*args) == expected
+        # nothing in the cache
+        assert core.batchable(cacheable_dt, cacheable_dt, True, False)
+
+def _add_date(response, datestr):
+    "adds a trailing 'date' dimension with the given `datestr` to each row in a GA4 `response`"
+    response['dimensionHeaders'] = response['dimensionHeaders'] + [{'name': 'date'}]
+    for row in response['rows']:
+        row['dimensionValues'].append({'value': datestr})
+    return response
+
+def test_add_date_dimension():
+    query = elife_v7.path_counts_query('', core.GA4_SWITCH, core.GA4_SWITCH)
+    actual = core.add_date_dimension(query)
+    assert actual['dimensions'][-1] == {'name': 'date'}
+    assert query['dimensions'] == [{'name': 'pagePathPlusQueryString'}] # original is unmodified
+
+def test_split_response_by_date():
+    "a multi-day response is split into per-day responses that look like single-day responses"
+    day1, day2, day3 = utils.dt_range(core.GA4_SWITCH, core.GA4_SWITCH + timedelta(days=2))
+    day1, day2, day3 = day1[0], day2[0], day3[0]
+    response = base.fixture_json('v7--views--2023-03-20.json')
+    expected_day1 = base.fixture_json('v7--views--2023-03-20.json')
+    multiday_response = _add_date(response, '20230320')
+    multiday_response['rows'].extend(_add_date({'dimensionHeaders': [], 'rows': [{'dimensionValues': [{'value': '/articles/1234'}], 'metricValues': [{'value': '1'}]}]}, '20230322')['rows'])
+
+    actual = core.split_response_by_date(multiday_response, [day1, day2, day3])
+    assert actual[day1]['rows'] == expected_day1['rows']
+    assert actual[day1]['dimensionHeaders'] == expected_day1['dimensionHeaders']
+    assert actual[day2]['rows'] == []
+    assert actual[day3]['rows'] == [{'dimensionValues': [{'value': '/articles/1234'}], 'metricValues': [{'value': '1'}]}]
+    assert actual[day3]['rowCount'] == 1
+
+def test_contiguous_era_runs():
+    one_day = timedelta(days=1)
+    switch = core.GA4_DOWNLOADS_SWITCH
+    dt_list = [switch - one_day * 2, switch - one_day, switch, switch + one_day, switch + one_day * 3]
+    expected = [
+        (elife_v7, [switch - one_day * 2, switch - one_day]),
+        (elife_v8, [switch, switch + one_day]),
+        # a gap in the days starts a new run
+        (elife_v8, [switch + one_day * 3]),
+    ]
+    assert core.contiguous_era_runs(dt_list) == expected
+
+def test_daily_metrics_between__multiday(test_output_dir):
+    "uncached GA4 days are fetched with a single query for views and downloads and written to per-day cache files"
+    from_dt = datetime(year=2023, month=8, day=13)
+    to_dt = from_dt + timedelta(days=1)
+    views = _add_date(base.fixture_json('v7--views--2023-03-20.json'), '20230813')
+    downloads = _add_date(base.fixture_json('v8--downloads--2023-08-13.json'), '20230814')
+    with mock.patch('article_metrics.ga_metrics.core.settings.GA_OUTPUT_SUBDIR', test_output_dir):
+        for results_type in ['views', 'downloads']:
+            os.makedirs(join(test_output_dir, results_type))
+        with mock.patch('article_metrics.ga_metrics.ga4.batch_query_ga', return_value=[views, downloads]) as batch_query:
+            actual = core.daily_metrics_between('', from_dt, to_dt, multiday=True)
+        assert batch_query.call_count == 1
+
+        # cache files were written for each day and each type
+        for dt in [from_dt, to_dt]:
+            assert core.has_cache('views', dt, dt)
+            assert core.has_cache('downloads', dt, dt)
+
+        # and subsequent daily queries are served from the cache
+        with mock.patch('article_metrics.ga_metrics.ga4.batch_query_ga') as batch_query:
+            expected = core.daily_metrics_between('', from_dt, to_dt)
+        assert not batch_query.called
+
+    assert list(actual.keys()) == [('2023-08-13', '2023-08-13'), ('2023-08-14', '2023-08-14')]
+    assert actual == expected
+    assert len(actual[('2023-08-13', '2023-08-13')]['views']) == 9840
+    assert actual[('2023-08-13', '2023-08-13')]['downloads'] == {}
+    assert actual[('2023-08-14', '2023-08-14')]['views'] == {}
+    assert len(actual[('2023-08-14', '2023-08-14')]['downloads']) == 496
+
+def test_compressed_cache(test_output_dir):
+    "results are written compressed and compactly and read back transparently"
+    results = base.fixture_json('v7--views--2023-03-20.json')
+    path = join(test_output_dir, 'foo.json.gz')
+    core.write_results_v2(results, path)
+    assert core.read_results(path) == results
+    with gzip.open(path, 'rt') as fh:
+        assert '\n' not in fh.read()
+
+def test_load_cache__either_format(test_output_dir):
+    "cache files are found and read in either format"
+    cacheable_dt = datetime(year=2023, month=8, day=1)
+    results = {'foo': 'bar'}
+    compressed_path = join(test_output_dir, 'foo.json.gz')
+    uncompressed_path = join(test_output_dir, 'foo.json')
+
+    core.write_results_v2(results, uncompressed_path)
+    with mock.patch('article_metrics.ga_metrics.core.output_path_v2', return_value=compressed_path):
+        assert core.has_cache('views', cacheable_dt, cacheable_dt)
+        assert core.load_cache('views', cacheable_dt, cacheable_dt, True, False) == results
+
+    core.compress_cache_file(uncompressed_path)
+    assert not os.path.exists(uncompressed_path)
+    with mock.patch('article_metrics.ga_metrics.core.output_path_v2', return_value=uncompressed_path):
+        assert core.has_cache('views', cacheable_dt, cacheable_dt)
+        assert core.load_cache('views', cacheable_dt, cacheable_dt, True, False) == results
+
+def test_compress_cache(test_output_dir):
+    "all uncompressed cache files in a directory tree are converted"
+    os.makedirs(join(test_output_dir, 'views'))
+    for fname in ['views/2001-01-01.json', 'views/2001-01-02.json', 'views/2001-01-03.json.gz']:
+        core.write_results_v2({'fname': fname}, join(test_output_dir, fname))
+
+    actual = core.compress_cache(test_output_dir)
+    expected = [join(test_output_dir, 'views/2001-01-01.json.gz'), join(test_output_dir, 'views/2001-01-02.json.gz')]
+    assert actual == expected
+    assert sorted(os.listdir(join(test_output_dir, 'views'))) == ['2001-01-01.json.gz', '2001-01-02.json.gz', '2001-01-03.json.gz']
+    assert core.read_results(expected[0]) == {'fname': 'views/2001-01-01.json'}
+
+def test_iter_rows(test_output_dir):
+    "rows are streamed from cache files in either format"
+    results = base.fixture_json('v7--views--2023-03-20.json')
+    for fname in ['foo.json', 'foo.json.gz']:
+        path = join(test_output_dir, fname)
+        core.write_results_v2(results, path)
+        with mock.patch('article_metrics.ga_metrics.core.READ_CHUNK_SIZE', 7):
+            assert list(core.iter_rows(path)) == results['rows']
+
+def test_iter_rows__edge_cases(test_output_dir):
+    "other values are skipped and missing or empty rows yield nothing"
+    cases = [
+        ({}, []),
+        ({'rows': []}, []),
+        ({'rows': None, 'rowCount': 0}, []),
+        ({'rowCount': 123456789, 'rows': [["/articles/1", "2"]], 'query': {'rows': [1]}}, [["/articles/1", "2"]]),
+        ({'a': " , ] } \" rows", 'rows': [{'b': 1.5}, {}, [], 0]}, [{'b': 1.5}, {}, [], 0]),
+    ]
+    path = join(test_output_dir, 'foo.json')
+    for results, expected in cases:
+        core.write_results_v2(results, path)
+        with mock.patch('article_metrics.ga_metrics.core.READ_CHUNK_SIZE', 1):
+            assert list(core.iter_rows(path)) == expected
+
+def test_load_cache_rows(test_output_dir):
+    "rows from a cache file are returned as an iterator"
+    dt = datetime(year=2023, month=8, day=1)
+    path = join(test_output_dir, 'foo.json.gz')
+    core.write_results_v2({'rows': [1, 2, 3]}, path)
+    with mock.patch('article_metrics.ga_metrics.core.output_path_v2', return_value=path):
+        rows = core.load_cache_rows('views', dt, dt, True, False)
+        assert not isinstance(rows, list)
+        assert list(rows) == [1, 2, 3]
+    with mock.patch('article_metrics.ga_metrics.core.output_path_v2', return_value=join(test_output_dir, 'bar.json.gz')):
+        assert core.load_cache_rows('views', dt, dt, True, True) == []
+        assert core.load_cache_rows('views', dt, dt, True, False) is None
+    assert core.load_cache_rows('views', dt, dt, False, False) is None
+
+def _views_row(path, count):
+    return {'dimensionValues': [{'value': path}], 'metricValues': [{'value': str(count)}]}
+
+def _downloads_row(path, count):
+    return {'dimensionValues': [{'value': 'file_download'}, {'value': 'foo.pdf'}, {'value': path}], 'metricValues': [{'value': str(count)}]}
+
+def test_monthly_metrics_between__from_daily(test_output_dir):
+    "monthly downloads are derived from cached daily downloads when every day of the month is cached, monthly views are queried"
+    from_dt = datetime(year=2023, month=9, day=1)
+    to_dt = datetime(year=2023, month=9, day=30)
+    monthly_views = {'rows': [_views_row('/articles/80001', 25), _views_row('/reviewed-preprints/80002', 400)]}
+    with mock.patch('article_metrics.ga_metrics.core.settings.GA_OUTPUT_SUBDIR', test_output_dir):
+        for results_type in ['views', 'downloads']:
+            os.makedirs(join(test_output_dir, results_type))
+        for dt, _ in utils.dt_range(from_dt, to_dt):
+            core.write_cache('views', dt, dt, {'rows': [_views_row('/articles/80001', 1), _views_row('/reviewed-preprints/80002', dt.day)]})
+            core.write_cache('downloads', dt, dt, {'rows': [_downloads_row('/articles/80001', 2)]})
+
+        with mock.patch('article_metrics.ga_metrics.core.query_ga_write_results_v2', return_value=(monthly_views, None)) as query_ga:
+            with mock.patch('article_metrics.ga_metrics.ga4.batch_query_ga') as batch_query:
+                actual = core.monthly_metrics_between('', from_dt, to_dt, from_daily=True)
+        assert query_ga.call_count == 1
+        assert query_ga.call_args[0][3] == 'views'
+        assert not batch_query.called
+
+    expected = {
+        ('2023-09-01', '2023-09-30'): {
+            'views': {
+                '10.7554/eLife.80001': Counter(full=25, abstract=0, digest=0),
+                '10.7554/eLife.80002': Counter(full=400, abstract=0, digest=0),
+            },
+            'downloads': {
+                '10.7554/eLife.80001': 60,
+            }
+        }
+    }
+    assert actual == expected
+
+def test_monthly_downloads_from_daily__fallback(test_output_dir):
+    "monthly downloads aren't derived when a day is missing, the month is cached or the month straddles an era boundary"
+    from_dt = datetime(year=2023, month=9, day=1)
+    to_dt = datetime(year=2023, month=9, day=30)
+    with mock.patch('article_metrics.ga_metrics.core.settings.GA_OUTPUT_SUBDIR', test_output_dir):
+        os.makedirs(join(test_output_dir, 'downloads'))
+        for dt, _ in utils.dt_range(from_dt, to_dt - timedelta(days=1)):
+            core.write_cache('downloads', dt, dt, {'rows': []})
+
+        # last day of the month is missing
+        assert core.monthly_downloads_from_daily('', from_dt, to_dt) is None
+
+        # daily views aren't needed
+        core.write_cache('downloads', to_dt, to_dt, {'rows': []})
+        assert core.monthly_downloads_from_daily('', from_dt, to_dt) == {}
+
+        # month is cached
+        core.write_cache('downloads', from_dt, to_dt, {'rows': []})
+        assert core.monthly_downloads_from_daily('', from_dt, to_dt) is None
+
+    # the month GA4 downloads switched from custom events is parsed differently to some of it's days
+    from_dt, to_dt = utils.month_min_max(core.GA4_DOWNLOADS_SWITCH)
+    with mock.patch('article_metrics.ga_metrics.core.downloads_cached', return_value=False) as downloads_cached:
+        assert core.monthly_downloads_from_daily('', from_dt, to_dt) is None
+    assert downloads_cached.call_count == 1 # only the month itself was checked
+
+def test_is_aggregated():
+    cases = [
+        ({}, False),
+        ({'rows': [_views_row('/articles/80001', 1)]}, False),
+        ({'rows': [_views_row('/articles/80001', 1), _views_row('(other)', 100)]}, True),
+        ({'rows': [_downloads_row('(other)', 100)]}, True),
+        ({'rows': [], 'metadata': {'samplingMetadatas': [{'samplesReadCount': '1'}]}}, True),
+        # observed on responses without an "(other)" row
+        ({'rows': [], 'metadata': {'dataLossFromOtherRow': True}}, False),
+    ]
+    for results, expected in cases:
+        assert core.is_aggregated(results) == expected, "case: %s" % results
+
+def test_merge_results():
+    results_list = [
+        {'kind': 'analyticsData#runReport', 'rows': [_views_row('/articles/80001', 1), _views_row('/articles/80002', 2)]},
+        {'kind': 'ignored', 'rows': [_views_row('/articles/80002', 3), _views_row('/articles/80003', 4)]},
+    ]
+    expected = {'kind': 'analyticsData#runReport',
+                'rows': [_views_row('/articles/80001', 1), _views_row('/articles/80002', 5), _views_row('/articles/80003', 4)],
+                'rowCount': 3}
+    assert core.merge_results(results_list) == expected
+
+def test_query_ga_write_results_v2__bisected(test_output_dir):
+    "GA4 queries with aggregated results are split in half until complete and the results merged and cached under the original date range"
+    from_dt = datetime(year=2023, month=9, day=1)
+    to_dt = datetime(year=2023, month=9, day=10)
+
+    def fake_query_ga(query_map, **kwargs):
+        query_from = core.todt_notz(query_map['dateRanges'][0]['startDate'])
+        query_to = core.todt_notz(query_map['dateRanges'][0]['endDate'])
+        num_days = (query_to - query_from).days + 1
+        if num_days > 3:
+            return {'rows': [_views_row('/articles/80001', num_days - 1), _views_row('(other)', 1)]}
+        return {'rows': [_views_row('/articles/80001', num_days)]}
+
+    query_map = elife_v8.path_counts_query(None, from_dt, to_dt)
+    with mock.patch('article_metrics.ga_metrics.core.settings.GA_OUTPUT_SUBDIR', test_output_dir):
+        os.makedirs(join(test_output_dir, 'views'))
+        with mock.patch('article_metrics.ga_metrics.ga4.query_ga', side_effect=fake_query_ga) as query_ga:
+            results, path = core.query_ga_write_results_v2(query_map, from_dt, to_dt, 'views')
+        # 1-10 => 1-5, 6-10 => 1-3, 4-5, 6-8, 9-10
+        assert query_ga.call_count == 7
+        assert results['rows'] == [_views_row('/articles/80001', 10)]
+        assert path == core.output_path_v2('views', from_dt, to_dt)
+        assert core.load_cache('views', from_dt, to_dt, cached=True, only_cached=True)['rows'] == results['rows']
+
+def test_bisect_aggregated__single_day():
+    "aggregated results for a single day can't be split and are returned as-is"
+    dt = datetime(year=2023, month=9, day=1)
+    query_map = elife_v8.path_counts_query(None, dt, dt)
+    results = {'rows': [_views_row('(other)', 1)]}
+    query_fn = mock.Mock()
+    assert core.bisect_aggregated(query_map, results, query_fn) == results
+    assert not query_fn.called
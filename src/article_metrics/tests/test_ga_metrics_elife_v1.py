@@ -0,0 +1,52 @@
+import random
+from collections import Counter
+from article_metrics.ga_metrics import elife_v1
+from . import base
+
+def _mk_triplets(num_articles, num_rows):
+    "returns a list of `num_rows` (art-id, count-type, count) triples spread over `num_articles` articles."
+    rand = random.Random(1)
+    return [("%05d" % rand.randrange(1, num_articles + 1), rand.choice(['full', 'full', 'abstract', 'digest']), rand.randrange(0, 100))
+            for _ in range(num_rows)]
+
+def test_group_results():
+    triplet_list = [
+        ('09560', 'full', 1),
+        ('09560', 'abstract', 2),
+        ('09560', 'full', 3),
+        ('9560', 'full', 4), # different art-id for the same article, replaces '09560'
+        ('00001', 'digest', 0),
+    ]
+    expected = {
+        '10.7554/eLife.09560': Counter(full=4, abstract=0, digest=0),
+        '10.7554/eLife.00001': Counter(full=0, abstract=0, digest=0),
+    }
+    actual = elife_v1.group_results(triplet_list)
+    assert actual == expected
+    assert actual == base.group_results_reference(triplet_list)
+    assert all(set(counts.keys()) == {'full', 'abstract', 'digest'} for counts in actual.values())
+    assert elife_v1.group_results([]) == {}
+
+def _ten_years_of_triplets():
+    "~10 years of monthly responses, each with ~200 articles viewed ~10 times."
+    triplet_list = []
+    for month in range(120):
+        triplet_list.extend(_mk_triplets(200 + month * 2, 2000))
+    return triplet_list
+
+def test_group_results__equivalence():
+    "`group_results` is equivalent to summing lists of Counters"
+    triplet_list = _mk_triplets(200, 2000)
+    expected = base.group_results_reference(triplet_list)
+    actual = elife_v1.group_results(triplet_list)
+    assert actual == expected
+    assert list(actual.keys()) == list(expected.keys())
+
+@base.benchmark
+def test_group_results__speed():
+    "`group_results` is faster than summing lists of Counters over a 10 year workload"
+    triplet_list = _ten_years_of_triplets()
+    expected, reference_elapsed = base.best_of(base.group_results_reference, triplet_list)
+    actual, elapsed = base.best_of(elife_v1.group_results, triplet_list)
+    assert actual == expected
+    assert elapsed < reference_elapsed / 2
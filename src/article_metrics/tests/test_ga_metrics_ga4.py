@@ -1,4 +1,8 @@
-import json
+import json, random, time, threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import httplib2
+from googleapiclient.errors import HttpError
 from unittest import mock
 from article_metrics.ga_metrics import ga4
 from .base import fixture_path
@@ -19,3 +23,141 @@ def test_query_ga():
     with mock.patch('article_metrics.ga_metrics.ga4._query_ga', return_value=fixture):
         actual = ga4.query_ga(query)
     assert expected == actual
+
+def mkresponse(rows, row_count):
+    return {'kind': 'analyticsData#runReport', 'rowCount': row_count, 'rows': rows}
+
+def test_batch_query_ga():
+    "each query in a batch is returned in order, with any further pages fetched individually"
+    query_list = [{'id': 1}, {'id': 2}]
+    batch_response = {
+        'kind': 'analyticsData#batchRunReports',
+        'reports': [
+            mkresponse(['a'] * ga4.MAX_RESULTS, ga4.MAX_RESULTS + 1),
+            mkresponse(['c'], 1),
+        ]
+    }
+    with mock.patch('article_metrics.ga_metrics.ga4._batch_query_ga', return_value=batch_response) as batch_query:
+        with mock.patch('article_metrics.ga_metrics.ga4._query_ga', return_value=mkresponse(['b'], ga4.MAX_RESULTS + 1)) as query:
+            actual = ga4.batch_query_ga(query_list)
+
+    assert batch_query.call_count == 1
+    assert query.call_count == 1 # second page of the first query
+    assert len(actual) == 2
+    assert actual[0]['rows'] == ['a'] * ga4.MAX_RESULTS + ['b']
+    assert actual[0]['-total-pages'] == 2
+    assert actual[1]['rows'] == ['c']
+    assert actual[1]['-total-pages'] == 1
+
+def test_batch_query_ga__batch_size():
+    "queries are sent in batches no larger than `MAX_BATCH_SIZE`"
+    query_list = [{'id': i} for i in range(ga4.MAX_BATCH_SIZE + 1)]
+
+    def fake_batch_query(batch):
+        return {'reports': [mkresponse([], 0) for _ in batch]}
+
+    with mock.patch('article_metrics.ga_metrics.ga4._batch_query_ga', side_effect=fake_batch_query) as batch_query:
+        actual = ga4.batch_query_ga(query_list)
+    assert batch_query.call_count == 2
+    assert len(actual) == len(query_list)
+
+def test_query_ga__concurrent_pages():
+    "further pages are fetched concurrently and their rows concatenated in offset order, regardless of the order they arrive in"
+    results_pp = 10
+    row_count = results_pp * 3 + 5
+
+    def fake_query(query):
+        offset = query['offset']
+        time.sleep(random.random() / 100)
+        rows = list(range(offset, min(offset + results_pp, row_count)))
+        return dict(mkresponse(rows, row_count), offset=offset)
+
+    with mock.patch('article_metrics.ga_metrics.ga4._query_ga', side_effect=fake_query) as query:
+        actual = ga4.query_ga({}, results_pp, page_workers=3)
+
+    assert query.call_count == 4
+    assert actual['rows'] == list(range(row_count))
+    assert actual['-total-pages'] == 4
+    assert actual['offset'] == results_pp * 3 # the last response is used
+
+def test_query_ga__sequential_pages():
+    "with a single page worker, pages are fetched one at a time and fetching stops at the first empty page"
+    response_list = [mkresponse(['a'], 4), mkresponse(['b'], 4), mkresponse([], 4), mkresponse(['d'], 4)]
+    with mock.patch('article_metrics.ga_metrics.ga4._query_ga', side_effect=response_list) as query:
+        actual = ga4.query_ga({}, 1, page_workers=1)
+    assert query.call_count == 3
+    assert actual['rows'] == ['a', 'b']
+    assert actual['-total-pages'] == 3
+
+def test_query_ga__bad_page_workers():
+    for page_workers in [0, ga4.MAX_PAGE_WORKERS + 1, '2']:
+        with mock.patch('article_metrics.ga_metrics.ga4._query_ga', return_value=mkresponse(['a'], 2)):
+            with pytest.raises(AssertionError):
+                ga4.query_ga({}, 1, page_workers=page_workers)
+
+def http_error(status):
+    return HttpError(httplib2.Response({'status': status}), b'')
+
+def test_execute_with_backoff():
+    "queries are retried with a back-off when rate limited or the service is unavailable"
+    for status in [403, 429, 503]:
+        query = mock.Mock()
+        query.execute.side_effect = [http_error(status), {'rows': []}]
+        with mock.patch('article_metrics.ga_metrics.ga4.time.sleep') as sleep:
+            assert ga4._execute_with_backoff(query) == {'rows': []}
+        assert query.execute.call_count == 2
+        assert sleep.called
+
+def test_backoff_seconds():
+    assert 1 <= ga4.backoff_seconds(0, 429) <= 2
+    assert 8 <= ga4.backoff_seconds(2, 503) <= 9
+    assert ga4.backoff_seconds(0, 400) is None
+
+def test_execute_with_backoff__unhandled_error():
+    "other http errors are raised immediately"
+    query = mock.Mock()
+    query.execute.side_effect = [http_error(400), {'rows': []}]
+    with mock.patch('article_metrics.ga_metrics.ga4.time.sleep'):
+        with pytest.raises(HttpError):
+            ga4._execute_with_backoff(query)
+    assert query.execute.call_count == 1
+
+def test_execute_with_backoff__attempts():
+    query = mock.Mock()
+    query.execute.side_effect = http_error(429)
+    with mock.patch('article_metrics.ga_metrics.ga4.time.sleep'):
+        with pytest.raises(AssertionError):
+            ga4._execute_with_backoff(query, num_attempts=3)
+    assert query.execute.call_count == 3
+
+def test_execute__in_flight():
+    "no more than `MAX_QUERIES_PER_SECOND` queries are executed at once, regardless of the number of threads"
+    lock = threading.Lock()
+    in_flight, max_in_flight = 0, 0
+
+    def fake_execute():
+        nonlocal in_flight, max_in_flight
+        with lock:
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+        time.sleep(0.3)
+        with lock:
+            in_flight -= 1
+
+    query = mock.Mock()
+    query.execute.side_effect = fake_execute
+    with mock.patch('article_metrics.ga_metrics.ga4._in_flight', threading.BoundedSemaphore(2)):
+        with ThreadPoolExecutor(max_workers=6) as executor:
+            list(executor.map(lambda _: ga4.execute(query), range(6)))
+    assert query.execute.call_count == 6
+    assert max_in_flight == 2
+
+def test_ga_service():
+    "a service is built once per-thread"
+    service_list = []
+    with mock.patch('article_metrics.ga_metrics.service.build', side_effect=lambda *args: object()) as build:
+        thread = threading.Thread(target=lambda: service_list.extend([ga4.ga_service(), ga4.ga_service()]))
+        thread.start()
+        thread.join()
+        assert build.call_count == 1
+        assert service_list[0] is service_list[1]
@@ -0,0 +1,133 @@
+import asyncio, json, time
+from contextlib import asynccontextmanager
+from datetime import datetime
+from unittest import mock
+import pytest
+from article_metrics.ga_metrics import ga4_async, elife_v7
+from . import base
+
+# `asyncio` event loops use sockets internally
+pytestmark = pytest.mark.enable_socket
+
+async def _read_request(reader):
+    "reads a HTTP/1.1 request, returning a pair of `(headers, body)`."
+    await reader.readline() # b"POST /v1beta/properties/123:runReport HTTP/1.1\r\n"
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if not line.strip():
+            break
+        key, _, val = line.decode('latin-1').partition(':')
+        headers[key.strip().lower()] = val.strip()
+    return headers, await reader.readexactly(int(headers['content-length']))
+
+def _page(query, fixture_map):
+    "returns the page of the fixture for the `query`'s date range, as GA would."
+    date_range = query['dateRanges'][0]
+    fixture = base.fixture_json(fixture_map.get((date_range['startDate'], date_range['endDate']), 'ga4--empty-response.json'))
+    rows = fixture.get('rows') or []
+    if not rows:
+        return fixture
+    offset = int(query.get('offset', 0))
+    return dict(fixture, rows=rows[offset:offset + int(query['limit'])], rowCount=len(rows))
+
+@asynccontextmanager
+async def fake_ga4_server(fixture_map, delay=0, fail_list=None):
+    """a stand-in for the GA4 `runReport` endpoint on localhost.
+    responds to a query with a page of the rows of the fixture for the query's date range in `fixture_map`,
+    after `delay` seconds, using 'chunked' transfer encoding like GA does.
+    the first requests are responded to with each HTTP status in `fail_list`.
+    yields the API url and a map of the requests received and the most requests in-flight at once."""
+    fail_list = list(fail_list or [])
+    state = {'requests': [], 'in-flight': 0, 'max-in-flight': 0}
+
+    async def handle(reader, writer):
+        state['in-flight'] += 1
+        state['max-in-flight'] = max(state['in-flight'], state['max-in-flight'])
+        headers, body = await _read_request(reader)
+        query = json.loads(body)
+        state['requests'].append((headers, query))
+        await asyncio.sleep(delay)
+        status = fail_list.pop(0) if fail_list else 200
+        payload = json.dumps(_page(query, fixture_map) if status == 200 else {'error': {'code': status}}).encode('utf-8')
+        writer.write(b"HTTP/1.1 %d -\r\nContent-Type: application/json\r\nTransfer-Encoding: chunked\r\n\r\n" % status)
+        for i in range(0, len(payload), 4096):
+            chunk = payload[i:i + 4096]
+            writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+        writer.close()
+        state['in-flight'] -= 1
+
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    try:
+        yield "http://127.0.0.1:%s/v1beta" % port, state
+    finally:
+        server.close()
+        await server.wait_closed()
+
+def run_against_fake_server(query_list, fixture_map, delay=0, fail_list=None, **kwargs):
+    """performs the queries in `query_list` against a fake GA4 server, returning a pair of `(responses, server-state)`.
+    requests aren't rate limited unless a `max_per_second` is given."""
+    kwargs.setdefault('max_per_second', 1000)
+
+    async def main():
+        async with fake_ga4_server(fixture_map, delay, fail_list) as (api_url, state):
+            return await ga4_async.query_ga_many(query_list, api_url=api_url, **kwargs), state
+    with mock.patch('article_metrics.ga_metrics.ga4_async._access_token', return_value='secret'):
+        return asyncio.run(main())
+
+def _views_query(dt):
+    return elife_v7.path_counts_query(None, dt, dt)
+
+def test_query_ga_many():
+    "each query is performed and every page of it's results fetched, the responses are returned in query order"
+    fixture_map = {('2023-03-20', '2023-03-20'): 'v7--views--2023-03-20.json'}
+    fixture = base.fixture_json('v7--views--2023-03-20.json')
+    query_list = [_views_query(datetime(2023, 3, 20)), _views_query(datetime(2023, 3, 21))]
+    actual, state = run_against_fake_server(query_list, fixture_map, results_pp=1000)
+
+    assert len(state['requests']) == 10 + 1 # 9964 rows over 10 pages, plus the empty response to the second query
+    assert all(headers['authorization'] == 'Bearer secret' for headers, _ in state['requests'])
+    assert actual[0]['rows'] == fixture['rows']
+    assert actual[0]['-total-pages'] == 10
+    assert actual[1]['rows'] == []
+    assert actual[1]['-total-pages'] == 1
+
+def test_query_ga_many__backoff():
+    "queries that are rate limited or find the service unavailable are attempted again"
+    query_list = [_views_query(datetime(2023, 3, 20))]
+    fixture_map = {('2023-03-20', '2023-03-20'): 'v7--views--2023-03-20.json'}
+    with mock.patch('article_metrics.ga_metrics.ga4.backoff_seconds', side_effect=[0, 0]):
+        actual, state = run_against_fake_server(query_list, fixture_map, fail_list=[429, 503])
+    assert len(state['requests']) == 3
+    assert len(actual[0]['rows']) == 9964
+
+def test_query_ga_many__error():
+    "queries that fail for other reasons are not attempted again"
+    query_list = [_views_query(datetime(2023, 3, 20))]
+    with pytest.raises(ga4_async.GAHTTPError) as err:
+        run_against_fake_server(query_list, {}, fail_list=[400])
+    assert err.value.status == 400
+
+def test_query_ga_many__throughput():
+    "independent queries overlap, with no more than `max_concurrent` requests in-flight at once"
+    num_queries, delay, max_concurrent = 50, 0.02, 10
+    query_list = [_views_query(datetime(2023, 3, 21)) for _ in range(num_queries)]
+    actual, state = run_against_fake_server(query_list, {}, delay=delay, max_concurrent=max_concurrent)
+
+    assert len(actual) == num_queries
+    assert 1 < state['max-in-flight'] <= max_concurrent
+
+def test_query_ga_many__rate_limited():
+    "no more than `max_per_second` requests are started a second"
+    num_queries, max_per_second = 5, 50
+    query_list = [_views_query(datetime(2023, 3, 21)) for _ in range(num_queries)]
+    start = time.perf_counter()
+    actual, _ = run_against_fake_server(query_list, {}, max_per_second=max_per_second)
+    elapsed = time.perf_counter() - start
+
+    assert len(actual) == num_queries
+    # the last request can't start until `num_queries - 1` intervals have passed
+    assert elapsed >= (num_queries - 1) / max_per_second
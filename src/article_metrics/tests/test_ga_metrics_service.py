@@ -0,0 +1,52 @@
+import json, subprocess, sys
+from unittest import mock
+from django.conf import settings
+from googleapiclient.http import HttpMock
+from article_metrics.ga_metrics import service
+
+def test_build__ga4():
+    "GA4 service objects are built from the bundled discovery document, without a request"
+    with mock.patch('googleapiclient.discovery.build') as fetching_build:
+        ga4_service = service.build('analyticsdata', 'v1beta', http=HttpMock())
+    assert not fetching_build.called
+
+    query_map = {'dateRanges': [{'startDate': '2023-03-20', 'endDate': '2023-03-20'}], 'limit': 10000}
+    request = ga4_service.properties().runReport(property='properties/123', body=query_map)
+    assert request.method == 'POST'
+    assert request.uri.startswith('https://analyticsdata.googleapis.com/v1beta/properties/123:runReport')
+    assert json.loads(request.body) == query_map
+
+    request = ga4_service.properties().batchRunReports(property='properties/123', body={'requests': [query_map]})
+    assert request.uri.startswith('https://analyticsdata.googleapis.com/v1beta/properties/123:batchRunReports')
+
+def test_build__ga3():
+    "GA3 service objects are built from the bundled discovery document, without a request"
+    with mock.patch('googleapiclient.discovery.build') as fetching_build:
+        ga3_service = service.build('analytics', 'v3', http=HttpMock())
+    assert not fetching_build.called
+
+    request = ga3_service.data().ga().get(**{
+        'ids': 'ga:123', 'start_date': '2016-01-01', 'end_date': '2016-01-31', 'metrics': 'ga:sessions',
+        'max_results': 10000, 'start_index': 1})
+    assert request.method == 'GET'
+    assert request.uri.startswith('https://www.googleapis.com/analytics/v3/data/ga?')
+    assert 'start-date=2016-01-01' in request.uri
+    assert 'max-results=10000' in request.uri
+
+def test_build__no_bundled_document():
+    "the discovery document is fetched for services without a bundled document"
+    with mock.patch('googleapiclient.discovery.build') as fetching_build:
+        service.build('foo', 'v1', http=HttpMock())
+    assert fetching_build.called
+
+def test_lazy_import():
+    "the GA client libraries are not imported until a service is built"
+    script = ";".join([
+        "import django, sys",
+        "django.setup()",
+        "import metrics.logic, article_metrics.logic, article_metrics.ga_metrics.core",
+        "print(sorted({'googleapiclient', 'oauth2client', 'httplib2'} & set(sys.modules)))",
+    ])
+    # run from the src dir, like `manage.py`, regardless of where the tests are run from
+    output = subprocess.check_output([sys.executable, '-c', script], cwd=settings.SRC_DIR)
+    assert output.strip() == b"[]"
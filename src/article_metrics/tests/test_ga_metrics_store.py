@@ -0,0 +1,379 @@
+import os
+import inspect
+import shutil
+import sqlite3
+import threading
+import tempfile
+import pytest
+from os.path import join
+from unittest import mock
+from collections import Counter
+from datetime import datetime, timedelta
+from . import base
+from article_metrics.ga_metrics import core, store, utils, elife_v7, elife_v8
+
+@pytest.fixture(name='test_output_dir')
+def fixture_test_output_dir():
+    name = tempfile.mkdtemp()
+    with mock.patch('article_metrics.ga_metrics.core.settings.GA_OUTPUT_SUBDIR', name):
+        with mock.patch('article_metrics.ga_metrics.core.settings.GA_CACHE_BACKEND', 'sqlite'):
+            yield name
+    shutil.rmtree(name)
+
+def test_put_get(test_output_dir):
+    "results can be stored and retrieved"
+    dt = datetime(year=2001, month=1, day=1)
+    results = {'foo': 'bar'}
+    assert store.get('views', dt, dt) is None
+    assert not store.exists('views', dt, dt)
+    store.put('views', dt, dt, results)
+    assert store.get('views', dt, dt) == results
+    assert store.exists('views', dt, dt)
+    assert not store.exists('downloads', dt, dt)
+    assert os.path.exists(join(test_output_dir, 'cache.sqlite3'))
+
+def test_put__replaces(test_output_dir):
+    "storing results for the same key replaces the previous results"
+    dt = datetime(year=2001, month=1, day=1)
+    store.put('views', dt, dt, {'foo': 'bar'})
+    store.put('views', dt, dt, {'bar': 'baz'})
+    assert store.get('views', dt, dt) == {'bar': 'baz'}
+
+def test_get_range(test_output_dir):
+    "all results within a date range are returned in a single pass"
+    dt = datetime(year=2001, month=1, day=1)
+    for i in range(5):
+        day = dt + timedelta(days=i)
+        store.put('views', day, day, {'i': i})
+    store.put('views', dt, dt + timedelta(days=30), {'month': True})
+    store.put('downloads', dt, dt, {'i': 0})
+
+    expected = {
+        ('2001-01-02', '2001-01-02'): {'i': 1},
+        ('2001-01-03', '2001-01-03'): {'i': 2},
+    }
+    assert store.get_range('views', dt + timedelta(days=1), dt + timedelta(days=2)) == expected
+
+def test_conn(test_output_dir):
+    "connections use write-ahead logging and wait for locks to be released"
+    assert store.conn().execute("PRAGMA journal_mode").fetchone() == ('wal',)
+    assert store.conn().execute("PRAGMA busy_timeout").fetchone() == (store.BUSY_TIMEOUT * 1000,)
+    assert store.conn() is store.conn()
+
+def test_close_connections(test_output_dir):
+    "connections opened by threads that have finished are closed, connections of running threads are not"
+    connection_list = []
+    thread = threading.Thread(target=lambda: connection_list.append(store.conn()))
+    thread.start()
+    thread.join()
+    connection = store.conn()
+    assert connection_list[0] is not connection
+
+    assert store.close_connections() == 1
+    with pytest.raises(sqlite3.ProgrammingError):
+        connection_list[0].execute("SELECT 1")
+    assert connection.execute("SELECT 1").fetchone() == (1,)
+
+def test_metrics_for_range__closes_connections(test_output_dir):
+    "the connections to the store opened by worker threads are closed once they have finished"
+    dt_range_list = utils.dt_range(datetime(year=2023, month=1, day=1), datetime(year=2023, month=1, day=4))
+
+    def fake_article_metrics(table_id, from_date, to_date, cached, only_cached):
+        store.conn()
+        return {}
+
+    with mock.patch('article_metrics.ga_metrics.core.article_metrics', side_effect=fake_article_metrics):
+        with mock.patch('article_metrics.ga_metrics.store.close_connections', wraps=store.close_connections) as close_connections:
+            core.metrics_for_range('', dt_range_list, cached=False, workers=2)
+    assert close_connections.call_count == 1
+    assert all(thread.is_alive() for thread, _ in store._connection_list)
+
+def test_preloaded(test_output_dir):
+    "within a `preloaded` context stored results are served from memory"
+    dt = datetime(year=2001, month=1, day=1)
+    store.put('views', dt, dt, {'foo': 'bar'})
+    with store.preloaded([('views', dt, dt), ('downloads', dt, dt)]):
+        with mock.patch('article_metrics.ga_metrics.store.conn') as conn:
+            assert store.get('views', dt, dt) == {'foo': 'bar'}
+        assert not conn.called
+    # results not preloaded are read from the store
+    assert store.get('views', dt, dt) == {'foo': 'bar'}
+
+def test_preloaded__exact_keys(test_output_dir):
+    "only the results for the given keys are preloaded, not everything within their date range"
+    dt = datetime(year=2001, month=1, day=1)
+    month_end = dt + timedelta(days=30)
+    for i in range(31):
+        day = dt + timedelta(days=i)
+        store.put('views', day, day, {'i': i})
+    store.put('views', dt, month_end, {'month': True})
+    with store.preloaded([('views', dt, month_end), ('downloads', dt, month_end)]):
+        assert set(store._local.preloaded.keys()) == {('results', 'views', '2001-01-01', '2001-01-31')}
+        assert store.get('views', dt, month_end) == {'month': True}
+
+def test_preloaded__many_keys(test_output_dir):
+    "keys are preloaded in batches"
+    dt = datetime(year=2001, month=1, day=1)
+    day_list = [dt + timedelta(days=i) for i in range(10)]
+    for day in day_list:
+        store.put('views', day, day, {'day': utils.ymd(day)})
+    with mock.patch('article_metrics.ga_metrics.store.MAX_KEYS_PER_QUERY', 3):
+        with store.preloaded([('views', day, day) for day in day_list]):
+            assert len(store._local.preloaded) == 10
+
+def test_preloaded_cache(test_output_dir):
+    "only the cached results for the date ranges given are preloaded, daily results within a month are not"
+    dt = datetime(year=2001, month=1, day=1)
+    month_end = dt + timedelta(days=30)
+    store.put('views', dt, dt, {'day': True})
+    store.put('views', dt, month_end, {'month': True})
+    store.put('downloads', dt, month_end, {'month': True})
+    with core.preloaded_cache([(dt, month_end)], cached=True):
+        assert set(store._local.preloaded.keys()) == {
+            ('results', 'views', '2001-01-01', '2001-01-31'),
+            ('results', 'downloads', '2001-01-01', '2001-01-31'),
+        }
+
+def test_import_files(test_output_dir):
+    "cache files are imported into the store"
+    os.makedirs(join(test_output_dir, 'views'))
+    for fname in ['views/2001-01-01.json', 'views/2001-01-02.json.gz', 'views/2001-01-01_2001-01-31.json']:
+        core.write_results_v2({'fname': fname}, join(test_output_dir, fname))
+    assert store.import_files(test_output_dir, core.KNOWN_RESULTS_TYPES) == 3
+    dt = datetime(year=2001, month=1, day=1)
+    assert store.get('views', dt, dt) == {'fname': 'views/2001-01-01.json'}
+    assert store.get('views', dt, dt + timedelta(days=30)) == {'fname': 'views/2001-01-01_2001-01-31.json'}
+
+def test_daily_metrics_between__sqlite(test_output_dir):
+    "results are written to and read from the store when the sqlite backend is used"
+    from_dt = datetime(year=2023, month=8, day=13)
+    to_dt = from_dt + timedelta(days=1)
+    views = base.fixture_json('v7--views--2023-03-20.json')
+    downloads = base.fixture_json('v8--downloads--2023-08-13.json')
+    with mock.patch('article_metrics.ga_metrics.ga4.batch_query_ga', side_effect=[[views, downloads], [views, downloads]]):
+        actual = core.daily_metrics_between('', from_dt, to_dt)
+
+    # no cache files were written
+    assert sorted(os.listdir(test_output_dir)) == ['cache.sqlite3', 'cache.sqlite3-shm', 'cache.sqlite3-wal']
+    for dt in [from_dt, to_dt]:
+        assert core.has_cache('views', dt, dt)
+        assert core.has_cache('downloads', dt, dt)
+
+    with mock.patch('article_metrics.ga_metrics.ga4.batch_query_ga') as batch_query:
+        expected = core.daily_metrics_between('', from_dt, to_dt)
+    assert not batch_query.called
+    assert actual == expected
+    assert len(actual[('2023-08-13', '2023-08-13')]['views']) == 9840
+
+def test_article_views__sqlite_ga3(test_output_dir):
+    "GA3 results are written to and read from the store when the sqlite backend is used"
+    dt = datetime(year=2016, month=2, day=8)
+    fixture = base.fixture_json('views-2016-02-08.json')
+    with mock.patch('article_metrics.ga_metrics.core.query_ga', return_value=fixture):
+        expected = core.article_views('12345', dt, dt, cached=True)
+
+    assert sorted(os.listdir(test_output_dir)) == ['cache.sqlite3', 'cache.sqlite3-shm', 'cache.sqlite3-wal']
+    assert store.exists('views', dt, dt)
+    with mock.patch('article_metrics.ga_metrics.core.query_ga') as query_ga:
+        actual = core.article_views('12345', dt, dt, cached=True, only_cached=True)
+    assert not query_ga.called
+    assert expected and actual == expected
+
+def test_put_get_parsed(test_output_dir):
+    "parsed results are only returned for the parser that produced them"
+    dt = datetime(year=2001, month=1, day=1)
+    store.put_parsed('views', dt, dt, 'elife_v1:abc', {'foo': 'bar'})
+    assert store.get_parsed('views', dt, dt, 'elife_v1:abc') == {'foo': 'bar'}
+    assert store.get_parsed('views', dt, dt, 'elife_v1:def') is None
+    assert store.get_parsed('downloads', dt, dt, 'elife_v1:abc') is None
+    with store.preloaded([('views', dt, dt)]):
+        assert store.get_parsed('views', dt, dt, 'elife_v1:abc') == {'foo': 'bar'}
+        assert store.get_parsed('views', dt, dt, 'elife_v1:def') is None
+
+def _parser_version_with_source(elife_module, fn, source):
+    "returns the parser version of `elife_module` as if the source of the function `fn` was `source`."
+    real_getsource = inspect.getsource
+
+    def fake_getsource(obj):
+        return source if obj is fn else real_getsource(obj)
+
+    core.parser_version.cache_clear()
+    try:
+        with mock.patch('article_metrics.ga_metrics.core.inspect.getsource', side_effect=fake_getsource):
+            return core.parser_version(elife_module)
+    finally:
+        core.parser_version.cache_clear()
+
+def test_parser_version__helpers():
+    "the parser version changes with the functions the parser uses and not with unrelated functions in the same modules"
+    from article_metrics import utils as am_utils
+    version = core.parser_version(elife_v7)
+    # used by `elife_v7.path_count`
+    assert _parser_version_with_source(elife_v7, am_utils.msid2doi, "") != version
+    assert _parser_version_with_source(elife_v7, elife_v7.classify_paths, "") != version
+    # not used by the parser
+    assert _parser_version_with_source(elife_v7, am_utils.paginate, "") == version
+    assert _parser_version_with_source(elife_v7, elife_v7.path_counts_query, "") == version
+
+def test_parser_version():
+    "the parser version of an era module includes the functions it depends on"
+    with mock.patch('article_metrics.ga_metrics.core.inspect.getsource', return_value=''):
+        core.parser_version.cache_clear()
+        version = core.parser_version(elife_v8)
+    core.parser_version.cache_clear()
+    assert version.startswith('elife_v8:')
+    assert version != core.parser_version(elife_v8)
+    assert core.parser_version(elife_v7) != core.parser_version(elife_v8)
+
+def test_parsed_cache(test_output_dir):
+    "cached responses are parsed once and subsequently served from the parsed cache"
+    dt = datetime(year=2023, month=8, day=13)
+    store.put('views', dt, dt, base.fixture_json('v7--views--2023-03-20.json'))
+    store.put('downloads', dt, dt, base.fixture_json('v8--downloads--2023-08-13.json'))
+    with mock.patch('article_metrics.ga_metrics.core.settings.GA_PARSED_CACHE', True):
+        expected = core.article_metrics('', dt, dt, cached=True)
+        with mock.patch('article_metrics.ga_metrics.elife_v8.path_counts') as path_counts:
+            with mock.patch('article_metrics.ga_metrics.elife_v8.event_counts') as event_counts:
+                actual = core.article_metrics('', dt, dt, cached=True)
+        assert not path_counts.called
+        assert not event_counts.called
+        assert actual == expected
+        assert len(actual['views']) == 9840
+        assert all(isinstance(counts, Counter) for counts in actual['views'].values())
+
+        # a change to the parser means responses are parsed again
+        with mock.patch('article_metrics.ga_metrics.core.parser_version', return_value='elife_v8:changed'):
+            with mock.patch('article_metrics.ga_metrics.elife_v8.path_counts', return_value={}) as path_counts:
+                core.article_views('', dt, dt, cached=True)
+        assert path_counts.called
+
+def test_manifest(test_output_dir):
+    "results written to the store are recorded in the manifest"
+    dt = datetime(year=2001, month=1, day=1)
+    store.put('views', dt, dt, {})
+    store.put('views', dt, dt + timedelta(days=30), {})
+    store.record('downloads', dt, dt)
+    expected = {('views', '2001-01-01', '2001-01-01'), ('downloads', '2001-01-01', '2001-01-01')}
+    assert store.coverage(['views', 'downloads'], dt, dt) == expected
+
+def test_rebuild_manifest(test_output_dir):
+    "the manifest is rebuilt from the store and cache files"
+    os.makedirs(join(test_output_dir, 'views'))
+    for fname in ['views/2001-01-01.json', 'views/2001-01-02.json.gz', 'views/2001-01-02.json']:
+        core.write_results_v2({}, join(test_output_dir, fname))
+    dt = datetime(year=2001, month=1, day=1)
+    store.put('downloads', dt, dt, {})
+    store.record('views', dt - timedelta(days=1), dt - timedelta(days=1)) # stale
+    assert store.rebuild_manifest(test_output_dir, core.KNOWN_RESULTS_TYPES) == 3
+    expected = {
+        ('views', '2001-01-01', '2001-01-01'),
+        ('views', '2001-01-02', '2001-01-02'),
+        ('downloads', '2001-01-01', '2001-01-01'),
+    }
+    assert store.coverage(['views', 'downloads'], dt - timedelta(days=1), dt + timedelta(days=1)) == expected
+
+def test_cache_gaps(test_output_dir):
+    "date ranges missing from the cache are found using the manifest"
+    dt = datetime(year=2023, month=8, day=1)
+    dt_range_list = [(dt, dt), (dt + timedelta(days=1), dt + timedelta(days=1))]
+    with mock.patch('article_metrics.ga_metrics.core.settings.GA_CACHE_BACKEND', 'files'):
+        with mock.patch('article_metrics.ga_metrics.core.settings.GA_CACHE_MANIFEST', True):
+            os.makedirs(join(test_output_dir, 'views'))
+            core.write_cache('views', dt, dt, {})
+            assert os.path.exists(join(test_output_dir, 'views', '2023-08-01.json.gz'))
+            expected = [
+                ('downloads', '2023-08-01', '2023-08-01'),
+                ('views', '2023-08-02', '2023-08-02'),
+                ('downloads', '2023-08-02', '2023-08-02'),
+            ]
+            assert core.cache_gaps(dt_range_list) == expected
+
+            # results that can't be cached are always missing
+            today = datetime.now()
+            assert core.cache_gaps([(today, today)]) == [('views', utils.ymd(today), utils.ymd(today)),
+                                                         ('downloads', utils.ymd(today), utils.ymd(today))]
+
+            # results before inception are never missing
+            dt = core.DOWNLOADS_INCEPTION - timedelta(days=1)
+            assert core.cache_gaps([(dt, dt)]) == [('views', utils.ymd(dt), utils.ymd(dt))]
+
+def test_metrics_for_range__manifest(test_output_dir):
+    "the manifest is used to find the date ranges that must be fetched"
+    dt = datetime(year=2023, month=8, day=13)
+    store.put('views', dt, dt, base.fixture_json('v7--views--2023-03-20.json'))
+    store.put('downloads', dt, dt, base.fixture_json('v8--downloads--2023-08-13.json'))
+    dt_range_list = [(dt, dt), (dt + timedelta(days=1), dt + timedelta(days=1))]
+    with mock.patch('article_metrics.ga_metrics.core.has_cache', side_effect=AssertionError("cache checked")):
+        with mock.patch('article_metrics.ga_metrics.core.article_metrics', return_value={}) as article_metrics:
+            core.metrics_for_range('', dt_range_list, cached=True, workers=2)
+    assert article_metrics.call_count == 2
+
+def test_put_get_provisional(test_output_dir):
+    "provisional results are returned if they were fetched recently enough and haven't been finalised"
+    dt = datetime(year=2023, month=8, day=13)
+    fetched = datetime(year=2023, month=8, day=14, hour=12)
+    store.put_provisional('views', dt, dt, {'foo': 'bar'}, fetched)
+    assert store.get_provisional('views', dt, dt, fetched - timedelta(hours=1)) == {'foo': 'bar'}
+    assert store.get_provisional('views', dt, dt, fetched + timedelta(hours=1)) is None
+    assert store.get_provisional('downloads', dt, dt, fetched - timedelta(hours=1)) is None
+
+    store.finalise('views', dt, dt)
+    assert store.get_provisional('views', dt, dt, fetched - timedelta(hours=1)) is None
+
+def test_purge_provisional(test_output_dir):
+    "finalised and expired provisional results are removed"
+    dt = datetime(year=2023, month=8, day=13)
+    fetched = datetime(year=2023, month=8, day=14, hour=12)
+    store.put_provisional('views', dt, dt, {}, fetched - timedelta(hours=2))
+    store.put_provisional('downloads', dt, dt, {}, fetched)
+    store.put_provisional('downloads', dt, dt + timedelta(days=1), {}, fetched)
+    store.finalise('downloads', dt, dt)
+    store.purge_provisional(fetched - timedelta(hours=1))
+    assert store.conn().execute("SELECT results_type, from_date, to_date FROM provisional").fetchall() == [('downloads', '2023-08-13', '2023-08-14')]
+
+def test_daily_metrics_between__provisional(test_output_dir):
+    "results for days that can't be cached yet are reused until they expire and are replaced once the days can be cached"
+    dt = datetime(year=2023, month=8, day=13)
+    now = datetime(year=2023, month=8, day=14, hour=12)
+    views = base.fixture_json('v7--views--2023-03-20.json')
+    downloads = base.fixture_json('v8--downloads--2023-08-13.json')
+
+    def daily_metrics(now):
+        with mock.patch('article_metrics.ga_metrics.core.datetime_now', return_value=now):
+            with mock.patch('article_metrics.ga_metrics.ga4.batch_query_ga', return_value=[views, downloads]) as batch_query:
+                results = core.daily_metrics_between('', dt, dt)
+        return results, batch_query.call_count
+
+    with mock.patch('article_metrics.ga_metrics.core.settings.GA_PROVISIONAL_TTL', 3600):
+        expected, num_queries = daily_metrics(now)
+        assert num_queries == 1
+        assert not core.has_cache('views', dt, dt)
+
+        # within the TTL
+        actual, num_queries = daily_metrics(now + timedelta(minutes=30))
+        assert num_queries == 0
+        assert actual == expected
+
+        # after the TTL
+        _, num_queries = daily_metrics(now + timedelta(hours=2))
+        assert num_queries == 1
+
+        # once the day can be cached
+        later = now + timedelta(days=3)
+        _, num_queries = daily_metrics(later)
+        assert num_queries == 1
+        with mock.patch('article_metrics.ga_metrics.core.datetime_now', return_value=later):
+            assert core.has_cache('views', dt, dt)
+        assert store.get_provisional('views', dt, dt, now) is None
+
+def test_daily_metrics_between__provisional_disabled(test_output_dir):
+    "results for days that can't be cached yet are not kept when the provisional cache is disabled"
+    dt = datetime(year=2023, month=8, day=13)
+    views = base.fixture_json('v7--views--2023-03-20.json')
+    downloads = base.fixture_json('v8--downloads--2023-08-13.json')
+    with mock.patch('article_metrics.ga_metrics.core.datetime_now', return_value=datetime(year=2023, month=8, day=14)):
+        with mock.patch('article_metrics.ga_metrics.ga4.batch_query_ga', return_value=[views, downloads]) as batch_query:
+            core.daily_metrics_between('', dt, dt)
+            core.daily_metrics_between('', dt, dt)
+    assert batch_query.call_count == 2
+    assert store.get_provisional('views', dt, dt, dt) is None
@@ -1,9 +1,13 @@
 from unittest import mock
+from contextlib import contextmanager
 from article_metrics import models, logic, utils
-from datetime import datetime
+from article_metrics.utils import first
+from datetime import date, datetime
 from . import base
 from article_metrics.scopus import citations as scopus_citations
 import pytest
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
 
 @pytest.mark.django_db
 def test_import_crossref_citations():
@@ -138,3 +142,181 @@ def test_data_is_updated():
     # rows have correct values
     clean_metric = models.Metric.objects.get(article__doi='10.7554/eLife.00001')
     assert clean_metric.pdf == 1
+
+def _citation(num, source=models.CROSSREF, **kwargs):
+    return dict({'num': num, 'source': source, 'source_id': 'https://example.org/%s' % num}, **kwargs)
+
+@pytest.mark.django_db
+def test_insert_citations():
+    "citations are upserted in chunks, unchanged citations are not touched and changed articles are reported"
+    logic.insert_citation(_citation(1, doi='10.7554/eLife.00001'))
+    art1 = models.Article.objects.get(doi='10.7554/eLife.00001')
+    unchanged = models.Citation.objects.get(article=art1)
+
+    data_list = [
+        _citation(1, doi='10.7554/eLife.00001'), # unchanged
+        _citation(2, doi='10.7554/eLife.00001', source=models.SCOPUS), # created, same article
+        _citation(3, doi='10.7554/eLife.00002'), # created, new article
+        _citation(4, doi='10.7554/eLife.00002'), # same citation again in the same chunk, last one wins
+        _citation(5, doi='10.7554/eLife.00003.001'), # bad doi, sub-resource
+        _citation(6, doi='10.7554/eLife.00002'), # updated in a later chunk
+    ]
+    actual = logic.insert_citations(iter(data_list), chunk_size=4)
+    art2 = models.Article.objects.get(doi='10.7554/eLife.00002')
+    assert actual == {'created': 2, 'updated': 1, 'unchanged': 1, 'changed-articles': sorted([art1.id, art2.id])}
+
+    assert models.Citation.objects.count() == 3
+    assert models.Citation.objects.get(article=art2).num == 6
+    assert models.Citation.objects.get(article=art1, source=models.CROSSREF).datetime_record_updated == unchanged.datetime_record_updated
+
+@pytest.mark.django_db
+def test_insert_citations__pmcid(django_assert_max_num_queries):
+    "citations can be inserted by pmcid, citations for unknown pmcids are skipped"
+    art = first(utils.create_or_update(models.Article, {'doi': '10.7554/eLife.00001', 'pmcid': 'PMC1'}))
+    data_list = [_citation(i, source=models.PUBMED, pmcid='PMC1') for i in range(100)] + [_citation(1, source=models.PUBMED, pmcid='PMC2')]
+    with django_assert_max_num_queries(10):
+        actual = logic.insert_citations(data_list, aid='pmcid')
+    assert actual == {'created': 1, 'updated': 0, 'unchanged': 0, 'changed-articles': [art.id]}
+    assert models.Citation.objects.get().num == 99
+    assert models.Article.objects.count() == 1
+
+@pytest.mark.django_db
+def test_insert_citations__bad_citation():
+    with pytest.raises(ValidationError):
+        logic.insert_citations([_citation(-1, doi='10.7554/eLife.00001')])
+    assert models.Citation.objects.count() == 0
+
+def _metric(doi, datestr, pdf=0, **kwargs):
+    return dict({'pdf': pdf, 'full': 0, 'abstract': 0, 'digest': 0, 'period': models.DAY, 'date': datestr, 'doi': doi, 'source': models.GA}, **kwargs)
+
+@pytest.mark.django_db
+def test_insert_many_rows():
+    "metrics are created or updated in bulk, unchanged metrics are not touched"
+    logic.insert_row(_metric('10.7554/eLife.00001', '2001-01-01'))
+    logic.insert_row(_metric('10.7554/eLife.00001', '2001-01-02'))
+    unchanged = models.Metric.objects.get(date='2001-01-02')
+
+    data_list = [
+        _metric('10.7554/eLife.00001', '2001-01-01', pdf=1), # updated
+        _metric('10.7554/eLife.00001', '2001-01-02'), # unchanged
+        _metric('10.7554/eLife.1', '2001-01-03'), # created, same article
+        _metric('10.7554/eLife.00002', '2001-01-01'), # created, new article
+        _metric('10.7554/eLife.00002', '2001-01-01', pdf=2), # same metric again, last one wins
+        _metric('10.7554/eLife.00003.001', '2001-01-01'), # bad doi, sub-resource
+    ]
+    actual = logic.insert_many_rows(data_list)
+    assert actual == {'created': 2, 'updated': 1, 'unchanged': 1}
+
+    assert models.Article.objects.count() == 2
+    assert models.Metric.objects.count() == 4
+    assert models.Metric.objects.get(article__doi='10.7554/eLife.00001', date='2001-01-01').pdf == 1
+    assert models.Metric.objects.get(article__doi='10.7554/eLife.00002').pdf == 2
+    assert models.Metric.objects.get(date='2001-01-02').datetime_record_updated == unchanged.datetime_record_updated
+
+@pytest.mark.django_db
+def test_insert_many_rows__num_queries(django_assert_max_num_queries):
+    "the number of queries doesn't grow with the number of metrics"
+    data_list = [_metric(utils.msid2doi(msid), '2001-01-01') for msid in range(1, 101)]
+    with django_assert_max_num_queries(8):
+        assert logic.insert_many_rows(data_list)['created'] == 100
+    with django_assert_max_num_queries(8):
+        assert logic.insert_many_rows(data_list)['unchanged'] == 100
+
+@pytest.mark.django_db
+def test_insert_many_rows__bad_metric():
+    "metrics are validated before insert"
+    with pytest.raises(ValidationError):
+        logic.insert_many_rows([_metric('10.7554/eLife.00001', '2001-01-01', pdf=-1)])
+
+@contextmanager
+def _now(dt):
+    "patches the current time to `dt`."
+    with mock.patch('article_metrics.ga_metrics.core.datetime_now', return_value=dt), \
+            mock.patch('article_metrics.logic.datetime_now', return_value=dt), \
+            mock.patch('article_metrics.utils.date_today', return_value=dt.date()):
+        yield
+
+def test_final_date():
+    now = datetime(year=2023, month=8, day=17, hour=10)
+    cases = [
+        ((now,), date(2023, 8, 14)),
+        ((now, True), date(2023, 7, 31)),
+        ((datetime(2023, 8, 1),), date(2023, 8, 1)),
+        ((date(2023, 8, 1),), date(2023, 8, 1)),
+        ((datetime(2023, 7, 31), True), date(2023, 7, 31)),
+        ((datetime(2023, 7, 30), True), date(2023, 6, 30)),
+    ]
+    with _now(now):
+        for args, expected in cases:
+            assert logic.final_date(*args) == expected, "case: %s" % (args,)
+
+@pytest.mark.django_db
+def test_set_watermark():
+    "watermarks never move backwards or over a gap"
+    assert logic.get_watermark('ga-daily') is None
+    logic.set_watermark('ga-daily', datetime(2023, 8, 1))
+    assert logic.get_watermark('ga-daily') == date(2023, 8, 1)
+
+    logic.set_watermark('ga-daily', date(2023, 7, 1))
+    assert logic.get_watermark('ga-daily') == date(2023, 8, 1)
+
+    # import started after the day after the watermark, days were skipped
+    logic.set_watermark('ga-daily', date(2023, 8, 10), from_date=date(2023, 8, 3))
+    assert logic.get_watermark('ga-daily') == date(2023, 8, 1)
+
+    logic.set_watermark('ga-daily', date(2023, 8, 10), from_date=date(2023, 8, 2))
+    assert logic.get_watermark('ga-daily') == date(2023, 8, 10)
+    assert models.Watermark.objects.count() == 1
+
+@pytest.mark.django_db
+def test_watermark_from_date():
+    "sources are imported from the day after their watermark, or the first non-final day, whichever is earlier"
+    now = datetime(year=2023, month=8, day=17, hour=10)
+    with _now(now):
+        default = datetime(2023, 8, 12)
+        assert logic.watermark_from_date('ga-daily', default) == date(2023, 8, 12)
+
+        logic.set_watermark('ga-daily', date(2023, 8, 1))
+        assert logic.watermark_from_date('ga-daily', default) == date(2023, 8, 2)
+
+        logic.set_watermark('ga-daily', date(2023, 8, 14))
+        assert logic.watermark_from_date('ga-daily', default) == date(2023, 8, 15)
+
+        logic.set_watermark('ga-monthly', date(2023, 7, 31))
+        assert logic.watermark_from_date('ga-monthly', default, monthly=True) == date(2023, 8, 1)
+
+def _call_import_metrics(*args):
+    "calls the `import_metrics` command with the imports themselves patched out."
+    with mock.patch('article_metrics.logic.import_ga_metrics'), \
+            mock.patch('article_metrics.logic.import_crossref_citations'), \
+            mock.patch('article_metrics.logic.import_scopus_citations'), \
+            mock.patch('article_metrics.logic.import_pmc_citations'), \
+            mock.patch('article_metrics.logic.recently_updated_article_notifications'), \
+            mock.patch('metrics.logic.update_all_ptypes_latest_frame'):
+        call_command('import_metrics', '--days=7', '--months=2', *args)
+
+@pytest.mark.django_db
+def test_import_metrics__watermarks():
+    "the GA watermarks are set to the last final day and month imported"
+    logic.set_watermark('ga-daily', date(2023, 8, 10))
+    logic.set_watermark('ga-monthly', date(2023, 6, 30))
+    with _now(datetime(2023, 8, 17, 10)), \
+            mock.patch('article_metrics.management.commands.import_metrics.datetime') as mock_datetime:
+        mock_datetime.now.return_value = datetime(2023, 8, 17, 10)
+        _call_import_metrics()
+    assert logic.get_watermark('ga-daily') == date(2023, 8, 14)
+    assert logic.get_watermark('ga-monthly') == date(2023, 7, 31)
+
+@pytest.mark.django_db
+def test_import_metrics__only_cached_watermarks():
+    "missing cache files are empty results when only importing from the cache, the GA watermarks are left where they are"
+    logic.set_watermark('ga-daily', date(2023, 8, 10))
+    logic.set_watermark('ga-monthly', date(2023, 6, 30))
+    with _now(datetime(2023, 8, 17, 10)), \
+            mock.patch('article_metrics.management.commands.import_metrics.datetime') as mock_datetime:
+        mock_datetime.now.return_value = datetime(2023, 8, 17, 10)
+        _call_import_metrics('--only-cached')
+    assert logic.get_watermark('ga-daily') == date(2023, 8, 10)
+    assert logic.get_watermark('ga-monthly') == date(2023, 6, 30)
+    # citation watermarks are unaffected
+    assert logic.get_watermark(models.CROSSREF) == date(2023, 8, 17)
@@ -23,3 +23,47 @@ def test_doi_validator_with_models_invalid():
     invalid_art = models.Article(doi='00.0000/foo.bar')
     with pytest.raises(ValidationError):
         invalid_art.save()
+
+@pytest.mark.django_db
+def test_bulk_ingest(django_assert_num_queries):
+    "instances of bulk ingested models aren't validated on save, instances of other models still are"
+    art = models.Article(doi=settings.DOI_PREFIX + '/eLife.00001')
+    art.save()
+    metric = models.Metric(article=art, date='2001-01-01', period=models.DAY, source=models.GA, full=1, abstract=0, digest=0, pdf=0)
+    with models.bulk_ingest(models.Metric):
+        with django_assert_num_queries(1): # no unique checks, just the insert
+            metric.save()
+        with pytest.raises(ValidationError):
+            models.Article(doi='00.0000/foo.bar').save()
+    assert models.bulk_ingest_models() == frozenset()
+    with pytest.raises(ValidationError):
+        models.Metric(article=art, date='2001-01-01', period=models.DAY, source=models.GA, full=1, abstract=0, digest=0, pdf=0).save()
+
+def test_validate_metric_rows():
+    good = {'date': '2001-01-01', 'period': models.DAY, 'source': models.GA, 'full': 1, 'abstract': 0, 'digest': '0', 'pdf': 0}
+    models.validate_metric_rows([good, dict(good, period=models.MONTH, date='2001-01'), dict(good, period=models.EVER, date=None)])
+    bad_list = [
+        dict(good, date='2001-01'),
+        dict(good, period=models.MONTH, date='2001-01-01'),
+        dict(good, period='year'),
+        dict(good, source='foo'),
+        dict(good, full=-1),
+        dict(good, pdf=None),
+    ]
+    for bad in bad_list:
+        with pytest.raises(ValidationError):
+            models.validate_metric_rows([good, bad])
+
+def test_validate_citation_rows():
+    good = {'doi': '10.7554/eLife.00001', 'num': 1, 'source': models.CROSSREF, 'source_id': 'https://doi.org/10.7554/eLife.00001'}
+    models.validate_citation_rows([good])
+    for bad in [dict(good, num=-1), dict(good, source='foo'), dict(good, source_id=''), dict(good, source_id='a' * 256)]:
+        with pytest.raises(ValidationError) as err:
+            models.validate_citation_rows([good, bad])
+        assert len(err.value.message_dict) == 1
+
+def test_validate_article_rows():
+    models.validate_article_rows([{'doi': settings.DOI_PREFIX + '/eLife.00001', 'pmid': '1', 'pmcid': 'PMC1234567'}])
+    for bad in [{'doi': '00.0000/foo.bar'}, {'doi': settings.DOI_PREFIX, 'pmid': -1}, {'doi': settings.DOI_PREFIX, 'pmcid': 'PMC123456789'}]:
+        with pytest.raises(ValidationError):
+            models.validate_article_rows([bad])
@@ -32,3 +32,18 @@ def test_load_missing():
     art = models.Article.objects.get(doi=doi)
     assert art.pmid is None
     assert art.pmcid == pmcid
+
+@pytest.mark.django_db
+def test_load__update(django_assert_max_num_queries):
+    "only articles whose pmid or pmcid have changed are updated, using a fixed number of queries"
+    fixture = base.fixture_path('pm-fixture.csv')
+    bulkload_pmids.load_csv(fixture)
+    art = models.Article.objects.get(doi='10.7554/eLife.00013')
+    art.pmid = None
+    art.save()
+
+    with django_assert_max_num_queries(8):
+        updated = bulkload_pmids.load_csv(fixture)
+    assert [a.doi for a in updated] == ['10.7554/eLife.00013']
+    assert models.Article.objects.get(doi='10.7554/eLife.00013').pmid == 23066504
+    assert models.Article.objects.count() == 9
@@ -0,0 +1,36 @@
+import pytest
+from article_metrics import models, resolver, logic, utils
+
+@pytest.mark.django_db
+def test_article_ids():
+    "article ids are returned for good dois, missing articles are created"
+    logic.get_create_article({'doi': '10.7554/eLife.00001'})
+    doi_list = ['10.7554/eLife.00001', '10.7554/elife.1', '10.7554/eLife.00002', '10.7554/eLife.00003.001', 'foo']
+    actual = resolver.article_ids(doi_list)
+    assert sorted(actual.keys()) == ['10.7554/eLife.00001', '10.7554/eLife.00002', '10.7554/elife.1']
+    assert actual['10.7554/eLife.00001'] == actual['10.7554/elife.1']
+    assert models.Article.objects.count() == 2
+    assert models.Article.objects.get(doi='10.7554/eLife.00002').id == actual['10.7554/eLife.00002']
+
+@pytest.mark.django_db
+def test_ingestion(django_assert_num_queries):
+    "during an ingestion known articles are resolved without a query"
+    doi_list = [utils.msid2doi(msid) for msid in range(1, 11)]
+    expected = resolver.article_ids(doi_list)
+    with resolver.ingestion():
+        with django_assert_num_queries(0):
+            assert resolver.article_ids(doi_list) == expected
+            with resolver.ingestion(): # nested
+                assert resolver.article_id(doi_list[0]) == expected[doi_list[0]]
+            article = logic.get_create_article({'doi': doi_list[0]})
+            assert (article.id, article.doi) == (expected[doi_list[0]], doi_list[0])
+            assert logic.get_create_article({'doi': 'foo'}) is None
+    assert not resolver.ingesting()
+
+@pytest.mark.django_db
+def test_ingestion__new_articles():
+    "articles created during an ingestion are resolved"
+    with resolver.ingestion():
+        actual = resolver.article_id('10.7554/eLife.00001')
+        assert actual == resolver.article_id('10.7554/eLife.00001')
+    assert models.Article.objects.get(doi='10.7554/eLife.00001').id == actual
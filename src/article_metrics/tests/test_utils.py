@@ -1,5 +1,7 @@
 import typing
+import time
 from article_metrics import utils, models
+from article_metrics.utils import first
 import pytz
 from datetime import datetime, date
 import pytest
@@ -17,6 +19,36 @@ def test_create_or_update_bad_keylist():
     with pytest.raises(AssertionError):
         utils.create_or_update(models.Article, {'pmid': 1}, key_list=['???'])
 
+@pytest.mark.django_db
+def test_create_or_update__update_check(django_assert_num_queries):
+    "changes are detected without another query and unchanged objects are not saved"
+    utils.create_or_update(models.Article, {'doi': '10.7554/eLife.1234', 'pmid': 1})
+    with django_assert_num_queries(1):
+        _, created, updated = utils.create_or_update(models.Article, {'doi': '10.7554/eLife.1234', 'pmid': '1'}, ['doi'], update_check=True)
+    assert (created, updated) == (False, False)
+
+    _, created, updated = utils.create_or_update(models.Article, {'doi': '10.7554/eLife.1234', 'pmid': 2}, ['doi'], update_check=True)
+    assert (created, updated) == (False, True)
+    assert models.Article.objects.get(doi='10.7554/eLife.1234').pmid == 2
+
+@pytest.mark.django_db
+def test_detect_changes():
+    art1 = first(utils.create_or_update(models.Article, {'doi': '10.7554/eLife.00001', 'pmid': 1}))
+    art2 = first(utils.create_or_update(models.Article, {'doi': '10.7554/eLife.00002', 'pmid': 2}))
+    key_list, value_list = ['doi'], ['pmid', 'pmcid']
+    snapshot_map = utils.snapshot(models.Article.objects.all(), key_list, value_list)
+    assert snapshot_map == {('10.7554/eLife.00001',): (art1.id, (1, None)), ('10.7554/eLife.00002',): (art2.id, (2, None))}
+
+    row_list = [
+        {'doi': '10.7554/eLife.00001', 'pmid': '1', 'pmcid': None}, # unchanged
+        {'doi': '10.7554/eLife.00002', 'pmid': 2, 'pmcid': 'PMC2'}, # updated
+        {'doi': '10.7554/eLife.00003', 'pmid': 3, 'pmcid': None}, # created
+    ]
+    created, updated, unchanged = utils.detect_changes(models.Article, snapshot_map, row_list, key_list, value_list)
+    assert created == [row_list[2]]
+    assert updated == [dict(row_list[1], pk=art2.id)]
+    assert unchanged == [dict(row_list[0], pk=art1.id)]
+
 def test_isint():
     int_list = [
         1,
@@ -192,3 +224,17 @@ def test_flatten():
     ]
     for given, expected in cases:
         assert utils.flatten(given) == expected
+
+def test_concurrent_rate_limiter():
+    "calls are spaced out but not serialised"
+    calls = []
+
+    @utils.concurrent_rate_limiter(100)
+    def fn(x):
+        calls.append(time.perf_counter())
+        return x
+
+    assert [fn(x) for x in range(5)] == list(range(5))
+    assert len(calls) == 5
+    # 5 calls at 100/s is at least 40ms between the first and last call
+    assert calls[-1] - calls[0] >= 0.039
@@ -218,6 +218,47 @@ def renkeys(d, keypair_list):
 # django utils
 #
 
+def _field_value(Model, key, val):
+    """returns `val` for the field `key` of `Model` as it would be loaded from the database.
+    related objects are replaced with their primary key."""
+    field = Model._meta.get_field(key)
+    if field.is_relation:
+        return getattr(val, 'pk', val)
+    return field.to_python(val)
+
+def _field_attname(Model, key):
+    return Model._meta.get_field(key).attname
+
+def has_changes(inst, data):
+    "returns `True` if any value in `data` differs from the value of the same field of model instance `inst`."
+    Model = type(inst)
+    return any(getattr(inst, _field_attname(Model, key)) != _field_value(Model, key, val) for key, val in data.items())
+
+def snapshot(queryset, key_list, value_list):
+    """loads the `value_list` fields of each object in `queryset` using a single query.
+    returns a map of each object's `key_list` values to a pair of `(pk, values)`.
+    related fields in `key_list` should be given by their attribute name, like `article_id`."""
+    snapshot_map = {}
+    for row in queryset.values_list('pk', *(key_list + value_list)):
+        snapshot_map[row[1:len(key_list) + 1]] = (row[0], row[len(key_list) + 1:])
+    return snapshot_map
+
+def detect_changes(Model, snapshot_map, row_list, key_list, value_list):
+    """compares the `value_list` values of each row dict in `row_list` with the row in `snapshot_map` with the same `key_list` values.
+    values are compared as they would be loaded from the database.
+    returns a triple of rows `(created, updated, unchanged)`. updated and unchanged rows are returned with the `pk` of their object."""
+    created, updated, unchanged = [], [], []
+    for row in row_list:
+        key = tuple(_field_value(Model, k, row[k]) for k in key_list)
+        existing = snapshot_map.get(key)
+        if existing is None:
+            created.append(row)
+            continue
+        pk, values = existing
+        new_values = tuple(_field_value(Model, k, row[k]) for k in value_list)
+        (updated if values != new_values else unchanged).append(dict(row, pk=pk))
+    return created, updated, unchanged
+
 def create_or_update(Model, orig_data, key_list=None, create=True, update=True, update_check=False, commit=True, **overrides):
     inst = None
     created = updated = checked = False
@@ -232,18 +273,10 @@ def create_or_update(Model, orig_data, key_list=None, create=True, update=True,
         inst = Model.objects.get(**key_list)
         # object exists, otherwise DoesNotExist would have been raised
 
-        # test if objects needs updating
-        # requires a db fetch but may save a db update ...
+        # test if objects needs updating, comparing against the object we already have.
         if update and update_check:
-            try:
-                Model.objects.get(**data) # we could also inspect properties I suppose ...
-                # doesn't need updating
-                update = False
-            except Model.DoesNotExist:
-                # needs updating
-                pass
-            finally:
-                checked = True
+            update = has_changes(inst, data)
+            checked = True
 
         if update:
             [setattr(inst, key, val) for key, val in data.items()]
@@ -380,6 +413,34 @@ def simple_rate_limiter2(max_per_second):
 
 simple_rate_limiter = simple_rate_limiter2
 
+def concurrent_rate_limiter(max_per_second):
+    """like `simple_rate_limiter2` but the lock is only held while reserving a time slot.
+    the decorated function is called outside of the lock so calls from many threads
+    may overlap while still starting no more than `max_per_second` times a second."""
+    lock = threading.Lock()
+    min_interval = 1.0 / max_per_second
+
+    def decorate(func):
+        next_slot = time.perf_counter()
+
+        @wraps(func)
+        def rate_limited_function(*args, **kwargs):
+            nonlocal next_slot
+            with lock:
+                now = time.perf_counter()
+                slot = max(now, next_slot)
+                next_slot = slot + min_interval
+
+            left_to_wait = slot - now
+            if left_to_wait > 0:
+                time.sleep(left_to_wait)
+
+            return func(*args, **kwargs)
+
+        return rate_limited_function
+
+    return decorate
+
 #
 #
 #
@@ -60,6 +60,32 @@ OUTPUT_PATH = join(EXT_DIR if USE_EXT else PROJECT_DIR, 'output')
 # TODO: rename 'GA_OUTPUT_PATH'. we have a path here not a dirname
 GA_OUTPUT_SUBDIR = join(OUTPUT_PATH, 'ga')
 
+# where GA responses are cached.
+# 'files' is a file per-results type, per-date range beneath `GA_OUTPUT_SUBDIR`.
+# 'sqlite' is a single indexed database file beneath `GA_OUTPUT_SUBDIR`.
+GA_CACHE_BACKEND = cfg('general.ga-cache-backend', 'files')
+
+# store the results of parsing GA responses alongside the raw responses, see `article_metrics.ga_metrics.store`.
+GA_PARSED_CACHE = cfg('general.ga-parsed-cache', False)
+
+# record cache files written in a manifest, see `article_metrics.ga_metrics.store`.
+# always enabled when the 'sqlite' cache backend is used.
+# `./manage.py ga_cache_gaps --rebuild` builds the manifest from existing cache files.
+GA_CACHE_MANIFEST = cfg('general.ga-cache-manifest', False)
+
+# the number of pages of a GA4 response fetched concurrently once the first page is known.
+# all GA4 queries share a rate limit, see `article_metrics.ga_metrics.ga4`.
+GA_PAGE_WORKERS = int(cfg('general.ga-page-workers', 4))
+
+# when `True`, uncached GA4 article metrics are fetched concurrently from a single thread using the asyncio client.
+# see `article_metrics.ga_metrics.ga4_async`.
+GA4_ASYNC = cfg('general.ga4-async', False)
+
+# seconds that GA results for date ranges that can't be cached yet are kept and reused for, see `article_metrics.ga_metrics.store`.
+# results within the last three days are never cached permanently as GA may still be collecting them.
+# 0 disables the provisional cache.
+GA_PROVISIONAL_TTL = int(cfg('general.ga-provisional-ttl', 0))
+
 GA3_TABLE_ID = "82618489"
 GA4_TABLE_ID = "316514145"
 
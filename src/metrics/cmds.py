@@ -18,7 +18,7 @@ def ingest_command(ptype_list, replace_cache_files=False):
     else:
         ptype_list = models.PAGE_TYPES
     try:
-        [logic.update_ptype(ptype, replace_cache_files=replace_cache_files) for ptype in ptype_list]
+        logic.update_ptypes([(ptype, None, None) for ptype in ptype_list], replace_cache_files)
     except BaseException as err:
         LOG.exception(str(err))
 
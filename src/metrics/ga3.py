@@ -7,7 +7,6 @@ import importlib
 from article_metrics.utils import ensure, lmap, lfilter
 from article_metrics.ga_metrics import core as ga_core
 from django.conf import settings
-import json
 import os
 import logging
 
@@ -43,11 +42,12 @@ def query_ga(ptype, query, results_pp=MAX_GA_RESULTS, replace_cache_files=False)
     sd, ed = query['start_date'], query['end_date']
     LOG.info("querying GA for %ss between %s and %s" % (ptype, sd, ed))
     dump_path = ga_core.output_path(ptype, sd, ed)
+    cache_path = ga_core.find_cache(dump_path)
     # TODO: this settings.TESTING check is a code smell.
-    if os.path.exists(dump_path) and not settings.TESTING:
+    if cache_path and not settings.TESTING:
         if not replace_cache_files:
             LOG.info("(cache hit)")
-            return json.load(open(dump_path, 'r'))
+            return ga_core.read_results(cache_path)
         # cache file will be replaced with results
         pass
 
@@ -1,7 +1,8 @@
 from urllib.parse import urlparse
+import copy, itertools, json
 from functools import partial
 from datetime import datetime, date
-from article_metrics.utils import ensure
+from article_metrics.utils import ensure, exsubdict, lmap
 from article_metrics.ga_metrics import core as ga_core
 from article_metrics import utils as ga_utils
 import logging
@@ -46,13 +47,81 @@ def build_ga4_query__queries_for_frame(_, frame, start_date, end_date):
             "limit": "10000"}
 
 def query_ga(ptype, query, replace_cache_files=False):
-    start_dt = ga_utils.todt(query['dateRanges'][0]['startDate'])
-    end_dt = ga_utils.todt(query['dateRanges'][0]['endDate'])
+    """returns the results of the GA4 `query` for the given `ptype`.
+    like GA3 queries, cached results are returned unless `replace_cache_files` is `True`.
+    results for date ranges that can't be cached yet may be returned from the provisional cache."""
+    start_dt = ga_utils.todt_notz(query['dateRanges'][0]['startDate'])
+    end_dt = ga_utils.todt_notz(query['dateRanges'][0]['endDate'])
 
     results_type = ptype
+    if not replace_cache_files:
+        results = ga_core.load_cache(results_type, start_dt, end_dt, cached=True, only_cached=False)
+        if results is not None:
+            LOG.info("(cache hit)")
+            return results
+
     results, _ = ga_core.query_ga_write_results_v2(query, start_dt, end_dt, results_type)
     return results
 
+def build_ga4_query__combined(query_list):
+    """returns a single GA4 query map combining the given list of GA4 query maps for page type frames.
+    each query must be for the same date range and filter paths on a single prefix.
+    the combined query matches paths beginning with any of the prefixes."""
+    ensure(query_list, "at least one query is required")
+    ensure(len(set(json.dumps(query['dateRanges']) for query in query_list)) == 1, "queries must be for the same date range")
+    combined = copy.deepcopy(query_list[0])
+    combined['dimensionFilter'] = {'orGroup': {'expressions': [query['dimensionFilter'] for query in query_list]}}
+    return combined
+
+def query_prefix(query):
+    "returns the path prefix the given GA4 `query` for a page type frame filters on."
+    return query['dimensionFilter']['filter']['stringFilter']['value']
+
+def split_response_by_prefix(response, prefix_list):
+    """splits the rows of a `response` to a combined query into a response per-prefix in `prefix_list`, in the same order.
+    a row is included in the response for each prefix it's path begins with, ignoring case like GA's `BEGINS_WITH` filter."""
+    rows_list = [[] for _ in prefix_list]
+    lower_prefix_list = [prefix.lower() for prefix in prefix_list]
+    for row in response.get('rows') or []:
+        path = row['dimensionValues'][1]['value'].lower()
+        for rows, prefix in zip(rows_list, lower_prefix_list):
+            if path.startswith(prefix):
+                rows.append(row)
+    template = exsubdict(response, ['rows', 'rowCount'])
+    return [dict(template, rows=rows, rowCount=len(rows)) for rows in rows_list]
+
+def query_ga_combined(ptype_query_list, replace_cache_files=False):
+    """like `query_ga` but for a list of `(ptype, query)` pairs whose queries are for the same date range.
+    queries that can't be served from the cache are combined into a single query to GA and
+    the rows of the response are routed back to each page type by prefix.
+    each page type's results are cached as if it had been queried separately.
+    returns a list of responses in the same order as `ptype_query_list`."""
+    response_list = [None] * len(ptype_query_list)
+    miss_list = []
+    for i, (ptype, query) in enumerate(ptype_query_list):
+        start_dt = ga_utils.todt_notz(query['dateRanges'][0]['startDate'])
+        end_dt = ga_utils.todt_notz(query['dateRanges'][0]['endDate'])
+        if not replace_cache_files:
+            response_list[i] = ga_core.load_cache(ptype, start_dt, end_dt, cached=True, only_cached=False)
+        if response_list[i] is None:
+            miss_list.append(i)
+
+    if len(miss_list) == 1:
+        i = miss_list[0]
+        response_list[i] = query_ga(*ptype_query_list[i], replace_cache_files=True)
+    elif miss_list:
+        query_list = [ptype_query_list[i][1] for i in miss_list]
+        LOG.info("querying GA for %s page types in a single query" % len(query_list))
+        combined = build_ga4_query__combined(query_list)
+        response = ga_core.query_ga_v2(combined)
+        start_dt = ga_utils.todt_notz(combined['dateRanges'][0]['startDate'])
+        end_dt = ga_utils.todt_notz(combined['dateRanges'][0]['endDate'])
+        for i, ptype_response in zip(miss_list, split_response_by_prefix(response, lmap(query_prefix, query_list))):
+            ptype = ptype_query_list[i][0]
+            ga_core.write_cache(ptype, start_dt, end_dt, ptype_response)
+            response_list[i] = ptype_response
+    return response_list
+
 # --- processing
 
 def prefixed_path_id(prefix, path):
@@ -66,10 +135,14 @@ def prefixed_path_id(prefix, path):
     return identifier
 
 def process_response(ptype, frame, response):
-    rows = response.get('rows')
-    if not rows:
-        LOG.warning("GA responded with no results", extra={'query': response['query'], 'ptype': ptype, 'frame': frame})
+    """normalises the rows of a GA4 `response`.
+    the response's rows may be any iterable, they are consumed one at a time."""
+    rows = iter(response.get('rows') or [])
+    first_row = next(rows, None)
+    if first_row is None:
+        LOG.warning("GA responded with no results", extra={'query': response.get('query'), 'ptype': ptype, 'frame': frame})
         return []
+    rows = itertools.chain([first_row], rows)
 
     id_fn = partial(prefixed_path_id, frame['prefix'])
 
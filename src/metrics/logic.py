@@ -1,10 +1,13 @@
 from . import models, history, ga3, ga4
-from article_metrics.utils import ensure, lmap, create_or_update, first, ymd, lfilter
+from article_metrics.utils import ensure, create_or_update, first, ymd, lfilter, date_today, paginate
+from article_metrics import logic as article_logic
 from article_metrics.ga_metrics import core as ga_core
 from django.db.models import Sum, F
 from django.db.models.functions import TruncMonth
 from datetime import date
-from django.db import transaction
+import os
+from django.conf import settings
+from django.db import transaction, connection
 import logging
 
 LOG = logging.getLogger(__name__)
@@ -143,52 +146,155 @@ def build_ga_query(ptype, start_date=None, end_date=None):
 #
 #
 
+def page_ids(ptypeobj, identifier_list):
+    """returns a map of each identifier in `identifier_list` to the id of it's `models.Page` of type `ptypeobj`.
+    the pages of the type are fetched in a single query and any missing pages are created in another."""
+    def fetch(**kwargs):
+        return dict(models.Page.objects.filter(type=ptypeobj, **kwargs).values_list('identifier', 'id'))
+    id_map = fetch()
+    missing = set(identifier_list).difference(id_map)
+    if missing:
+        bad_list = lfilter(lambda identifier: not is_pid(identifier), missing)
+        ensure(not bad_list, "refusing to create pages with bad identifiers: %s" % bad_list)
+        models.Page.objects.bulk_create([models.Page(type=ptypeobj, identifier=identifier) for identifier in sorted(missing)], ignore_conflicts=True)
+        id_map.update(fetch(identifier__in=missing))
+        LOG.info("%s '%s' pages created" % (len(missing), ptypeobj))
+    return id_map
+
+# the number of page counts inserted or updated per-query.
+UPSERT_CHUNK_SIZE = 10000
+
+UPSERT_PAGE_COUNTS_SQL = open(os.path.join(settings.SQL_PATH, 'pagecount-upsert.sql'), 'r').read()
+
+def upsert_page_counts(row_list):
+    """creates or updates a `models.PageCount` for each row in `row_list` using a single query.
+    rows are dicts of `page_id`, `date` and `views` and are not validated.
+    page counts that exist and are unchanged are not updated.
+    returns a list of `(created,)` for each page count created or updated."""
+    if not row_list:
+        return []
+    params = {key: [row[key] for row in row_list] for key in ['page_id', 'date', 'views']}
+    with connection.cursor() as cursor:
+        cursor.execute(UPSERT_PAGE_COUNTS_SQL, params)
+        return cursor.fetchall()
+
 @transaction.atomic
 def update_page_counts(ptype, page_counts):
+    """creates or updates the page counts of the given `ptype` using a single transaction.
+    pages are fetched and created in bulk and page counts are inserted or updated `UPSERT_CHUNK_SIZE` rows per-query.
+    returns a map of the number of page counts `created`, `updated` and `unchanged`."""
     ptypeobj = first(create_or_update(models.PageType, {"name": ptype}, update=False))
-
-    def do(row):
-        page_data = {
-            'type': ptypeobj,
-            'identifier': row['identifier'],
-        }
-        pageobj = first(create_or_update(models.Page, page_data, update=False))
-
-        pagecount_data = {
-            'page': pageobj,
-            'views': row['views'],
-            'date': row['date']
-        }
-        key_list = ['page', 'date']
-        pagecountobj = first(create_or_update(models.PageCount, pagecount_data, key_list, update=True))
-        return pagecountobj
-    return lmap(do, page_counts)
+    page_counts = list(page_counts)
+
+    bad_list = lfilter(lambda row: not (is_date(row['date']) and isinstance(row['views'], int) and row['views'] >= 0), page_counts)
+    ensure(not bad_list, "refusing to insert bad page counts: %s" % bad_list[:10])
+
+    page_id_map = page_ids(ptypeobj, [row['identifier'] for row in page_counts])
+    row_map = {}
+    for row in page_counts:
+        # a page count may only be upserted once per-query. the last one wins, as if inserted one at a time.
+        row_map[(page_id_map[row['identifier']], row['date'])] = {'page_id': page_id_map[row['identifier']], 'date': row['date'], 'views': row['views']}
+
+    result_list = []
+    for chunk in paginate(list(row_map.values()), UPSERT_CHUNK_SIZE):
+        result_list.extend(upsert_page_counts(chunk))
+    num_created = len(lfilter(first, result_list))
+    summary = {
+        'created': num_created,
+        'updated': len(result_list) - num_created,
+        'unchanged': len(row_map) - len(result_list),
+    }
+    LOG.info("%s '%s' page counts created, %s updated and %s unchanged" % (summary['created'], ptype, summary['updated'], summary['unchanged']))
+    return summary
 
 #
 #
 #
 
-def update_ptype(ptype, start_date=None, end_date=None, replace_cache_files=False):
-    "query GA about a page-type, then process and store the results."
+def update_ptype(ptype, start_date=None, end_date=None, replace_cache_files=False, response_map=None):
+    """query GA about a page-type, then process and store the results.
+    responses already fetched for a frame may be given in `response_map`, keyed by frame id.
+    returns `True` if all results were stored."""
+    response_map = response_map or {}
     try:
         for frame, query in build_ga_query(ptype, start_date, end_date):
-            response = query_ga(ptype, query, replace_cache_files=replace_cache_files)
+            response = response_map.get(frame['id'])
+            if response is None:
+                response = query_ga(ptype, query, replace_cache_files=replace_cache_files)
             normalised_rows = process_response(ptype, frame, response)
             counts = aggregate(normalised_rows)
             LOG.info("inserting/updating %s '%s' rows" % (len(counts), ptype))
             update_page_counts(ptype, counts)
+        return True
     except AssertionError as err:
         LOG.error(err)
+        return False
+
+def combined_responses(ptype_range_list, replace_cache_files=False):
+    """fetches the GA4 frames of each `(ptype, start-date, end-date)` triple in `ptype_range_list` that are for the same
+    date range using a single query, see `ga4.query_ga_combined`.
+    returns a map of `{ptype: {frame-id: response}}`, any problems are left for `update_ptype` to report."""
+    idx = {}
+    for ptype, start_date, end_date in ptype_range_list:
+        try:
+            frame_query_list = build_ga_query(ptype, start_date, end_date)
+        except AssertionError:
+            continue
+        for frame, query in frame_query_list:
+            if ga_core.guess_era_from_query(query) == ga_core.GA4:
+                date_range = query['dateRanges'][0]
+                idx.setdefault((date_range['startDate'], date_range['endDate']), []).append((ptype, frame, query))
+
+    response_map = {}
+    for group in idx.values():
+        if len(group) < 2:
+            continue
+        try:
+            response_list = ga4.query_ga_combined([(ptype, query) for ptype, _, query in group], replace_cache_files)
+        except AssertionError as err:
+            LOG.error("failed to query page types together, querying separately: %s" % err)
+            continue
+        for (ptype, frame, _), response in zip(group, response_list):
+            response_map.setdefault(ptype, {})[frame['id']] = response
+    return response_map
+
+def update_ptypes(ptype_range_list, replace_cache_files=False):
+    """like `update_ptype` for each `(ptype, start-date, end-date)` triple in `ptype_range_list`.
+    GA4 frames for the same date range are fetched using a single query.
+    returns a list of `True` or `False` for each page type, see `update_ptype`."""
+    response_map = combined_responses(ptype_range_list, replace_cache_files)
+    return [update_ptype(ptype, start_date=start_date, end_date=end_date, replace_cache_files=replace_cache_files,
+                         response_map=response_map.get(ptype))
+            for ptype, start_date, end_date in ptype_range_list]
 
 def update_all_ptypes(start_date=None, end_date=None, replace_cache_files=False):
-    for ptype in models.PAGE_TYPES:
-        update_ptype(ptype, start_date, end_date, replace_cache_files)
+    update_ptypes([(ptype, start_date, end_date) for ptype in models.PAGE_TYPES], replace_cache_files)
 
 def update_all_ptypes_latest_frame():
+    ptype_range_list = []
+    for ptype in models.PAGE_TYPES:
+        history_data = history.ptype_history(ptype)
+        latest_frame = history_data['frames'][-1]
+        ptype_range_list.append((ptype, latest_frame['starts'], None))
+    update_ptypes(ptype_range_list)
+
+def ptype_watermark_source(ptype):
+    return 'ptype-%s' % ptype
+
+def update_all_ptypes_since_watermark():
+    """like `update_all_ptypes_latest_frame`, but each page type is only queried from the day after it's watermark,
+    plus the days whose metrics aren't final yet."""
+    ptype_range_list = []
     for ptype in models.PAGE_TYPES:
         history_data = history.ptype_history(ptype)
         latest_frame = history_data['frames'][-1]
-        update_ptype(ptype, start_date=latest_frame['starts'], end_date=None)
+        source = ptype_watermark_source(ptype)
+        start_date = max(latest_frame['starts'], article_logic.watermark_from_date(source, latest_frame['starts']))
+        ptype_range_list.append((ptype, start_date, None))
+    final_date = article_logic.final_date(date_today())
+    for (ptype, start_date, _), success in zip(ptype_range_list, update_ptypes(ptype_range_list)):
+        if success:
+            article_logic.set_watermark(ptype_watermark_source(ptype), final_date, start_date)
 
 #
 #
@@ -2,9 +2,10 @@ import json
 from . import base
 from unittest import mock
 from datetime import date, datetime
-from metrics import ga4
+from metrics import ga4, history, models
 import pytest
 from article_metrics import utils
+from article_metrics.utils import lmap
 import os
 
 @pytest.fixture(name="tempdir")
@@ -71,6 +72,87 @@ def test_query_ga(tempdir):
     assert os.path.exists(output_path)
     assert json.load(open(output_path, 'r')) == expected
 
+def test_query_ga__provisional(tempdir):
+    "results for a frame that ends too recently to be cached are kept provisionally and reused"
+    start_dt = datetime(year=2023, month=3, day=20)
+    end_dt = datetime(year=2023, month=8, day=14)
+    frame = {'id': 'foo',
+             'prefix': '/inside-elife',
+             'starts': start_dt,
+             'ends': end_dt}
+    query = ga4.build_ga4_query__queries_for_frame(None, frame, start_dt, end_dt)
+    fixture = json.load(open(base.fixture_path('ga4-response--blog-articles.json'), 'r'))
+
+    with mock.patch('article_metrics.ga_metrics.core.settings.GA_OUTPUT_SUBDIR', tempdir), \
+            mock.patch('article_metrics.ga_metrics.core.settings.GA_PROVISIONAL_TTL', 3600), \
+            mock.patch('article_metrics.ga_metrics.core.datetime_now', return_value=datetime(year=2023, month=8, day=15)):
+        with mock.patch('article_metrics.ga_metrics.ga4.query_ga', return_value=fixture) as query_ga:
+            first = ga4.query_ga('blog-article', query)
+            second = ga4.query_ga('blog-article', query)
+            assert query_ga.call_count == 1
+            assert first == second == fixture
+
+            ga4.query_ga('blog-article', query, replace_cache_files=True)
+            assert query_ga.call_count == 2
+
+def _ptype_frame_query(ptype, start_dt, end_dt):
+    frame = history.ptype_history(ptype)['frames'][-1]
+    return ga4.build_ga4_query__queries_for_frame(ptype, frame, start_dt, end_dt)
+
+def test_build_ga4_query__combined():
+    "the combined query matches paths beginning with any of the prefixes of the given queries"
+    start_dt, end_dt = date(2023, 4, 1), date(2023, 4, 30)
+    query_list = [_ptype_frame_query(ptype, start_dt, end_dt) for ptype in [models.EVENT, 'blog-article']]
+    actual = ga4.build_ga4_query__combined(query_list)
+    assert actual['dateRanges'] == query_list[0]['dateRanges']
+    assert actual['dimensions'] == query_list[0]['dimensions']
+    assert actual['dimensionFilter'] == {'orGroup': {'expressions': [query['dimensionFilter'] for query in query_list]}}
+    assert lmap(ga4.query_prefix, query_list) == ['/events', '/inside-elife']
+
+    query_list.append(_ptype_frame_query('digest', start_dt, date(2023, 5, 1)))
+    with pytest.raises(AssertionError):
+        ga4.build_ga4_query__combined(query_list)
+
+def _row(path, count):
+    return {'dimensionValues': [{'value': '20230401'}, {'value': path}], 'metricValues': [{'value': str(count)}]}
+
+def test_split_response_by_prefix():
+    response = {'kind': 'analyticsData#runReport',
+                'rows': [_row('/events/foo', 1), _row('/inside-elife/bar', 2), _row('/Events/baz?q=1', 3), _row('/other', 4)],
+                'rowCount': 4}
+    expected = [
+        {'kind': 'analyticsData#runReport', 'rows': [_row('/events/foo', 1), _row('/Events/baz?q=1', 3)], 'rowCount': 2},
+        {'kind': 'analyticsData#runReport', 'rows': [_row('/inside-elife/bar', 2)], 'rowCount': 1},
+        {'kind': 'analyticsData#runReport', 'rows': [], 'rowCount': 0},
+    ]
+    assert ga4.split_response_by_prefix(response, ['/events', '/inside-elife', '/digests']) == expected
+
+def test_query_ga_combined(tempdir):
+    "page types are queried together, their results routed by prefix and cached as if queried separately"
+    start_dt, end_dt = date(2023, 4, 1), date(2023, 4, 30)
+    ptype_list = [models.EVENT, 'blog-article', 'digest']
+    ptype_query_list = [(ptype, _ptype_frame_query(ptype, start_dt, end_dt)) for ptype in ptype_list]
+    fixture = json.load(open(base.fixture_path('ga4-response--blog-articles.json'), 'r'))
+    response = dict(fixture, rows=fixture['rows'] + [_row('/events/foo', 1)])
+
+    with mock.patch('article_metrics.ga_metrics.core.settings.GA_OUTPUT_SUBDIR', tempdir):
+        for ptype in ptype_list:
+            os.makedirs(os.path.join(tempdir, ptype))
+        with mock.patch('article_metrics.ga_metrics.ga4.query_ga', return_value=response) as query_ga:
+            events, blog_articles, digests = ga4.query_ga_combined(ptype_query_list)
+        assert query_ga.call_count == 1
+        assert query_ga.call_args[0][0]['dimensionFilter']['orGroup']
+
+        assert events['rows'] == [_row('/events/foo', 1)]
+        assert blog_articles['rows'] == fixture['rows']
+        assert digests['rows'] == []
+
+        # each page type's results were cached
+        with mock.patch('article_metrics.ga_metrics.ga4.query_ga') as query_ga:
+            assert ga4.query_ga_combined(ptype_query_list) == [events, blog_articles, digests]
+            assert ga4.query_ga(models.EVENT, ptype_query_list[0][1]) == events
+        assert not query_ga.called
+
 def test_process_response():
     expected = [
         {'date': date(2023, 1, 2), 'identifier': '54d63486', 'views': 157},
@@ -89,6 +171,20 @@ def test_process_response():
     actual = ga4.process_response(ptype, frame, response)
     assert actual[:10] == expected[:10]
 
+def test_process_response__iterator():
+    "rows can be any iterable"
+    ptype = 'blog-article'
+    frame = {'prefix': '/inside-elife'}
+    response = json.load(open(base.fixture_path('ga4-response--blog-articles.json'), 'r'))
+    expected = ga4.process_response(ptype, frame, response)
+    response['rows'] = iter(response['rows'])
+    assert ga4.process_response(ptype, frame, response) == expected
+
+    response = {'query': {}, 'rows': iter([])}
+    with mock.patch('metrics.ga4.LOG') as log:
+        assert ga4.process_response(ptype, frame, response) == []
+        assert log.warning.call_count == 1
+
 def test_process_response__other_row():
     expected = []
     expected_error = "skipping row, bad value: path does not start with given prefix ('/inside-elife'): (other)"
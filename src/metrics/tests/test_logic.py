@@ -2,7 +2,8 @@ import pytest
 from . import base
 from article_metrics.utils import tod
 from metrics import logic, models
-from datetime import date, timedelta
+from article_metrics import logic as article_logic
+from datetime import date, datetime, timedelta
 from unittest.mock import patch
 from django.db.models import Sum
 
@@ -116,7 +117,7 @@ def test_insert():
         ("/events/bar", tod("2018-01-03"), 1)
     ])
     results = logic.update_page_counts(models.EVENT, aggregated_rows)
-    assert len(results) == len(aggregated_rows)
+    assert results == {'created': len(aggregated_rows), 'updated': 0, 'unchanged': 0}
 
     assert models.PageType.objects.count() == 1
     assert models.Page.objects.count() == 2
@@ -131,7 +132,7 @@ def test_double_insert():
         ("/events/bar", tod("2018-01-03"), 1)
     ])
     results = logic.update_page_counts(models.EVENT, aggregated_rows)
-    assert len(results) == len(aggregated_rows)
+    assert results == {'created': len(aggregated_rows), 'updated': 0, 'unchanged': 0}
     assert models.PageType.objects.count() == 1
     assert models.Page.objects.count() == 2
     assert models.PageCount.objects.count() == 4
@@ -147,7 +148,7 @@ def test_double_insert():
         ("/events/bar", tod("2018-01-03"), 2)
     ])
     results = logic.update_page_counts(models.EVENT, aggregated_rows)
-    assert len(results) == len(aggregated_rows)
+    assert results == {'created': 0, 'updated': len(aggregated_rows), 'unchanged': 0}
 
     # these numbers should have stayed the same
     assert models.PageType.objects.count() == 1
@@ -158,6 +159,29 @@ def test_double_insert():
     expected_total = 16
     assert expected_total == actual_total()
 
+@pytest.mark.django_db
+def test_update_page_counts__bulk(django_assert_max_num_queries):
+    "page counts are upserted in chunks using a fixed number of queries, unchanged page counts are not updated"
+    aggregated_rows = logic.asmaps([("page-%s" % i, tod("2018-01-01"), i) for i in range(25)])
+    with patch('metrics.logic.UPSERT_CHUNK_SIZE', 10):
+        with django_assert_max_num_queries(15): # not one or more per-row
+            results = logic.update_page_counts(models.EVENT, aggregated_rows)
+        assert results == {'created': 25, 'updated': 0, 'unchanged': 0}
+
+        aggregated_rows[0]['views'] = 100
+        results = logic.update_page_counts(models.EVENT, aggregated_rows)
+        assert results == {'created': 0, 'updated': 1, 'unchanged': 24}
+
+    assert models.Page.objects.count() == 25
+    assert models.PageCount.objects.get(page__identifier='page-0').views == 100
+
+@pytest.mark.django_db
+def test_update_page_counts__bad_rows():
+    aggregated_rows = logic.asmaps([("foo", tod("2018-01-01"), -1)])
+    with pytest.raises(AssertionError):
+        logic.update_page_counts(models.EVENT, aggregated_rows)
+    assert models.PageCount.objects.count() == 0
+
 @pytest.mark.django_db
 def test_update_ptype():
     "`update_ptype` convenience function behaves as expected"
@@ -177,3 +201,40 @@ def test_update_ptype():
     assert models.PageType.objects.count() == 1 # 'event'
     # not the same as len(fixture.rows) because of aggregation
     assert models.PageCount.objects.count() == 138
+
+@pytest.mark.django_db
+def test_update_all_ptypes_since_watermark():
+    "page types are queried from the day after their watermark and the watermark is moved once stored"
+    today = date(2023, 8, 17)
+    watermark = date(2023, 8, 1)
+    article_logic.set_watermark(logic.ptype_watermark_source('event'), watermark)
+    with patch('metrics.logic.date_today', return_value=today), \
+            patch('article_metrics.utils.date_today', return_value=today), \
+            patch('article_metrics.ga_metrics.core.datetime_now', return_value=datetime(2023, 8, 17)):
+        with patch('metrics.logic.update_ptype', return_value=True) as update_ptype, patch('metrics.logic.combined_responses', return_value={}):
+            logic.update_all_ptypes_since_watermark()
+    start_dates = {call.args[0]: call.kwargs['start_date'] for call in update_ptype.call_args_list}
+    assert start_dates['event'] == watermark + timedelta(days=1)
+    # no watermark, the latest frame is queried
+    assert start_dates['blog-article'] == logic.history.ptype_history('blog-article')['frames'][-1]['starts']
+    # watermarks are set to the last final day
+    for ptype in models.PAGE_TYPES:
+        assert article_logic.get_watermark(logic.ptype_watermark_source(ptype)) < today
+
+@pytest.mark.django_db
+def test_update_all_ptypes__combined():
+    "the GA4 frames of all page types are fetched with a single query"
+    fixture = base.fixture_json('ga4-response--blog-articles.json')
+    empty = dict(fixture, rows=[], rowCount=0)
+
+    def query_ga_combined(ptype_query_list, replace_cache_files):
+        return [fixture if ptype == 'blog-article' else empty for ptype, _ in ptype_query_list]
+
+    start_date = date(2023, 4, 1)
+    with patch('metrics.ga4.query_ga_combined', side_effect=query_ga_combined) as combined:
+        with patch('metrics.logic.query_ga', side_effect=AssertionError("page type queried separately")):
+            logic.update_all_ptypes(start_date, date(2023, 4, 30))
+    assert combined.call_count == 1
+    assert [ptype for ptype, _ in combined.call_args[0][0]] == list(models.PAGE_TYPES)
+    assert set(models.Page.objects.values_list('type', flat=True)) == {'blog-article'}
+    assert models.PageCount.objects.count() > 0